@@ -0,0 +1,46 @@
+import hashlib
+
+from jenkins.utils import DefaultSettings
+
+
+# The checksums that can be stored for an ArchiveArtifact, sha256 is always
+# calculated.
+CHECKSUM_ALGORITHMS = ("sha256", "sha1", "md5")
+
+checksum_settings = DefaultSettings({
+    # Checksums calculated as artifacts are transferred, in addition to sha256.
+    "ARCHIVE_CHECKSUMS": ["sha256"],
+})
+
+
+class Checksums(object):
+    """
+    Calculates the checksums of an artifact as it's streamed to an archive,
+    so that the archived file doesn't need to be read again.
+    """
+    def __init__(self, algorithms=None):
+        if algorithms is None:
+            algorithms = checksum_settings.ARCHIVE_CHECKSUMS
+        algorithms = set(algorithms) | set(["sha256"])
+        unknown = algorithms - set(CHECKSUM_ALGORITHMS)
+        if unknown:
+            raise ValueError(
+                "Unknown checksum algorithms: %s" % ", ".join(sorted(unknown)))
+        self.hashes = dict(
+            (algorithm, hashlib.new(algorithm)) for algorithm in algorithms)
+
+    def update(self, data):
+        """
+        Adds a chunk of the artifact to each of the checksums.
+        """
+        for checksum in self.hashes.values():
+            checksum.update(data)
+
+    def hexdigests(self):
+        """
+        Returns a dictionary mapping the algorithms to the hex digest of the
+        data.
+        """
+        return dict(
+            (algorithm, checksum.hexdigest())
+            for algorithm, checksum in self.hashes.items())
@@ -9,3 +9,15 @@ def get_default_archive():
         return Archive.objects.get(default=True)
     except Archive.DoesNotExist:
         return
+
+
+def get_enabled_archives():
+    """
+    Returns the default archive followed by the archives which builds are
+    replicated to, or an empty list if there's no default archive.
+    """
+    default = get_default_archive()
+    if default is None:
+        return []
+    return [default] + list(
+        Archive.objects.filter(replicate=True).exclude(pk=default.pk))
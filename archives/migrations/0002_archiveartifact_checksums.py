@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('archives', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archiveartifact',
+            name='md5',
+            field=models.CharField(default=b'', max_length=32, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='archiveartifact',
+            name='sha1',
+            field=models.CharField(default=b'', max_length=40, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='archiveartifact',
+            name='sha256',
+            field=models.CharField(default=b'', max_length=64, blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('archives', '0002_archiveartifact_checksums'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archive',
+            name='content_addressed',
+            field=models.BooleanField(default=False, help_text=b'Store files with the same content once, and link the archived files to them.'),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='archiveartifact',
+            name='content_addressed',
+            field=models.BooleanField(default=False),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('archives', '0003_content_addressed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archive',
+            name='replicate',
+            field=models.BooleanField(default=False, help_text=b'Copy every build to this archive as well as to the default archive.'),
+            preserve_default=True,
+        ),
+    ]
@@ -3,11 +3,15 @@ import urlparse
 from collections import OrderedDict
 
 from django.db import models
+from django.db.models import Q
 from django.utils.encoding import python_2_unicode_compatible
 
 from jenkins.models import Artifact, Build
 from credentials.models import SshKeyPair
-from projects.models import ProjectBuildDependency, Dependency
+from projects.caching import get_dependencies_for_job, bump_versions_for_job
+from projects.models import (
+    ProjectBuildDependency, ProjectBuildArtifact, Dependency)
+from archives.checksums import CHECKSUM_ALGORITHMS
 from archives.policies import CdimageArchivePolicy, DefaultPolicy
 from archives.transports import SshTransport, LocalTransport
 
@@ -32,6 +36,14 @@ class Archive(models.Model):
         max_length=64, choices=[(p, p) for p in TRANSPORTS.keys()])
     default = models.BooleanField(default=False)
     base_url = models.CharField(max_length=200, blank=True, default="")
+    content_addressed = models.BooleanField(
+        default=False,
+        help_text="Store files with the same content once, and link the "
+        "archived files to them.")
+    replicate = models.BooleanField(
+        default=False,
+        help_text="Copy every build to this archive as well as to the "
+        "default archive.")
 
     def __str__(self):
         return self.name
@@ -67,6 +79,8 @@ class Archive(models.Model):
             items = self.add_dependency_build(build)
             for artifact, files in self.add_projectbuild(build).items():
                 items.setdefault(artifact, []).extend(files)
+        # The archived items are displayed for the projects and dependencies.
+        bump_versions_for_job(build.job_id)
         return items
 
     def add_dependency_build(self, build):
@@ -75,9 +89,10 @@ class Archive(models.Model):
         """
         logging.info("    processing dependency builds")
         items = OrderedDict()
+        dependencies = get_dependencies_for_job(build.job_id)
         for artifact in build.artifact_set.all():
             logging.info("Adding artifact %s", artifact)
-            for dependency in build.job.dependency_set.all():
+            for dependency in dependencies:
                 items.setdefault(artifact, []).append(self.add_artifact(
                     artifact, build, dependency=dependency))
         return items
@@ -96,6 +111,20 @@ class Archive(models.Model):
                     projectbuild_dependency=dependency))
         return items
 
+    def add_projectbuild_dependency(self, projectbuild_dependency):
+        """
+        This adds the build of a ProjectBuildDependency which was built
+        before the ProjectBuild was requested, e.g. a reused build.
+        """
+        items = OrderedDict()
+        build = projectbuild_dependency.build
+        for artifact in build.artifact_set.all():
+            logging.info("Adding artifact %s", artifact)
+            items.setdefault(artifact, []).append(self.add_artifact(
+                artifact, build, dependency=projectbuild_dependency.dependency,
+                projectbuild_dependency=projectbuild_dependency))
+        return items
+
     def add_artifact(
             self, artifact, build, dependency=None,
             projectbuild_dependency=None):
@@ -108,12 +137,14 @@ class Archive(models.Model):
         archived_path = policy.get_path_for_artifact(
             artifact, build=build, dependency=dependency,
             projectbuild=projectbuild)
-        return self.items.create(
+        item = self.items.create(
             artifact=artifact,
             dependency=dependency,
             build=build,
             projectbuild_dependency=projectbuild_dependency,
             archived_path=archived_path)
+        item.update_manifest()
+        return item
 
     def get_archived_artifacts_for_build(self, build):
         """
@@ -121,6 +152,53 @@ class Archive(models.Model):
         """
         return self.items.filter(build=build)
 
+    def get_blob_item(self, artifact):
+        """
+        Returns an item in the archive whose archived file is a link to a
+        blob with the content of the artifact, or None.
+
+        The item can be for any build, it's matched by the artifact, or by
+        the MD5 fingerprint Jenkins recorded for the artifact, see
+        get_fingerprint_item.
+        """
+        content = Q(artifact=artifact)
+        if artifact.fingerprint:
+            content |= self._get_fingerprint_query(artifact.fingerprint)
+        return self.items.filter(
+            content, content_addressed=True,
+            archived_at__isnull=False).exclude(sha256="").order_by(
+            "-archived_at").first()
+
+    def get_archived_item(self, artifact):
+        """
+        Returns the most recently archived item in the archive for the
+        artifact, or None.
+        """
+        return self.items.filter(
+            artifact=artifact, archived_at__isnull=False,
+            archived_path__isnull=False).order_by("-archived_at").first()
+
+    def _get_fingerprint_query(self, fingerprint):
+        """
+        Returns a query matching items by the md5 calculated as they were
+        archived, or the fingerprint of their artifact if it wasn't.
+        """
+        return (Q(md5=fingerprint) |
+                Q(md5="", artifact__fingerprint=fingerprint))
+
+    def get_fingerprint_item(self, artifact):
+        """
+        Returns the most recently archived item in the archive with the same
+        content as the artifact, according to the MD5 fingerprint Jenkins
+        recorded for it, or None.
+        """
+        if not artifact.fingerprint:
+            return None
+        return self.items.filter(
+            self._get_fingerprint_query(artifact.fingerprint),
+            archived_at__isnull=False, archived_path__isnull=False).order_by(
+            "-archived_at").first()
+
 
 @python_2_unicode_compatible
 class ArchiveArtifact(models.Model):
@@ -130,6 +208,12 @@ class ArchiveArtifact(models.Model):
     archived_at = models.DateTimeField(blank=True, null=True)
     archived_path = models.CharField(max_length=255, blank=True, null=True)
     archived_size = models.IntegerField(default=0)
+    # Calculated as the artifact is archived, see archives.checksums.
+    sha256 = models.CharField(max_length=64, blank=True, default="")
+    sha1 = models.CharField(max_length=40, blank=True, default="")
+    md5 = models.CharField(max_length=32, blank=True, default="")
+    # The archived file is a link to the blob for the sha256.
+    content_addressed = models.BooleanField(default=False)
 
     build = models.ForeignKey(Build, blank=True, null=True)
     projectbuild_dependency = models.ForeignKey(
@@ -150,3 +234,41 @@ class ArchiveArtifact(models.Model):
         """
         return urlparse.urljoin(
             self.archive.base_url, self.archived_path.lstrip("/"))
+
+    def set_checksums(self, checksums):
+        """
+        Stores the checksums calculated as the artifact was archived.
+        """
+        for algorithm, hexdigest in checksums.hexdigests().items():
+            setattr(self, algorithm, hexdigest)
+
+    def copy_checksums(self, item):
+        """
+        Copies the checksums from another ArchiveArtifact for the same file.
+        """
+        for algorithm in CHECKSUM_ALGORITHMS:
+            setattr(self, algorithm, getattr(item, algorithm))
+
+    def update_manifest(self):
+        """
+        Records the archived URL, size and checksum of this item in the
+        manifest of the ProjectBuild it was archived for, the manifest refers
+        to the default archive.
+        """
+        if self.projectbuild_dependency is None or not self.archive.default:
+            return
+        details = {
+            "archive_url": self.get_url(),
+            "size": self.archived_size if self.archived_at else None,
+            "checksum": self.sha256 if self.archived_at else ""}
+        updated = ProjectBuildArtifact.objects.filter(
+            projectbuild=self.projectbuild_dependency.projectbuild_id,
+            artifact=self.artifact_id).update(**details)
+        if not updated:
+            # The manifest was written before the artifact was recorded for
+            # the ProjectBuild.
+            artifact = self.artifact
+            ProjectBuildArtifact.objects.create(
+                projectbuild_id=self.projectbuild_dependency.projectbuild_id,
+                artifact=artifact, build_id=artifact.build_id,
+                filename=artifact.filename, url=artifact.url, **details)
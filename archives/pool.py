@@ -0,0 +1,181 @@
+import os
+import time
+import socket
+import logging
+import threading
+
+from paramiko import SSHException
+
+from jenkins.utils import DefaultSettings
+
+
+pool_settings = DefaultSettings({
+    # The maximum number of connections to each archive from a worker.
+    "ARCHIVE_SSH_POOL_MAX_SESSIONS": 4,
+    # Connections which have been idle for this many seconds are closed.
+    "ARCHIVE_SSH_POOL_IDLE_TIMEOUT": 5 * 60,
+    # Seconds to wait for a connection when all of them are in use.
+    "ARCHIVE_SSH_POOL_ACQUIRE_TIMEOUT": 60,
+})
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no connection becomes available within the
+    ARCHIVE_SSH_POOL_ACQUIRE_TIMEOUT.
+    """
+
+
+class SshConnection(object):
+    """
+    An SSHClient and the SFTPClient opened over it.
+    """
+    def __init__(self, ssh_client, sftp_client):
+        self.ssh_client = ssh_client
+        self.sftp_client = sftp_client
+        self.last_used = time.time()
+
+    def is_healthy(self):
+        """
+        Returns True if the connection to the server is still usable.
+        """
+        transport = self.ssh_client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except (SSHException, socket.error, EOFError):
+            return False
+        return True
+
+    def close(self):
+        """
+        Closes the connection, ignoring errors from connections which are
+        already broken.
+        """
+        try:
+            self.sftp_client.close()
+            self.ssh_client.close()
+        except Exception:
+            logging.exception("Error closing ssh connection")
+
+
+class SshConnectionPool(object):
+    """
+    Keeps the ssh connections to the archives open between tasks, so that
+    each task doesn't need to connect and authenticate.
+
+    Connections are checked before they're reused, and replaced if they're
+    broken or have been idle for longer than the
+    ARCHIVE_SSH_POOL_IDLE_TIMEOUT.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = {}
+        self._in_use = {}
+
+    def _check_pid(self):
+        """
+        Connections inherited from the parent of a forked worker are
+        dropped without closing them, they're still used by the parent.
+        """
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _pop_expired(self):
+        """
+        Removes and returns the connections which have been idle for too long.
+        """
+        cutoff = time.time() - pool_settings.ARCHIVE_SSH_POOL_IDLE_TIMEOUT
+        expired = []
+        for key, connections in self._idle.items():
+            expired.extend(x for x in connections if x.last_used < cutoff)
+            self._idle[key] = [x for x in connections if x.last_used >= cutoff]
+        return expired
+
+    def acquire(self, key, connect):
+        """
+        Returns an SshConnection for the key, reusing an idle connection if
+        there is a healthy one, or calling connect to create the SSHClient
+        and SFTPClient for a new connection.
+
+        Raises PoolTimeout if the ARCHIVE_SSH_POOL_MAX_SESSIONS are all in
+        use for longer than the ARCHIVE_SSH_POOL_ACQUIRE_TIMEOUT.
+        """
+        deadline = time.time() + pool_settings.ARCHIVE_SSH_POOL_ACQUIRE_TIMEOUT
+        with self._condition:
+            self._check_pid()
+            expired = self._pop_expired()
+            while True:
+                idle = self._idle.get(key)
+                if idle or (self._in_use.get(key, 0) <
+                            pool_settings.ARCHIVE_SSH_POOL_MAX_SESSIONS):
+                    connection = idle.pop() if idle else None
+                    self._in_use[key] = self._in_use.get(key, 0) + 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolTimeout(
+                        "No ssh connection available for %s" % (key,))
+                self._condition.wait(remaining)
+
+        for expired_connection in expired:
+            expired_connection.close()
+        try:
+            if connection is not None and not connection.is_healthy():
+                logging.info("Reconnecting broken ssh connection for %s", key)
+                connection.close()
+                connection = None
+            if connection is None:
+                connection = SshConnection(*connect())
+        except Exception:
+            self._release_slot(key)
+            raise
+        return connection
+
+    def _release_slot(self, key):
+        with self._condition:
+            if key in self._in_use:
+                self._in_use[key] -= 1
+            self._condition.notify()
+
+    def release(self, key, connection, discard=False):
+        """
+        Returns the connection to the pool, or closes it if it should be
+        discarded because an operation on it failed.
+        """
+        expired = []
+        with self._condition:
+            if self._pid == os.getpid() and self._in_use.get(key):
+                self._in_use[key] -= 1
+                if not discard:
+                    connection.last_used = time.time()
+                    self._idle.setdefault(key, []).append(connection)
+                expired = self._pop_expired()
+                self._condition.notify()
+            else:
+                discard = True
+        if discard:
+            connection.close()
+        for expired_connection in expired:
+            expired_connection.close()
+
+    def close_all(self):
+        """
+        Closes the idle connections and forgets those in use.
+        """
+        with self._condition:
+            idle = [x for connections in self._idle.values()
+                    for x in connections]
+            self._reset()
+            self._condition.notify_all()
+        for connection in idle:
+            connection.close()
+
+
+# Each worker process keeps its own connections.
+ssh_pool = SshConnectionPool()
@@ -1,27 +1,86 @@
+import posixpath
+import uuid
+
 from paramiko import SFTPClient as BaseSFTPClient
+from paramiko.sftp import CMD_EXTENDED
 
 
 class SFTPClient(BaseSFTPClient):
-    def stream_file_to_remote(self, fileobj, remotepath):
+
+    def __init__(self, *args, **kwargs):
+        super(SFTPClient, self).__init__(*args, **kwargs)
+        # Directories which are known to exist on the server, the client is
+        # kept open between tasks by the pool, so this saves checking for
+        # the directories of each artifact.
+        self.directories = set()
+
+    def makedirs(self, path):
+        """
+        Creates the remote directory and any missing parents, like mkdir -p.
+
+        Directories which were created or found through this client aren't
+        checked again.
+        """
+        if path in self.directories or path == posixpath.dirname(path):
+            return
+        try:
+            self.stat(path)
+        except IOError:
+            self.makedirs(posixpath.dirname(path))
+            try:
+                self.mkdir(path)
+            except IOError:
+                # It may have been created by another connection since.
+                self.stat(path)
+        self.directories.add(path)
+
+    def posix_rename(self, oldpath, newpath):
+        """
+        Renames oldpath to newpath, replacing newpath if it exists, using the
+        posix-rename@openssh.com extension, which paramiko 1.13 doesn't
+        provide.
+        """
+        oldpath = self._adjust_cwd(oldpath)
+        newpath = self._adjust_cwd(newpath)
+        self._request(
+            CMD_EXTENDED, "posix-rename@openssh.com", oldpath, newpath)
+
+    def stream_file_to_remote(self, fileobj, remotepath, checksums=None):
         """
         Reads from fileobj and streams it to a remote server over ssh.
+
+        The file is written to a temporary file alongside the remotepath, and
+        renamed over it once it's complete, so that a partially written file
+        is never visible, and any existing links to the remotepath are left
+        untouched.
+
+        If provided, the checksums are updated with the data as it's streamed.
         """
+        temporary = "%s.tmp-%s" % (remotepath, uuid.uuid4().hex)
         try:
-            fr = self.file(remotepath, "wb")
-            fr.set_pipelined(True)
-            size = 0
+            fr = self.file(temporary, "wb")
             try:
-                while True:
-                    data = fileobj.read(32768)
-                    if len(data) == 0:
-                        break
-                    fr.write(data)
-                    size += len(data)
-            finally:
-                fr.close()
+                fr.set_pipelined(True)
+                size = 0
+                try:
+                    while True:
+                        data = fileobj.read(32768)
+                        if len(data) == 0:
+                            break
+                        if checksums is not None:
+                            checksums.update(data)
+                        fr.write(data)
+                        size += len(data)
+                finally:
+                    fr.close()
+                s = self.stat(temporary)
+                if s.st_size != size:
+                    raise IOError(
+                        "size mismatch in put! %d != %d" % (s.st_size, size))
+                self.posix_rename(temporary, remotepath)
+            except Exception:
+                self.remove(temporary)
+                raise
         finally:
             fileobj.close()
-        s = self.stat(remotepath)
-        if s.st_size != size:
-            raise IOError("size mismatch in put! %d != %d" % (s.st_size, size))
-        return s.st_size
+        return size
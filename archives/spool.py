@@ -0,0 +1,65 @@
+import os
+import shutil
+import logging
+import tempfile
+
+from archives.models import Archive
+from jenkins.utils import DefaultSettings
+
+
+spool_settings = DefaultSettings({
+    # Artifacts which are copied to several archives are downloaded into a
+    # temporary directory here first, None uses the system default.
+    "ARCHIVE_SPOOL_DIR": None,
+})
+
+
+class SpooledArtifact(object):
+    """
+    A local copy of an artifact, downloaded from Jenkins once so that it can
+    be written to several archives.
+    """
+    def __init__(self, artifact):
+        self.artifact = artifact
+        self.directory = None
+        self.size = None
+        self.checksums = None
+
+    @property
+    def filename(self):
+        return os.path.join(self.directory, "artifact")
+
+    def download(self, checksums):
+        """
+        Downloads the artifact into a new directory in the ARCHIVE_SPOOL_DIR,
+        updating the checksums with it.
+        """
+        spool_dir = spool_settings.ARCHIVE_SPOOL_DIR
+        if spool_dir and not os.path.exists(spool_dir):
+            os.makedirs(spool_dir)
+        self.directory = tempfile.mkdtemp(prefix="artifact-", dir=spool_dir)
+        logging.info("  %s -> %s", self.artifact.url, self.filename)
+        # The spool is written like a local archive, so that failed downloads
+        # are resumed.
+        transport = Archive(
+            name="spool", transport="local",
+            basedir=self.directory).get_transport()
+        server = self.artifact.build.job.server
+        self.size = transport.archive_url(
+            self.artifact.url, "/artifact", username=server.username,
+            password=server.password, checksums=checksums)
+        self.checksums = checksums
+
+    def open(self):
+        """
+        Returns a file object for reading the downloaded artifact.
+        """
+        return open(self.filename, "rb")
+
+    def remove(self):
+        """
+        Removes the downloaded artifact from the spool.
+        """
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
@@ -1,12 +1,20 @@
+import sys
 import logging
+import threading
+from collections import OrderedDict
+from functools import wraps
 
-from django.utils import timezone
+from django.utils import six, timezone
 
-from celery import shared_task, chain
+from celery import shared_task, chain, chord
 
-from archives.helpers import get_default_archive
+from archives.checksums import Checksums, checksum_settings
+from archives.helpers import get_enabled_archives
 from archives.models import ArchiveArtifact
+from archives.spool import SpooledArtifact
 from jenkins.models import Build
+from projects.caching import bump_versions_for_job
+from projects.models import ProjectBuildDependency
 
 
 def link_to_current_if_required(projectbuild, item, transport):
@@ -24,7 +32,124 @@ def link_to_current_if_required(projectbuild, item, transport):
         transport.link_to_current(item.archived_path)
 
 
-@shared_task
+def get_existing_item(item):
+    """
+    Returns an archived item in the same archive with the content of the
+    artifact of the item, which the item can be linked to rather than copying
+    the artifact again, or None.
+
+    In content-addressed archives, this is an item which is linked to the
+    blob for the artifact, otherwise it's an item for the same artifact, or
+    one which matches the Jenkins fingerprint of the artifact.
+    """
+    archive = item.archive
+    return ((archive.content_addressed and
+             archive.get_blob_item(item.artifact)) or
+            archive.get_archived_item(item.artifact) or
+            archive.get_fingerprint_item(item.artifact))
+
+
+def link_existing_item(item, existing, transport):
+    """
+    Links the archived path of the item to the file of the existing item,
+    copying its size and checksums.
+    """
+    if existing.content_addressed:
+        logging.info(
+            "  %s is already stored as %s", item.artifact.url, existing.sha256)
+        transport.link_blob(existing.sha256, item.archived_path)
+    else:
+        logging.info(
+            "  %s is already archived as %s", item.artifact.url,
+            existing.archived_path)
+        transport.link_filename_to_filename(
+            existing.archived_path, item.archived_path)
+    item.archived_size = existing.archived_size
+    item.copy_checksums(existing)
+    item.content_addressed = existing.content_addressed
+
+
+def get_checksums(artifact):
+    """
+    Returns the Checksums to calculate as the artifact is copied from Jenkins.
+
+    The md5 of fingerprinted artifacts is kept so that later artifacts can be
+    matched against it.
+    """
+    return Checksums(
+        list(checksum_settings.ARCHIVE_CHECKSUMS) +
+        (["md5"] if artifact.fingerprint else []))
+
+
+def check_fingerprint(artifact, checksums):
+    """
+    Logs a warning if the artifact copied from Jenkins doesn't match the
+    fingerprint Jenkins recorded for it.
+    """
+    md5 = checksums.hexdigests().get("md5")
+    if artifact.fingerprint and artifact.fingerprint != md5:
+        logging.warning(
+            "  %s doesn't match the fingerprint %s", artifact.url,
+            artifact.fingerprint)
+
+
+def record_archived_file(item, checksums, transport):
+    """
+    Records the checksums of the file copied to the archived path of the
+    item, and stores it as a blob in content-addressed archives.
+    """
+    item.set_checksums(checksums)
+    if item.archive.content_addressed:
+        transport.store_blob(item.archived_path, item.sha256)
+    item.content_addressed = item.archive.content_addressed
+
+
+def transfer_artifact(item, transport):
+    """
+    Copies the artifact from Jenkins to the archived path of the item,
+    recording the size and checksums of the file on the item.
+
+    If the content of the artifact is already in the archive, see
+    get_existing_item, the archived path is linked to it rather than copying
+    it again.
+    """
+    artifact = item.artifact
+    existing = get_existing_item(item)
+    if existing:
+        link_existing_item(item, existing, transport)
+    else:
+        server = artifact.build.job.server
+        logging.info("  %s -> %s", artifact.url, item.archived_path)
+        checksums = get_checksums(artifact)
+        item.archived_size = transport.archive_url(
+            artifact.url, item.archived_path,
+            username=server.username, password=server.password,
+            checksums=checksums)
+        check_fingerprint(artifact, checksums)
+        record_archived_file(item, checksums, transport)
+
+
+def log_transfer_errors(func):
+    """
+    Decorates the tasks which transfer artifacts, so that errors are logged
+    and the task returns False rather than raising.
+
+    The transfers are the header of a chord, and celery doesn't call the
+    callback of a chord if any of the tasks in its header fail, so the
+    checksums wouldn't be generated for the artifacts that were archived.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            logging.exception("Error in %s%r", func.__name__, args)
+            return False
+    return wrapper
+
+
+@shared_task(ignore_result=False)
+@log_transfer_errors
 def archive_artifact_from_jenkins(archiveartifact_pk):
     """
     Schedule the transfer of the file in the artifact to the specified archive.
@@ -38,30 +163,37 @@ def archive_artifact_from_jenkins(archiveartifact_pk):
     projectbuild = (item.projectbuild_dependency and
                     item.projectbuild_dependency.projectbuild)
 
-    server = artifact.build.job.server
     transport.start()
-    logging.info("  %s -> %s", artifact.url, item.archived_path)
-    size = transport.archive_url(
-        item.artifact.url, item.archived_path,
-        username=server.username, password=server.password)
-
-    link_to_current_if_required(projectbuild, item, transport)
-
-    transport.end()
+    try:
+        transfer_artifact(item, transport)
+        link_to_current_if_required(projectbuild, item, transport)
+    finally:
+        transport.end()
     item.archived_at = timezone.now()
-    item.archived_size = size
     item.save()
+    item.update_manifest()
+    # The archived artifacts are displayed for the projects and dependencies.
+    bump_versions_for_job(artifact.build.job_id)
     logging.info("  archived at %s", item.archived_at)
+    return True
 
 
-@shared_task
+@shared_task(ignore_result=False)
+@log_transfer_errors
 def link_artifact_in_archive(source_pk, destination_pk):
     """
     This task uses the underlying transport to link the source archiveartifact
     to the destination archiveartifact without duplicating the file.
+
+    If the source wasn't archived, e.g. copying it from Jenkins failed, then
+    there's nothing to link to.
     """
     destination = ArchiveArtifact.objects.get(pk=destination_pk)
     source = ArchiveArtifact.objects.get(pk=source_pk)
+    if source.archived_at is None:
+        logging.warning(
+            "Not linking %s, %s wasn't archived", destination, source)
+        return False
 
     projectbuild = (destination.projectbuild_dependency and
                     destination.projectbuild_dependency.projectbuild)
@@ -69,19 +201,144 @@ def link_artifact_in_archive(source_pk, destination_pk):
 
     transport = source.archive.get_transport()
     transport.start()
-    logging.info("  %s -> %s", source.archived_path, destination.archived_path)
-
-    transport.link_filename_to_filename(
-        source.archived_path, destination.archived_path)
+    try:
+        logging.info(
+            "  %s -> %s", source.archived_path, destination.archived_path)
 
-    link_to_current_if_required(projectbuild, destination, transport)
+        transport.link_filename_to_filename(
+            source.archived_path, destination.archived_path)
 
-    transport.end()
+        link_to_current_if_required(projectbuild, destination, transport)
+    finally:
+        transport.end()
     destination.archived_at = timezone.now()
     destination.archived_size = source.archived_size
+    destination.copy_checksums(source)
+    destination.content_addressed = source.content_addressed
     destination.save()
     logging.info("  archived at %s", destination.archived_at)
     destination.save()
+    destination.update_manifest()
+    bump_versions_for_job(destination.artifact.build.job_id)
+    return True
+
+
+def write_spooled_artifact(item, existing, spool, projectbuild):
+    """
+    Writes the spooled artifact to the archived path of the item, or links it
+    to the existing item.
+
+    This doesn't use the database, so that the archives can be written in
+    parallel threads.
+    """
+    transport = item.archive.get_transport()
+    transport.start()
+    try:
+        if existing:
+            link_existing_item(item, existing, transport)
+        else:
+            logging.info(
+                "  %s -> %s in archive %s", spool.filename,
+                item.archived_path, item.archive)
+            with spool.open() as fileobj:
+                item.archived_size = transport.archive_file(
+                    fileobj, item.archived_path)
+            record_archived_file(item, spool.checksums, transport)
+        link_to_current_if_required(projectbuild, item, transport)
+    finally:
+        transport.end()
+
+
+@shared_task(ignore_result=False)
+@log_transfer_errors
+def archive_artifact_to_archives(archiveartifact_pks):
+    """
+    Archives an artifact in several archives, the artifact is downloaded from
+    Jenkins once into the spool, and then written to the archives in
+    parallel.
+
+    Each item is marked as archived once it's written to its archive, if
+    writing to any of the archives fails, the first error is raised after the
+    others have been written, see log_transfer_errors.
+    """
+    items = list(ArchiveArtifact.objects.filter(
+        pk__in=archiveartifact_pks).select_related(
+        "archive__ssh_credentials", "artifact__build__job__server",
+        "projectbuild_dependency__projectbuild"))
+    artifact = items[0].artifact
+    logging.info(
+        "Archiving %s in archives %s", artifact,
+        ", ".join(item.archive.name for item in items))
+
+    existing = dict((item.pk, get_existing_item(item)) for item in items)
+    errors = {}
+
+    def write(item):
+        projectbuild = (item.projectbuild_dependency and
+                        item.projectbuild_dependency.projectbuild)
+        try:
+            write_spooled_artifact(
+                item, existing[item.pk], spool, projectbuild)
+        except Exception:
+            logging.exception("Error archiving %s in %s", item, item.archive)
+            errors[item.pk] = sys.exc_info()
+
+    spool = SpooledArtifact(artifact)
+    try:
+        if not all(existing.values()):
+            spool.download(get_checksums(artifact))
+            check_fingerprint(artifact, spool.checksums)
+        threads = [threading.Thread(target=write, args=(item,))
+                   for item in items]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        spool.remove()
+
+    for item in items:
+        if item.pk in errors:
+            continue
+        item.archived_at = timezone.now()
+        item.save()
+        item.update_manifest()
+        logging.info("  archived in %s at %s", item.archive, item.archived_at)
+    # The archived artifacts are displayed for the projects and dependencies.
+    bump_versions_for_job(artifact.build.job_id)
+    for item in items:
+        if item.pk in errors:
+            six.reraise(*errors[item.pk])
+    return True
+
+
+def get_transfer_chains(items):
+    """
+    Returns a list of chains which archive the items, a dictionary mapping
+    artifacts to the ArchiveArtifacts to archive them as.
+
+    There's a chain for each artifact, which copies it from Jenkins once, to
+    the first of its items in each archive, and then links it to the rest of
+    its items in that archive, so that failing to archive one artifact doesn't
+    stop the others from being archived.
+    """
+    chains = []
+    for artifact, files in items.items():
+        archives = OrderedDict()
+        for item in files:
+            archives.setdefault(item.archive_id, []).append(item)
+        firsts = [x[0] for x in archives.values()]
+        if len(firsts) == 1:
+            tasks = [archive_artifact_from_jenkins.si(firsts[0].pk)]
+        else:
+            tasks = [archive_artifact_to_archives.si(
+                [item.pk for item in firsts])]
+        for first, rest in [(x[0], x[1:]) for x in archives.values()]:
+            tasks.extend(
+                link_artifact_in_archive.si(first.pk, item.pk)
+                for item in rest)
+        chains.append(chain(*tasks))
+    return chains
 
 
 # TODO Workout some sort of decorator so these functions don't have to return
@@ -91,42 +348,106 @@ def process_build_artifacts(build_pk):
     """
     This task should be triggered after we've imported the artifacts from
     Jenkins for a build.
+
+    The artifacts are archived in the default archive, and the archives which
+    builds are replicated to, by subtasks. When they've all finished the
+    build is marked as archived, if they all succeeded, and the checksums are
+    generated for the artifacts that were archived.
     """
     build = Build.objects.get(pk=build_pk)
     logging.info(
         "Processing build artifacts from build %s %d", build, build.number)
-    archive = get_default_archive()
-    if archive:
-        items = archive.add_build(build)
+    archives = get_enabled_archives()
+    if archives:
+        items = OrderedDict()
+        for archive in archives:
+            for artifact, files in archive.add_build(build).items():
+                items.setdefault(artifact, []).extend(files)
         logging.info("Archiving %s", items)
-        for artifact, files in items.items():
-            first, rest = files[0], files[1:]
-            chain(
-                archive_artifact_from_jenkins.si(first.pk),
-                *[link_artifact_in_archive.si(first.pk, item.pk) for item in
-                  rest]).apply()
+        callback = chain(
+            mark_build_archived.si(build_pk), generate_checksums.si(build_pk))
+        transfers = get_transfer_chains(items)
+        if transfers:
+            chord(transfers)(callback)
+        else:
+            callback.apply_async()
     else:
         logging.info("No default archiver - build not automatically archived.")
     return build_pk
 
 
+@shared_task
+def archive_projectbuild_dependencies(projectbuild_dependency_pks):
+    """
+    Archives the builds of ProjectBuildDependencies which were built before
+    their ProjectBuild was requested, e.g. reused builds, so that they're
+    archived with the rest of the ProjectBuild.
+
+    The artifacts are usually already archived, and are linked rather than
+    copied again.
+    """
+    archives = get_enabled_archives()
+    if not archives:
+        logging.info(
+            "No default archiver - builds not automatically archived.")
+        return
+    dependencies = ProjectBuildDependency.objects.filter(
+        pk__in=projectbuild_dependency_pks,
+        build__isnull=False).select_related("build", "dependency")
+    items = OrderedDict()
+    for archive in archives:
+        for dependency in dependencies:
+            for artifact, files in archive.add_projectbuild_dependency(
+                    dependency).items():
+                items.setdefault(artifact, []).extend(files)
+    build_pks = sorted(set(x.build_id for x in dependencies))
+    callback = chain(*[generate_checksums.si(x) for x in build_pks])
+    transfers = get_transfer_chains(items)
+    if transfers:
+        chord(transfers)(callback)
+    elif build_pks:
+        callback.apply_async()
+
+
+@shared_task
+def mark_build_archived(build_pk):
+    """
+    Records that all the artifacts of the build have been archived, if any of
+    them weren't archived in the enabled archives, then the build isn't
+    marked.
+    """
+    unarchived = ArchiveArtifact.objects.filter(
+        artifact__build=build_pk, archive__in=get_enabled_archives(),
+        archived_at__isnull=True)
+    if unarchived.exists():
+        logging.warning(
+            "Not all the artifacts of build %d were archived", build_pk)
+    else:
+        Build.objects.filter(pk=build_pk).update(archived_at=timezone.now())
+    return build_pk
+
+
 @shared_task
 def generate_checksums(build_pk):
     """
-    This task should ask the archive transport to generate checksum files
-    for each project build the specified build has caused.
+    This task should ask the archive transports to generate checksum files
+    for each project build the specified build has caused, for the artifacts
+    that were archived.
     """
     build = Build.objects.get(pk=build_pk)
-    archive = get_default_archive()
-    if not archive:
+    archives = get_enabled_archives()
+    if not archives:
         logging.info("No default archiver - no checksum to generate")
         return build_pk
-    transport = archive.get_transport()
-    archived_artifacts = archive.get_archived_artifacts_for_build(build)
-    transport.start()
-    for artifact in archived_artifacts:
-        if artifact.projectbuild_dependency:
-            logging.info("Generating checksums for %s" % artifact)
-            transport.generate_checksums(artifact)
-    transport.end()
+    for archive in archives:
+        transport = archive.get_transport()
+        archived_artifacts = archive.get_archived_artifacts_for_build(
+            build).filter(
+            projectbuild_dependency__isnull=False, archived_at__isnull=False)
+        transport.start()
+        try:
+            logging.info("Generating checksums for %s" % build)
+            transport.generate_checksums(archived_artifacts)
+        finally:
+            transport.end()
     return build_pk
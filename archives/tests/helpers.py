@@ -0,0 +1,96 @@
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from io import StringIO
+import re
+import threading
+import time
+
+
+class FakeResponse(StringIO):
+    """
+    Stands in for the response from urllib2.urlopen.
+    """
+    def __init__(self, content, code=200):
+        super(FakeResponse, self).__init__(content)
+        self.code = code
+        self.headers = {"Content-Length": str(len(content))}
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.code
+
+
+def fake_response(content):
+    """
+    Returns a function which returns a new FakeResponse for the content each
+    time it's called, for use as the side_effect of urlopen.
+    """
+    return lambda *args, **kwargs: FakeResponse(content)
+
+
+class ArtifactRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        server.ranges.append(self.headers.get("Range"))
+        start = 0
+        match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+        if match and server.supports_ranges:
+            start = int(match.group(1))
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", "bytes %d-%d/%d" % (
+                    start, len(server.content) - 1, len(server.content)))
+        else:
+            self.send_response(200)
+        body = server.content[start:]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        if server.failures:
+            server.failures -= 1
+            if server.stall:
+                time.sleep(server.stall)
+            # Drop the connection part way through the body.
+            self.wfile.write(body[:server.drop_after])
+            self.close_connection = 1
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves content at any path, dropping the connection after drop_after
+    bytes of the body for the first failures requests.
+
+    The Range header of each request is recorded in ranges.
+    """
+    daemon_threads = True
+
+    def __init__(self, content, failures=0, drop_after=0,
+                 supports_ranges=True, stall=0):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), ArtifactRequestHandler)
+        self.content = content
+        self.failures = failures
+        self.drop_after = drop_after
+        self.supports_ranges = supports_ranges
+        self.stall = stall
+        self.ranges = []
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/artifact.img" % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,173 @@
+"""
+An in-process ssh server for testing SshTransport.
+
+Commands are run in a local shell and SFTP reads and writes local files, so
+an archive with a basedir in a temporary directory behaves like a remote one.
+"""
+from StringIO import StringIO
+import os
+import socket
+import subprocess
+import threading
+
+import paramiko
+from paramiko.sftp import CMD_EXTENDED
+
+from credentials.tests.factories import private_key
+
+
+class StubServer(paramiko.ServerInterface):
+
+    def __init__(self, username, key):
+        self.username = username
+        self.key = key
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        if username == self.username and key == self.key:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(
+            target=self.run_command, args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def run_command(self, channel, command):
+        process = subprocess.Popen(
+            command, shell=True, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        channel.sendall(stdout)
+        channel.sendall_stderr(stderr)
+        channel.send_exit_status(process.returncode)
+        channel.close()
+
+
+class StubSFTPHandle(paramiko.SFTPHandle):
+
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(
+            os.fstat(self.readfile.fileno()))
+
+
+class StubSFTPServer(paramiko.SFTPServerInterface):
+    """
+    Only supports what SFTPClient.stream_file_to_remote and makedirs need.
+    """
+
+    def open(self, path, flags, attr):
+        fd = os.open(path, flags, 0o666)
+        handle = StubSFTPHandle(flags)
+        handle.filename = path
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(path)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        try:
+            os.rename(oldpath, newpath)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+class StubSFTPSubsystem(paramiko.SFTPServer):
+    """
+    Adds the posix-rename@openssh.com extension that OpenSSH provides.
+    """
+
+    def _process(self, t, request_number, msg):
+        if t == CMD_EXTENDED:
+            position = msg.packet.tell()
+            if msg.get_text() == "posix-rename@openssh.com":
+                oldpath, newpath = msg.get_text(), msg.get_text()
+                self._send_status(
+                    request_number,
+                    self.server.posix_rename(oldpath, newpath))
+                return
+            msg.packet.seek(position)
+        super(StubSFTPSubsystem, self)._process(t, request_number, msg)
+
+
+class SshServer(object):
+    """
+    Accepts ssh connections on a local port for the user with the test
+    SshKeyPair.
+    """
+
+    def __init__(self, username, key):
+        self.username = username
+        self.key = key
+        self.host_key = paramiko.RSAKey(file_obj=StringIO(private_key))
+        self.transports = []
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("127.0.0.1", 0))
+        self.port = self.socket.getsockname()[1]
+
+    def start(self):
+        self.socket.listen(5)
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+
+    def accept(self):
+        while True:
+            try:
+                client, _ = self.socket.accept()
+            except socket.error:
+                return
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler(
+                "sftp", StubSFTPSubsystem, StubSFTPServer)
+            transport.start_server(server=StubServer(self.username, self.key))
+            self.transports.append(transport)
+
+    def disconnect_all(self):
+        """
+        Closes the connections that clients have open.
+        """
+        for transport in self.transports:
+            transport.close()
+
+    def stop(self):
+        self.disconnect_all()
+        self.socket.close()
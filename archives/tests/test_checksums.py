@@ -0,0 +1,43 @@
+from __future__ import unicode_literals
+import hashlib
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from archives.checksums import Checksums
+
+
+class ChecksumsTest(TestCase):
+
+    def test_checksums(self):
+        """
+        Checksums calculates the sha256 of the data it's updated with.
+        """
+        checksums = Checksums()
+        checksums.update(b"This is ")
+        checksums.update(b"the artifact")
+
+        self.assertEqual(
+            {"sha256": hashlib.sha256(b"This is the artifact").hexdigest()},
+            checksums.hexdigests())
+
+    @override_settings(ARCHIVE_CHECKSUMS=["md5", "sha1"])
+    def test_checksums_from_settings(self):
+        """
+        The ARCHIVE_CHECKSUMS are calculated as well as the sha256.
+        """
+        checksums = Checksums()
+        checksums.update(b"This is the artifact")
+
+        self.assertEqual(
+            {"sha256": hashlib.sha256(b"This is the artifact").hexdigest(),
+             "sha1": hashlib.sha1(b"This is the artifact").hexdigest(),
+             "md5": hashlib.md5(b"This is the artifact").hexdigest()},
+            checksums.hexdigests())
+
+    def test_checksums_with_unknown_algorithm(self):
+        """
+        Only the checksums which can be stored may be calculated.
+        """
+        with self.assertRaises(ValueError):
+            Checksums(["sha512"])
@@ -3,7 +3,7 @@ from __future__ import unicode_literals
 from django.test import TestCase
 
 from .factories import ArchiveFactory
-from archives.helpers import get_default_archive
+from archives.helpers import get_default_archive, get_enabled_archives
 
 
 class GetDefaultArchiveTest(TestCase):
@@ -16,3 +16,19 @@ class GetDefaultArchiveTest(TestCase):
 
         default = ArchiveFactory.create(name="default", default=True)
         self.assertEqual(default, get_default_archive())
+
+
+class GetEnabledArchivesTest(TestCase):
+
+    def test_get_enabled_archives(self):
+        """
+        Return the default archive followed by the archives builds are
+        replicated to, if there's a default archive.
+        """
+        replica = ArchiveFactory.create(name="replica", replicate=True)
+        ArchiveFactory.create(name="other")
+        self.assertEqual([], get_enabled_archives())
+
+        default = ArchiveFactory.create(
+            name="default", default=True, replicate=True)
+        self.assertEqual([default, replica], get_enabled_archives())
@@ -0,0 +1,259 @@
+from __future__ import unicode_literals
+
+import hashlib
+import os
+import shutil
+import tempfile
+from io import StringIO
+
+from django.test import TestCase
+from django.test.utils import override_settings
+import mock
+from paramiko import SSHClient
+
+from archives.checksums import Checksums
+from archives.pool import SshConnectionPool, PoolTimeout, ssh_pool
+from archives.transports import SshTransport
+from .factories import ArchiveFactory
+from .sshserver import SshServer
+
+
+class SshConnectionPoolTest(TestCase):
+
+    def setUp(self):
+        self.pool = SshConnectionPool()
+        self.connect = mock.Mock(
+            side_effect=lambda: (mock.Mock(), mock.Mock()))
+
+    def test_acquire_reuses_released_connections(self):
+        """
+        A released connection is reused for the same key, connections aren't
+        shared between keys.
+        """
+        connection = self.pool.acquire("archive1", self.connect)
+        self.pool.release("archive1", connection)
+
+        self.assertIs(connection, self.pool.acquire("archive1", self.connect))
+        self.assertIsNot(
+            connection, self.pool.acquire("archive2", self.connect))
+        self.assertEqual(2, self.connect.call_count)
+
+    def test_acquire_replaces_broken_connections(self):
+        """
+        A connection which fails the health check is closed and replaced.
+        """
+        connection = self.pool.acquire("archive1", self.connect)
+        self.pool.release("archive1", connection)
+        connection.ssh_client.get_transport.return_value.is_active.\
+            return_value = False
+
+        new_connection = self.pool.acquire("archive1", self.connect)
+
+        self.assertIsNot(connection, new_connection)
+        connection.ssh_client.close.assert_called_once_with()
+
+    def test_release_with_discard(self):
+        """
+        Discarded connections are closed rather than reused.
+        """
+        connection = self.pool.acquire("archive1", self.connect)
+        self.pool.release("archive1", connection, discard=True)
+
+        self.assertIsNot(
+            connection, self.pool.acquire("archive1", self.connect))
+        connection.ssh_client.close.assert_called_once_with()
+
+    @override_settings(ARCHIVE_SSH_POOL_IDLE_TIMEOUT=60)
+    def test_idle_connections_expire(self):
+        """
+        Connections which have been idle for longer than the
+        ARCHIVE_SSH_POOL_IDLE_TIMEOUT are closed.
+        """
+        connection = self.pool.acquire("archive1", self.connect)
+        self.pool.release("archive1", connection)
+        connection.last_used -= 61
+
+        self.assertIsNot(
+            connection, self.pool.acquire("archive1", self.connect))
+        connection.ssh_client.close.assert_called_once_with()
+
+    @override_settings(
+        ARCHIVE_SSH_POOL_MAX_SESSIONS=2, ARCHIVE_SSH_POOL_ACQUIRE_TIMEOUT=0)
+    def test_max_sessions(self):
+        """
+        No more than ARCHIVE_SSH_POOL_MAX_SESSIONS connections are used for a
+        key at once.
+        """
+        connection = self.pool.acquire("archive1", self.connect)
+        self.pool.acquire("archive1", self.connect)
+
+        with self.assertRaises(PoolTimeout):
+            self.pool.acquire("archive1", self.connect)
+        self.pool.acquire("archive2", self.connect)
+
+        self.pool.release("archive1", connection)
+        self.assertIs(connection, self.pool.acquire("archive1", self.connect))
+
+    @override_settings(
+        ARCHIVE_SSH_POOL_MAX_SESSIONS=1, ARCHIVE_SSH_POOL_ACQUIRE_TIMEOUT=0)
+    def test_failed_connect_releases_session(self):
+        """
+        If connecting fails, the session can be used by another connection.
+        """
+        self.connect.side_effect = IOError("Connection refused")
+        with self.assertRaises(IOError):
+            self.pool.acquire("archive1", self.connect)
+
+        self.connect.side_effect = lambda: (mock.Mock(), mock.Mock())
+        self.pool.acquire("archive1", self.connect)
+
+    def test_connections_are_not_shared_after_fork(self):
+        """
+        A forked worker doesn't use the connections of its parent.
+        """
+        connection = self.pool.acquire("archive1", self.connect)
+        self.pool.release("archive1", connection)
+
+        with mock.patch("archives.pool.os.getpid", return_value=-1):
+            self.assertIsNot(
+                connection, self.pool.acquire("archive1", self.connect))
+        self.assertFalse(connection.ssh_client.close.called)
+
+
+class SshTransportPoolTest(TestCase):
+
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        self.archive = ArchiveFactory.create(
+            transport="ssh", host="127.0.0.1", basedir=self.basedir)
+        self.server = SshServer(
+            self.archive.username, self.archive.ssh_credentials.get_pkey())
+        self.server.start()
+        connect = SSHClient.connect
+        patcher = mock.patch.object(
+            SSHClient, "connect", autospec=True,
+            side_effect=lambda client, host, **kwargs: connect(
+                client, host, port=self.server.port, **kwargs))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(ssh_pool.close_all)
+        self.addCleanup(self.server.stop)
+        self.addCleanup(shutil.rmtree, self.basedir)
+
+    def archive_file(self, content, filename):
+        transport = SshTransport(self.archive)
+        transport.start()
+        try:
+            checksums = Checksums()
+            size = transport.archive_file(
+                StringIO(content), filename, checksums=checksums)
+        finally:
+            transport.end()
+        return size, checksums
+
+    def test_archive_file(self):
+        """
+        SshTransport archives files over the ssh connection.
+        """
+        size, checksums = self.archive_file(
+            "This is the artifact", "/temp/temp.gz")
+
+        self.assertEqual(20, size)
+        filename = os.path.join(self.basedir, "temp/temp.gz")
+        self.assertEqual("This is the artifact", open(filename).read())
+        self.assertEqual(
+            hashlib.sha256(b"This is the artifact").hexdigest(),
+            checksums.hexdigests()["sha256"])
+
+    def test_archive_file_replaces_links(self):
+        """
+        Archiving over an existing file replaces it, rather than writing
+        through to the other links to the file.
+        """
+        os.mkdir(os.path.join(self.basedir, "temp"))
+        filename = os.path.join(self.basedir, "temp/temp.gz")
+        linked = os.path.join(self.basedir, "temp/linked.gz")
+        with open(filename, "w") as f:
+            f.write("The original artifact")
+        os.link(filename, linked)
+
+        self.archive_file("This is the artifact", "/temp/temp.gz")
+
+        self.assertEqual("This is the artifact", open(filename).read())
+        self.assertEqual("The original artifact", open(linked).read())
+        self.assertEqual(["linked.gz", "temp.gz"], sorted(
+            os.listdir(os.path.join(self.basedir, "temp"))))
+
+    def test_connection_is_reused(self):
+        """
+        Transports for the same archive share a single connection.
+        """
+        for index in range(3):
+            self.archive_file("Artifact %d" % index, "/temp%d/temp.gz" % index)
+
+        self.assertEqual(1, len(self.server.transports))
+        for index in range(3):
+            filename = os.path.join(self.basedir, "temp%d/temp.gz" % index)
+            self.assertEqual("Artifact %d" % index, open(filename).read())
+
+    def test_reconnects_after_disconnect(self):
+        """
+        If the server closes the connection, the next transport reconnects.
+        """
+        self.archive_file("Artifact 1", "/temp1/temp.gz")
+        self.server.disconnect_all()
+
+        self.archive_file("Artifact 2", "/temp2/temp.gz")
+
+        self.assertEqual(2, len(self.server.transports))
+        filename = os.path.join(self.basedir, "temp2/temp.gz")
+        self.assertEqual("Artifact 2", open(filename).read())
+
+    def test_directories_are_remembered_for_connection(self):
+        """
+        The directories created for archived files are remembered for the
+        connection, so that archiving more files in them with the same
+        connection doesn't check for them again.
+        """
+        for filename in ("/builds/1/file1.gz", "/builds/2/file2.gz"):
+            self.archive_file("This is the artifact", filename)
+
+        transport = SshTransport(self.archive)
+        transport.start()
+        try:
+            with mock.patch.object(
+                    transport.sftp_client, "mkdir") as mock_mkdir:
+                for filename in ("/builds/1/file1.gz", "/builds/2/file1.gz"):
+                    transport.archive_file(
+                        StringIO("This is the artifact"), filename)
+        finally:
+            transport.end()
+
+        self.assertFalse(mock_mkdir.called)
+        self.assertTrue(set([
+            os.path.join(self.basedir, "builds/1"),
+            os.path.join(self.basedir, "builds/2")]).issubset(
+            transport.sftp_client.directories))
+        for filename in ("builds/1/file1.gz", "builds/2/file1.gz"):
+            self.assertEqual(
+                "This is the artifact",
+                open(os.path.join(self.basedir, filename)).read())
+
+    def test_failed_connection_is_discarded(self):
+        """
+        If an operation on the connection fails, the connection isn't
+        reused.
+        """
+        transport = SshTransport(self.archive)
+        transport.start()
+        with mock.patch.object(
+                transport.sftp_client, "stream_file_to_remote",
+                side_effect=IOError("size mismatch")):
+            with self.assertRaises(IOError):
+                transport.archive_file(
+                    StringIO("This is the artifact"), "/temp/temp.gz")
+        transport.end()
+
+        self.archive_file("This is the artifact", "/temp/temp.gz")
+
+        self.assertEqual(2, len(self.server.transports))
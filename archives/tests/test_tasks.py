@@ -1,6 +1,7 @@
 from __future__ import unicode_literals
 
 from io import StringIO
+import hashlib
 import logging
 import os
 import shutil
@@ -8,12 +9,14 @@ import tempfile
 
 from django.test import TestCase
 from django.test.utils import override_settings
+from django.utils import timezone
 
 import mock
 
 from archives.tasks import (
     archive_artifact_from_jenkins, process_build_artifacts,
-    link_artifact_in_archive, generate_checksums)
+    link_artifact_in_archive, generate_checksums, get_transfer_chains,
+    archive_artifact_to_archives, archive_projectbuild_dependencies)
 from archives.models import Archive, ArchiveArtifact
 from archives.transports import Transport, LocalTransport
 from jenkins.tests.factories import ArtifactFactory, BuildFactory
@@ -23,6 +26,7 @@ from projects.tasks import process_build_dependencies
 from projects.models import ProjectDependency, ProjectBuildDependency
 from projects.tests.factories import DependencyFactory, ProjectFactory
 from .factories import ArchiveFactory
+from .helpers import FakeResponse, fake_response
 
 
 class LoggingTransport(Transport):
@@ -40,13 +44,14 @@ class LoggingTransport(Transport):
     def end(self):
         self.log.append("END")
 
-    def archive_url(self, url, path, username, password):
+    def archive_url(self, url, path, username, password, checksums=None):
         self.log.append("%s -> %s %s:%s" % (url, path, username, password))
         return 0
 
-    def generate_checksums(self, archived_artifact):
-        self.log.append(
-            "Checksums generated for %s" % archived_artifact)
+    def generate_checksums(self, archived_artifacts):
+        for archived_artifact in archived_artifacts:
+            self.log.append(
+                "Checksums generated for %s" % archived_artifact)
 
     def link_to_current(self, path):
         self.log.append(
@@ -83,7 +88,7 @@ class ArchiveArtifactFromJenkinsTaskTest(LocalArchiveTestBase):
 
         items = archive.add_build(artifact.build)
 
-        fakefile = StringIO(u"Artifact from Jenkins")
+        fakefile = FakeResponse(u"Artifact from Jenkins")
         with mock.patch("archives.transports.urllib2") as urllib2_mock:
             urllib2_mock.urlopen.return_value = fakefile
             archive_artifact_from_jenkins(items[artifact][0].pk)
@@ -93,6 +98,8 @@ class ArchiveArtifactFromJenkinsTaskTest(LocalArchiveTestBase):
         filename = os.path.join(self.basedir, item.archived_path)
         self.assertEqual(file(filename).read(), "Artifact from Jenkins")
         self.assertEqual(21, item.archived_size)
+        self.assertEqual(
+            hashlib.sha256(b"Artifact from Jenkins").hexdigest(), item.sha256)
 
     def test_archive_artifact_from_finalized_dependency_build(self):
         """
@@ -159,6 +166,77 @@ class ArchiveArtifactFromJenkinsTaskTest(LocalArchiveTestBase):
              "END"],
             transport.log)
 
+    def test_archive_artifact_updates_projectbuild_manifest(self):
+        """
+        archive_artifact_from_jenkins should record the archived URL, size and
+        checksum in the manifest of the ProjectBuild.
+        """
+        project = ProjectFactory.create()
+        dependency = DependencyFactory.create()
+        ProjectDependency.objects.create(
+            project=project, dependency=dependency)
+        projectbuild = build_project(project, queue_build=False)
+        build = BuildFactory.create(
+            job=dependency.job, build_id=projectbuild.build_key,
+            phase=Build.FINALIZED)
+        artifact = ArtifactFactory.create(
+            build=build, filename="testing/testing.txt")
+        process_build_dependencies(build.pk)
+
+        archive = ArchiveFactory.create(
+            transport="local", basedir=self.basedir, default=True)
+        item = [x for x in archive.add_build(artifact.build)[artifact]
+                if x.projectbuild_dependency][0]
+        entry = projectbuild.manifest.get()
+        self.assertEqual(item.get_url(), entry.archive_url)
+        self.assertIsNone(entry.size)
+
+        fakefile = FakeResponse(u"Artifact from Jenkins")
+        with mock.patch("archives.transports.urllib2") as urllib2_mock:
+            urllib2_mock.urlopen.return_value = fakefile
+            archive_artifact_from_jenkins(item.pk)
+
+        entry = projectbuild.manifest.get()
+        self.assertEqual(item.get_url(), entry.archive_url)
+        self.assertEqual(21, entry.size)
+        self.assertEqual(
+            hashlib.sha256(b"Artifact from Jenkins").hexdigest(),
+            entry.checksum)
+
+    def test_archive_artifact_adds_missing_manifest_entry(self):
+        """
+        If the manifest of the ProjectBuild doesn't have an entry for the
+        archived artifact, it's added.
+        """
+        project = ProjectFactory.create()
+        dependency = DependencyFactory.create()
+        ProjectDependency.objects.create(
+            project=project, dependency=dependency)
+        projectbuild = build_project(project, queue_build=False)
+        build = BuildFactory.create(
+            job=dependency.job, build_id=projectbuild.build_key,
+            phase=Build.FINALIZED)
+        process_build_dependencies(build.pk)
+        # The artifact is recorded after the manifest was written.
+        artifact = ArtifactFactory.create(
+            build=build, filename="testing/testing.txt")
+        self.assertEqual(0, projectbuild.manifest.count())
+
+        archive = ArchiveFactory.create(
+            transport="local", basedir=self.basedir, default=True)
+        item = [x for x in archive.add_build(artifact.build)[artifact]
+                if x.projectbuild_dependency][0]
+        with mock.patch("archives.transports.urllib2") as urllib2_mock:
+            urllib2_mock.urlopen.side_effect = fake_response(
+                u"Artifact from Jenkins")
+            archive_artifact_from_jenkins(item.pk)
+
+        entry = projectbuild.manifest.get()
+        self.assertEqual(
+            (artifact, build, "testing/testing.txt", item.get_url(), 21),
+            (entry.artifact, entry.build, entry.filename, entry.archive_url,
+             entry.size))
+
     def test_archive_artifact_from_non_finalized_projectbuild(self):
         """
         If the build is complete, and the item being archived is in a FINALIZED
@@ -233,6 +311,33 @@ class ArchiveArtifactFromJenkinsTaskTest(LocalArchiveTestBase):
             transport.log)
         self.assertIsNotNone(item.archived_at)
 
+    def test_archive_artifact_from_jenkins_ends_transport_on_failure(self):
+        """
+        If archiving fails, the transport is still ended so that its
+        connection is released, and the error is logged rather than raised.
+        """
+        archive = ArchiveFactory.create(
+            transport="local", basedir=self.basedir)
+        dependency = DependencyFactory.create()
+        build = BuildFactory.create(job=dependency.job)
+        artifact = ArtifactFactory.create(
+            build=build, filename="testing/testing.txt")
+        [item] = archive.add_build(artifact.build)[artifact]
+
+        transport = LoggingTransport(archive)
+        with mock.patch.object(
+                Archive, "get_transport", return_value=transport):
+            with mock.patch.object(
+                    transport, "archive_url", side_effect=IOError):
+                with mock.patch("archives.tasks.logging") as mock_logging:
+                    result = archive_artifact_from_jenkins(item.pk)
+
+        self.assertFalse(result)
+        self.assertTrue(mock_logging.exception.called)
+        self.assertEqual(["START", "END"], transport.log)
+        item = ArchiveArtifact.objects.get(pk=item.pk)
+        self.assertIsNone(item.archived_at)
+
 
 class GenerateChecksumsTaskTest(TestCase):
 
@@ -265,6 +370,12 @@ class GenerateChecksumsTaskTest(TestCase):
         archived_artifact = ArchiveArtifact.objects.create(
             build=build, archive=archive, artifact=artifact,
             archived_path="/srv/builds/200101.01/artifact_filename",
+            projectbuild_dependency=projectbuild_dependency,
+            archived_at=timezone.now())
+        # Artifacts that weren't archived don't have checksums.
+        ArchiveArtifact.objects.create(
+            build=build, archive=archive, artifact=artifact,
+            archived_path="/srv/builds/200101.01/unarchived_filename",
             projectbuild_dependency=projectbuild_dependency)
 
         transport = LoggingTransport(archive)
@@ -342,7 +453,7 @@ class ProcessBuildArtifactsTaskTest(TestCase):
             transport="local", basedir=self.basedir, default=True,
             policy="cdimage")
         with mock.patch("archives.transports.urllib2") as urllib2_mock:
-            urllib2_mock.urlopen.side_effect = lambda x: StringIO(
+            urllib2_mock.urlopen.side_effect = fake_response(
                 u"Artifact from Jenkins")
             process_build_artifacts(build.pk)
 
@@ -391,11 +502,7 @@ class ProcessBuildArtifactsTaskTest(TestCase):
             [],
             list(archive.get_archived_artifacts_for_build(build)))
 
-    @override_settings(CELERY_ALWAYS_EAGER=True)
-    def test_process_build_artifacts_with_multiple_artifacts(self):
-        """
-        All the artifacts should be individually linked.
-        """
+    def create_build_with_artifacts(self, count):
         project = ProjectFactory.create()
         dependency = DependencyFactory.create()
         ProjectDependency.objects.create(
@@ -405,38 +512,612 @@ class ProcessBuildArtifactsTaskTest(TestCase):
 
         build = BuildFactory.create(
             job=dependency.job, build_id=projectbuild.build_key)
-        ArtifactFactory.create(
-            build=build, filename="testing/testing1.txt")
-        ArtifactFactory.create(
-            build=build, filename="testing/testing2.txt")
+        for index in range(count):
+            ArtifactFactory.create(
+                build=build, filename="testing/testing%d.txt" % index)
         # We need to ensure that the artifacts are all connected up.
         process_build_dependencies(build.pk)
+        return build
 
+    @override_settings(CELERY_ALWAYS_EAGER=True)
+    def test_process_build_artifacts_with_multiple_artifacts(self):
+        """
+        All the artifacts should be individually linked, and the build is
+        marked as archived and the checksums generated once they're all
+        archived.
+        """
+        build = self.create_build_with_artifacts(2)
         archive = ArchiveFactory.create(
             transport="local", basedir=self.basedir, default=True,
             policy="cdimage")
 
         with mock.patch("archives.transports.urllib2") as urllib2_mock:
-            urllib2_mock.urlopen.side_effect = lambda x: StringIO(
-                u"Artifact %s")
-            with mock.patch(
-                    "archives.tasks.archive_artifact_from_jenkins"
-                    ) as archive_task:
-                with mock.patch(
-                        "archives.tasks.link_artifact_in_archive"
-                        ) as link_task:
-                    process_build_artifacts(build.pk)
-
-        [item1, item2, item3, item4] = list(
-            archive.get_archived_artifacts_for_build(build).order_by(
-                "artifact"))
+            urllib2_mock.urlopen.side_effect = fake_response(
+                u"Artifact from Jenkins")
+            process_build_artifacts(build.pk)
 
+        items = list(archive.get_archived_artifacts_for_build(build))
+        self.assertEqual(4, len(items))
+        for item in items:
+            self.assertIsNotNone(item.archived_at)
+            filename = os.path.join(self.basedir, item.archived_path)
+            self.assertEqual(file(filename).read(), "Artifact from Jenkins")
+        build = Build.objects.get(pk=build.pk)
+        self.assertIsNotNone(build.archived_at)
+        for item in items:
+            if item.projectbuild_dependency:
+                checksums_filename = os.path.join(
+                    self.basedir, os.path.dirname(
+                        item.archived_path.lstrip("/")), "SHA256SUMS")
+                self.assertTrue(os.path.exists(checksums_filename))
+
+    def test_get_transfer_chains(self):
+        """
+        Each artifact is archived once and then linked to its other items, in
+        a chain of its own.
+        """
+        build = self.create_build_with_artifacts(2)
+        archive = ArchiveFactory.create(
+            transport="local", basedir=self.basedir, default=True,
+            policy="cdimage")
+        items = archive.add_build(build)
+        [files1, files2] = items.values()
+
+        transfers = get_transfer_chains(items)
+
+        self.assertEqual(
+            [[("archives.tasks.archive_artifact_from_jenkins",
+               (files1[0].pk,)),
+              ("archives.tasks.link_artifact_in_archive",
+               (files1[0].pk, files1[1].pk))],
+             [("archives.tasks.archive_artifact_from_jenkins",
+               (files2[0].pk,)),
+              ("archives.tasks.link_artifact_in_archive",
+               (files2[0].pk, files2[1].pk))]],
+            [[(x.task, tuple(x.args)) for x in transfer.tasks]
+             for transfer in transfers])
+        self.assertTrue(
+            all(x.immutable for transfer in transfers
+                for x in transfer.tasks))
+
+    @override_settings(ARCHIVE_DOWNLOAD_RETRIES=0, CELERY_ALWAYS_EAGER=True)
+    def test_process_build_artifacts_with_failed_artifact(self):
+        """
+        Each artifact is archived by a chain of its own, so if archiving one
+        of them fails, the others are still archived and their checksums are
+        generated, but the build isn't marked as archived.
+        """
+        build = self.create_build_with_artifacts(3)
+        archive = ArchiveFactory.create(
+            transport="local", basedir=self.basedir, default=True,
+            policy="cdimage")
+        failed = build.artifact_set.get(filename="testing/testing0.txt")
+
+        def urlopen(request, *args, **kwargs):
+            if request.url == failed.url:
+                raise IOError("Connection refused")
+            return FakeResponse(u"Artifact from Jenkins")
+
+        with mock.patch("archives.transports.urllib2") as urllib2_mock:
+            urllib2_mock.Request.side_effect = lambda url: mock.Mock(url=url)
+            urllib2_mock.urlopen.side_effect = urlopen
+            with mock.patch("archives.tasks.logging") as mock_logging:
+                process_build_artifacts(build.pk)
+
+        self.assertTrue(mock_logging.exception.called)
+        archived = archive.get_archived_artifacts_for_build(build).filter(
+            archived_at__isnull=False)
         self.assertEqual(
-            [mock.call(item4.pk), mock.call(item2.pk)],
-            archive_task.si.call_args_list)
+            ["testing1.txt", "testing1.txt", "testing2.txt", "testing2.txt"],
+            sorted(os.path.basename(x.artifact.filename) for x in archived))
+        for item in archived.filter(projectbuild_dependency__isnull=False):
+            checksums_filename = os.path.join(
+                self.basedir, os.path.dirname(
+                    item.archived_path.lstrip("/")), "SHA256SUMS")
+            self.assertTrue(os.path.exists(checksums_filename))
+        build = Build.objects.get(pk=build.pk)
+        self.assertIsNone(build.archived_at)
+
+    def test_transfers_are_routed_to_archives_queue(self):
+        """
+        The artifacts are transferred by the workers consuming the archives
+        queue, which bounds the number of transfers at once.
+        """
+        for task in [archive_artifact_from_jenkins,
+                     archive_artifact_to_archives, link_artifact_in_archive]:
+            route = task.app.amqp.router.route({}, task.name)
+            self.assertEqual("archives", route["queue"].name)
+
+    def test_only_transfers_store_results(self):
+        """
+        Only the transfers in the header of the chord store their results, so
+        that the amqp backend doesn't create a queue for every task.
+        """
+        for task in [archive_artifact_from_jenkins,
+                     archive_artifact_to_archives, link_artifact_in_archive]:
+            self.assertFalse(task.ignore_result)
+        for task in [process_build_artifacts, generate_checksums]:
+            self.assertTrue(task.ignore_result)
+
+    def test_process_build_artifacts_dispatches_chord(self):
+        """
+        process_build_artifacts dispatches the transfers as a chord, with a
+        callback that marks the build as archived and generates the checksums.
+        """
+        build = self.create_build_with_artifacts(2)
+        ArchiveFactory.create(
+            transport="local", basedir=self.basedir, default=True)
+
+        with mock.patch("archives.tasks.chord") as mock_chord:
+            self.assertEqual(build.pk, process_build_artifacts(build.pk))
+
+        [transfers], _ = mock_chord.call_args
+        self.assertEqual(2, len(transfers))
+        [callback], _ = mock_chord.return_value.call_args
         self.assertEqual(
-            [mock.call(item4.pk, item3.pk), mock.call(item2.pk, item1.pk)],
-            link_task.si.call_args_list)
+            [("archives.tasks.mark_build_archived", (build.pk,)),
+             ("archives.tasks.generate_checksums", (build.pk,))],
+            [(x.task, tuple(x.args)) for x in callback.tasks])
+
+    @override_settings(CELERY_ALWAYS_EAGER=True)
+    def test_process_build_artifacts_without_artifacts(self):
+        """
+        A build without artifacts is marked as archived immediately.
+        """
+        build = self.create_build_with_artifacts(0)
+        ArchiveFactory.create(
+            transport="local", basedir=self.basedir, default=True)
+
+        process_build_artifacts(build.pk)
+
+        build = Build.objects.get(pk=build.pk)
+        self.assertIsNotNone(build.archived_at)
+
+
+class ArchiveProjectBuildDependenciesTaskTest(LocalArchiveTestBase):
+
+    @override_settings(CELERY_ALWAYS_EAGER=True)
+    def test_archive_reused_build(self):
+        """
+        A build reused for a projectbuild is archived for the projectbuild by
+        linking the copy that's already archived.
+        """
+        project = ProjectFactory.create()
+        dependency = DependencyFactory.create()
+        ProjectDependency.objects.create(
+            project=project, dependency=dependency)
+        build = BuildFactory.create(
+            job=dependency.job, phase=Build.FINALIZED, status="SUCCESS")
+        artifact = ArtifactFactory.create(
+            build=build, filename="testing/testing.txt")
+        ArchiveFactory.create(
+            transport="local", basedir=self.basedir, default=True,
+            policy="cdimage")
+        with mock.patch("archives.transports.urllib2") as urllib2_mock:
+            urllib2_mock.urlopen.side_effect = fake_response(
+                u"Artifact from Jenkins")
+            process_build_artifacts(build.pk)
+        projectbuild = build_project(project, queue_build=False)
+        projectbuild_dependency = projectbuild.dependencies.get()
+        projectbuild_dependency.build = build
+        projectbuild_dependency.save()
+
+        with mock.patch("archives.transports.urllib2") as urllib2_mock:
+            archive_projectbuild_dependencies([projectbuild_dependency.pk])
+
+        self.assertFalse(urllib2_mock.urlopen.called)
+        item = ArchiveArtifact.objects.get(
+            projectbuild_dependency=projectbuild_dependency)
+        self.assertEqual(artifact, item.artifact)
+        self.assertIsNotNone(item.archived_at)
+        self.assertIn(projectbuild.build_id, item.archived_path)
+        filename = os.path.join(self.basedir, item.archived_path.lstrip("/"))
+        self.assertEqual("Artifact from Jenkins", open(filename).read())
+        self.assertTrue(os.path.exists(
+            os.path.join(os.path.dirname(filename), "SHA256SUMS")))
+
+    @override_settings(ARCHIVE_DOWNLOAD_RETRIES=0, CELERY_ALWAYS_EAGER=True)
+    def test_archive_reused_build_with_failed_artifact(self):
+        """
+        If archiving one of the artifacts fails, the checksums are still
+        generated for the others.
+        """
+        project = ProjectFactory.create()
+        dependency = DependencyFactory.create()
+        ProjectDependency.objects.create(
+            project=project, dependency=dependency)
+        build = BuildFactory.create(
+            job=dependency.job, phase=Build.FINALIZED, status="SUCCESS")
+        failed = ArtifactFactory.create(
+            build=build, filename="testing/failed.txt")
+        artifact = ArtifactFactory.create(
+            build=build, filename="testing/testing.txt")
+        ArchiveFactory.create(
+            transport="local", basedir=self.basedir, default=True,
+            policy="cdimage")
+        projectbuild = build_project(project, queue_build=False)
+        projectbuild_dependency = projectbuild.dependencies.get()
+        projectbuild_dependency.build = build
+        projectbuild_dependency.save()
+
+        def urlopen(request, *args, **kwargs):
+            if request.url == failed.url:
+                raise IOError("Connection refused")
+            return FakeResponse(u"Artifact from Jenkins")
+
+        with mock.patch("archives.transports.urllib2") as urllib2_mock:
+            urllib2_mock.Request.side_effect = lambda url: mock.Mock(url=url)
+            urllib2_mock.urlopen.side_effect = urlopen
+            with mock.patch("archives.tasks.logging"):
+                archive_projectbuild_dependencies([projectbuild_dependency.pk])
+
+        item = ArchiveArtifact.objects.get(
+            projectbuild_dependency=projectbuild_dependency,
+            artifact=artifact)
+        self.assertIsNotNone(item.archived_at)
+        filename = os.path.join(self.basedir, item.archived_path.lstrip("/"))
+        checksums = open(
+            os.path.join(os.path.dirname(filename), "SHA256SUMS")).read()
+        self.assertIn("testing.txt", checksums)
+        self.assertNotIn("failed.txt", checksums)
+
+
+class ReplicationTest(TestCase):
+
+    def setUp(self):
+        self.basedir1 = tempfile.mkdtemp()
+        self.basedir2 = tempfile.mkdtemp()
+        self.spool_dir = tempfile.mkdtemp()
+        for directory in (self.basedir1, self.basedir2, self.spool_dir):
+            self.addCleanup(shutil.rmtree, directory)
+        self.archive1 = ArchiveFactory.create(
+            transport="local", basedir=self.basedir1, default=True)
+        self.archive2 = ArchiveFactory.create(
+            transport="local", basedir=self.basedir2, replicate=True)
+        self.dependency = DependencyFactory.create()
+
+    def create_artifact(self, filename="testing.txt", fingerprint=""):
+        return ArtifactFactory.create(
+            build=BuildFactory.create(job=self.dependency.job),
+            filename=filename, fingerprint=fingerprint)
+
+    def add_artifact(self, artifact):
+        [item1] = self.archive1.add_build(artifact.build)[artifact]
+        [item2] = self.archive2.add_build(artifact.build)[artifact]
+        return item1, item2
+
+    def archive_to_archives(self, items, content):
+        with mock.patch("archives.transports.urllib2") as urllib2_mock:
+            urllib2_mock.urlopen.side_effect = fake_response(content)
+            with override_settings(ARCHIVE_SPOOL_DIR=self.spool_dir):
+                archive_artifact_to_archives([x.pk for x in items])
+        return urllib2_mock
+
+    def get_filename(self, item):
+        item = ArchiveArtifact.objects.get(pk=item.pk)
+        return os.path.join(
+            item.archive.basedir, item.archived_path.lstrip("/"))
+
+    def test_archive_artifact_to_archives(self):
+        """
+        The artifact is downloaded once and written to each of the archives,
+        the spooled copy is removed afterwards.
+        """
+        items = self.add_artifact(self.create_artifact())
+
+        urllib2_mock = self.archive_to_archives(
+            items, u"Artifact from Jenkins")
+
+        self.assertEqual(1, urllib2_mock.urlopen.call_count)
+        for item in items:
+            item = ArchiveArtifact.objects.get(pk=item.pk)
+            self.assertIsNotNone(item.archived_at)
+            self.assertEqual(21, item.archived_size)
+            self.assertEqual(
+                hashlib.sha256(b"Artifact from Jenkins").hexdigest(),
+                item.sha256)
+            self.assertEqual(
+                "Artifact from Jenkins", open(self.get_filename(item)).read())
+        self.assertEqual([], os.listdir(self.spool_dir))
+
+    def test_archive_artifact_to_archives_with_failure(self):
+        """
+        If writing to one of the archives fails, the artifact is still
+        archived in the others and the error is logged.
+        """
+        self.archive2.basedir = os.path.join(self.basedir2, "file")
+        self.archive2.save()
+        open(self.archive2.basedir, "w").close()
+        item1, item2 = self.add_artifact(self.create_artifact())
+
+        with mock.patch("archives.tasks.logging") as mock_logging:
+            self.archive_to_archives([item1, item2], u"Artifact from Jenkins")
+
+        self.assertTrue(mock_logging.exception.called)
+        self.assertIsNotNone(
+            ArchiveArtifact.objects.get(pk=item1.pk).archived_at)
+        self.assertIsNone(ArchiveArtifact.objects.get(pk=item2.pk).archived_at)
+        self.assertEqual([], os.listdir(self.spool_dir))
+
+    def test_existing_artifacts_are_not_downloaded(self):
+        """
+        If every archive already has the content of the artifact, it isn't
+        downloaded from Jenkins.
+        """
+        fingerprint = hashlib.md5(b"Artifact from Jenkins").hexdigest()
+        self.archive_to_archives(
+            self.add_artifact(self.create_artifact("old.txt", fingerprint)),
+            u"Artifact from Jenkins")
+
+        items = self.add_artifact(self.create_artifact("new.txt", fingerprint))
+        urllib2_mock = self.archive_to_archives(items, u"")
+
+        self.assertFalse(urllib2_mock.urlopen.called)
+        for item in items:
+            self.assertEqual(
+                "Artifact from Jenkins", open(self.get_filename(item)).read())
+
+    def test_get_transfer_chains(self):
+        """
+        Artifacts are downloaded once for all the archives, and then linked
+        to the rest of their items in each archive.
+        """
+        project = ProjectFactory.create()
+        ProjectDependency.objects.create(
+            project=project, dependency=self.dependency)
+        projectbuild = build_project(project, queue_build=False)
+        artifact = ArtifactFactory.create(
+            build=BuildFactory.create(
+                job=self.dependency.job, build_id=projectbuild.build_key))
+        process_build_dependencies(artifact.build.pk)
+        files1 = self.archive1.add_build(artifact.build)[artifact]
+        files2 = self.archive2.add_build(artifact.build)[artifact]
+
+        [transfer] = get_transfer_chains({artifact: files1 + files2})
+
+        self.assertEqual(
+            [("archives.tasks.archive_artifact_to_archives",
+              ([files1[0].pk, files2[0].pk],)),
+             ("archives.tasks.link_artifact_in_archive",
+              (files1[0].pk, files1[1].pk)),
+             ("archives.tasks.link_artifact_in_archive",
+              (files2[0].pk, files2[1].pk))],
+            [(x.task, tuple(x.args)) for x in transfer.tasks])
+
+    @override_settings(CELERY_ALWAYS_EAGER=True)
+    def test_process_build_artifacts(self):
+        """
+        Builds are archived in the default archive and the archives they're
+        replicated to.
+        """
+        project = ProjectFactory.create()
+        ProjectDependency.objects.create(
+            project=project, dependency=self.dependency)
+        projectbuild = build_project(project, queue_build=False)
+        build = BuildFactory.create(
+            job=self.dependency.job, build_id=projectbuild.build_key)
+        ArtifactFactory.create(build=build, filename="testing/testing.txt")
+        process_build_dependencies(build.pk)
+
+        with mock.patch("archives.transports.urllib2") as urllib2_mock:
+            urllib2_mock.urlopen.side_effect = fake_response(
+                u"Artifact from Jenkins")
+            with override_settings(ARCHIVE_SPOOL_DIR=self.spool_dir):
+                process_build_artifacts(build.pk)
+
+        self.assertEqual(1, urllib2_mock.urlopen.call_count)
+        for archive in (self.archive1, self.archive2):
+            items = list(archive.get_archived_artifacts_for_build(build))
+            self.assertEqual(2, len(items))
+            for item in items:
+                self.assertEqual(
+                    "Artifact from Jenkins",
+                    open(self.get_filename(item)).read())
+                if item.projectbuild_dependency:
+                    checksums_filename = os.path.join(
+                        os.path.dirname(self.get_filename(item)),
+                        "SHA256SUMS")
+                    self.assertTrue(os.path.exists(checksums_filename))
+
+
+class ContentAddressedArchiveTest(LocalArchiveTestBase):
+
+    def setUp(self):
+        super(ContentAddressedArchiveTest, self).setUp()
+        self.archive = ArchiveFactory.create(
+            transport="local", basedir=self.basedir, content_addressed=True)
+
+    def archive_artifact(self, artifact, content):
+        [item] = self.archive.add_build(artifact.build)[artifact]
+        with mock.patch("archives.transports.urllib2") as urllib2_mock:
+            urllib2_mock.urlopen.side_effect = fake_response(content)
+            archive_artifact_from_jenkins(item.pk)
+        return ArchiveArtifact.objects.get(pk=item.pk), urllib2_mock
+
+    def test_identical_artifacts_are_stored_once(self):
+        """
+        Artifacts with the same content are links to the same blob.
+        """
+        dependency = DependencyFactory.create()
+        artifact1 = ArtifactFactory.create(
+            build=BuildFactory.create(job=dependency.job),
+            filename="testing1.txt")
+        artifact2 = ArtifactFactory.create(
+            build=BuildFactory.create(job=dependency.job),
+            filename="testing2.txt")
+
+        item1, _ = self.archive_artifact(artifact1, u"Artifact from Jenkins")
+        item2, _ = self.archive_artifact(artifact2, u"Artifact from Jenkins")
+
+        self.assertTrue(item1.content_addressed)
+        self.assertEqual(item1.sha256, item2.sha256)
+        filename1 = os.path.join(self.basedir, item1.archived_path.lstrip("/"))
+        filename2 = os.path.join(self.basedir, item2.archived_path.lstrip("/"))
+        self.assertNotEqual(filename1, filename2)
+        self.assertEqual(os.stat(filename1).st_ino, os.stat(filename2).st_ino)
+        self.assertEqual(file(filename2).read(), "Artifact from Jenkins")
+
+    def test_stored_artifacts_are_not_transferred(self):
+        """
+        If the artifact is already stored as a blob, it's linked rather than
+        being transferred again.
+        """
+        dependency = DependencyFactory.create()
+        artifact = ArtifactFactory.create(
+            build=BuildFactory.create(job=dependency.job),
+            filename="testing.txt")
+        item1, _ = self.archive_artifact(artifact, u"Artifact from Jenkins")
+        # Archiving the build again creates a new item for the artifact.
+        ArchiveArtifact.objects.filter(pk=item1.pk).update(
+            archived_path="/old/testing.txt")
+
+        item2, urllib2_mock = self.archive_artifact(artifact, u"")
+
+        self.assertFalse(urllib2_mock.urlopen.called)
+        self.assertEqual(21, item2.archived_size)
+        self.assertEqual(item1.sha256, item2.sha256)
+        filename = os.path.join(self.basedir, item2.archived_path.lstrip("/"))
+        self.assertEqual(file(filename).read(), "Artifact from Jenkins")
+
+    def test_get_blob_item(self):
+        """
+        Only archived items which are links to blobs can be linked to.
+        """
+        artifact = ArtifactFactory.create()
+        item = ArchiveArtifact.objects.create(
+            archive=self.archive, artifact=artifact, sha256="a" * 64,
+            archived_at=timezone.now())
+        self.assertIsNone(self.archive.get_blob_item(artifact))
+
+        item.content_addressed = True
+        item.save()
+        self.assertEqual(item, self.archive.get_blob_item(artifact))
+
+    def test_get_blob_item_from_other_build(self):
+        """
+        Blobs are matched by content, so an item for the same fingerprint in
+        another build can be linked to.
+        """
+        dependency = DependencyFactory.create()
+        artifact1 = ArtifactFactory.create(
+            build=BuildFactory.create(job=dependency.job),
+            filename="testing.txt", fingerprint="a" * 32)
+        artifact2 = ArtifactFactory.create(
+            build=BuildFactory.create(job=dependency.job),
+            filename="testing.txt", fingerprint="a" * 32)
+        item = ArchiveArtifact.objects.create(
+            archive=self.archive, artifact=artifact1, sha256="b" * 64,
+            md5="a" * 32, content_addressed=True, archived_at=timezone.now())
+
+        self.assertEqual(item, self.archive.get_blob_item(artifact2))
+        artifact2.fingerprint = "c" * 32
+        self.assertIsNone(self.archive.get_blob_item(artifact2))
+
+
+class FingerprintArchiveTest(LocalArchiveTestBase):
+
+    def setUp(self):
+        super(FingerprintArchiveTest, self).setUp()
+        self.archive = ArchiveFactory.create(
+            transport="local", basedir=self.basedir)
+        self.dependency = DependencyFactory.create()
+
+    def archive_artifact(self, artifact, content):
+        [item] = self.archive.add_build(artifact.build)[artifact]
+        with mock.patch("archives.transports.urllib2") as urllib2_mock:
+            urllib2_mock.urlopen.side_effect = fake_response(content)
+            archive_artifact_from_jenkins(item.pk)
+        return ArchiveArtifact.objects.get(pk=item.pk), urllib2_mock
+
+    def create_artifact(self, filename, fingerprint):
+        return ArtifactFactory.create(
+            build=BuildFactory.create(job=self.dependency.job),
+            filename=filename, fingerprint=fingerprint)
+
+    def test_fingerprinted_artifacts_are_not_transferred(self):
+        """
+        An artifact whose fingerprint matches an archived file is linked to
+        it rather than being transferred from Jenkins.
+        """
+        fingerprint = hashlib.md5(b"Artifact from Jenkins").hexdigest()
+        item1, _ = self.archive_artifact(
+            self.create_artifact("testing1.txt", fingerprint),
+            u"Artifact from Jenkins")
+        self.assertEqual(fingerprint, item1.md5)
+
+        artifact = self.create_artifact("testing2.txt", fingerprint)
+        item2, urllib2_mock = self.archive_artifact(artifact, u"")
+
+        self.assertFalse(urllib2_mock.urlopen.called)
+        self.assertEqual(21, item2.archived_size)
+        self.assertEqual(item1.sha256, item2.sha256)
+        filename1 = os.path.join(self.basedir, item1.archived_path.lstrip("/"))
+        filename2 = os.path.join(self.basedir, item2.archived_path.lstrip("/"))
+        self.assertEqual(os.stat(filename1).st_ino, os.stat(filename2).st_ino)
+
+    def test_changed_artifacts_are_transferred(self):
+        """
+        Artifacts with a different fingerprint, or without one, are
+        transferred from Jenkins.
+        """
+        self.archive_artifact(
+            self.create_artifact("testing1.txt", "a" * 32), u"Old artifact")
+
+        item2, urllib2_mock = self.archive_artifact(
+            self.create_artifact("testing2.txt", "b" * 32), u"New artifact")
+        item3, urllib2_mock = self.archive_artifact(
+            self.create_artifact("testing3.txt", ""), u"New artifact")
+
+        self.assertTrue(urllib2_mock.urlopen.called)
+        for item in (item2, item3):
+            filename = os.path.join(
+                self.basedir, item.archived_path.lstrip("/"))
+            self.assertEqual("New artifact", open(filename).read())
+
+    def test_get_fingerprint_item(self):
+        """
+        Archived items are matched by the md5 calculated as they were
+        archived, falling back to the fingerprint of their artifact.
+        """
+        artifact = self.create_artifact("testing.txt", "a" * 32)
+        item = ArchiveArtifact.objects.create(
+            archive=self.archive, artifact=self.create_artifact("old.txt", ""),
+            archived_path="/old.txt", md5="a" * 32, archived_size=100)
+        self.assertIsNone(self.archive.get_fingerprint_item(artifact))
+
+        item.archived_at = timezone.now()
+        item.save()
+        self.assertEqual(item, self.archive.get_fingerprint_item(artifact))
+
+        item.md5 = ""
+        item.save()
+        self.assertIsNone(self.archive.get_fingerprint_item(artifact))
+        item.artifact.fingerprint = "a" * 32
+        item.artifact.save()
+        self.assertEqual(item, self.archive.get_fingerprint_item(artifact))
+
+    def test_fingerprinted_blobs_are_linked(self):
+        """
+        In content-addressed archives, a fingerprinted artifact is linked to
+        the blob of the matching item.
+        """
+        self.archive.content_addressed = True
+        self.archive.save()
+        fingerprint = hashlib.md5(b"Artifact from Jenkins").hexdigest()
+        item1, _ = self.archive_artifact(
+            self.create_artifact("testing1.txt", fingerprint),
+            u"Artifact from Jenkins")
+
+        item2, urllib2_mock = self.archive_artifact(
+            self.create_artifact("testing2.txt", fingerprint), u"")
+
+        self.assertFalse(urllib2_mock.urlopen.called)
+        self.assertTrue(item2.content_addressed)
+        blob = os.path.join(
+            self.basedir, LocalTransport(self.archive).get_blob_path(
+                item1.sha256).lstrip("/"))
+        filename = os.path.join(self.basedir, item2.archived_path.lstrip("/"))
+        self.assertEqual(os.stat(blob).st_ino, os.stat(filename).st_ino)
 
 
 class LinkArtifactInArchiveTaskTest(LocalArchiveTestBase):
@@ -461,6 +1142,9 @@ class LinkArtifactInArchiveTaskTest(LocalArchiveTestBase):
             transport="local", basedir=self.basedir, default=True)
         [item1, item2] = archive.add_build(artifact.build)[artifact]
         item1.archived_size = 1000
+        item1.sha256 = "a" * 64
+        item1.md5 = "b" * 32
+        item1.archived_at = timezone.now()
         item1.save()
 
         transport = mock.Mock(spec=LocalTransport)
@@ -473,6 +1157,37 @@ class LinkArtifactInArchiveTaskTest(LocalArchiveTestBase):
         transport.link_to_current.assert_called_once_with(item2.archived_path)
         item1 = ArchiveArtifact.objects.get(pk=item1.pk)
         self.assertEqual(1000, item1.archived_size)
+        item2 = ArchiveArtifact.objects.get(pk=item2.pk)
+        self.assertEqual(1000, item2.archived_size)
+        self.assertEqual("a" * 64, item2.sha256)
+        self.assertEqual("b" * 32, item2.md5)
+        self.assertEqual("", item2.sha1)
+
+    def test_link_artifact_in_archive_without_archived_source(self):
+        """
+        If the source wasn't archived, e.g. copying it from Jenkins failed,
+        then the destination isn't linked to it.
+        """
+        project = ProjectFactory.create()
+        dependency = DependencyFactory.create()
+        ProjectDependency.objects.create(
+            project=project, dependency=dependency)
+        build = BuildFactory.create(job=dependency.job, phase=Build.FINALIZED)
+        artifact = ArtifactFactory.create(
+            build=build, filename="testing/testing.txt")
+        process_build_dependencies(build.pk)
+        archive = ArchiveFactory.create(
+            transport="local", basedir=self.basedir, default=True)
+        [item1, item2] = archive.add_build(artifact.build)[artifact]
+
+        transport = mock.Mock(spec=LocalTransport)
+        with mock.patch.object(
+                Archive, "get_transport", return_value=transport):
+            self.assertFalse(link_artifact_in_archive(item1.pk, item2.pk))
+
+        self.assertFalse(transport.link_filename_to_filename.called)
+        item2 = ArchiveArtifact.objects.get(pk=item2.pk)
+        self.assertIsNone(item2.archived_at)
 
     def test_archive_artifact_from_non_finalized_projectbuild(self):
         """
@@ -506,6 +1221,8 @@ class LinkArtifactInArchiveTaskTest(LocalArchiveTestBase):
         archive = ArchiveFactory.create(
             transport="local", basedir=self.basedir, default=True)
         [item1, item2] = archive.add_build(artifact.build)[artifact]
+        item1.archived_at = timezone.now()
+        item1.save()
 
         transport = LoggingTransport(archive)
         with mock.patch.object(
@@ -553,6 +1270,8 @@ class LinkArtifactInArchiveTaskTest(LocalArchiveTestBase):
         archive = ArchiveFactory.create(
             transport="local", basedir=self.basedir, default=True)
         [item1, item2] = archive.add_build(artifact.build)[artifact]
+        item1.archived_at = timezone.now()
+        item1.save()
 
         transport = LoggingTransport(archive)
         with mock.patch.object(
@@ -1,20 +1,27 @@
 from __future__ import unicode_literals
 
+import hashlib
 import tempfile
 import shutil
 from io import StringIO
 import os
 
 from django.test import TestCase
+from django.test.utils import override_settings
 import mock
 
+from archives.checksums import Checksums
 from archives.models import ArchiveArtifact
-from archives.transports import LocalTransport, SshTransport
+from archives.pool import ssh_pool
+from archives.sftpclient import SFTPClient
+from archives.transports import (
+    LocalTransport, SshTransport, ResumableDownload)
 from jenkins.tests.factories import ArtifactFactory, BuildFactory
 from projects.helpers import build_project
 from projects.models import ProjectDependency, ProjectBuildDependency
 from projects.tests.factories import ProjectFactory, DependencyFactory
 from .factories import ArchiveFactory
+from .helpers import FakeResponse, StubHTTPServer
 
 
 class LocalTransportTest(TestCase):
@@ -41,12 +48,100 @@ class LocalTransportTest(TestCase):
         filename = os.path.join(self.basedir, "temp/temp.gz")
         self.assertEqual(file(filename).read(), "This is the artifact")
 
+    @override_settings(ARCHIVE_BUFFER_SIZE=4)
+    def test_archive_file_in_chunks(self):
+        """
+        LocalTransport reads the fileobj in chunks of ARCHIVE_BUFFER_SIZE
+        bytes.
+        """
+        transport = LocalTransport(self.archive)
+        fakefile = mock.Mock(wraps=StringIO(u"This is the artifact"))
+
+        size = transport.archive_file(fakefile, "/temp/temp.gz")
+
+        self.assertEqual(20, size)
+        self.assertEqual(
+            [mock.call(4)] * 6, fakefile.read.call_args_list)
+        filename = os.path.join(self.basedir, "temp/temp.gz")
+        self.assertEqual(file(filename).read(), "This is the artifact")
+
+    def test_archive_file_with_checksums(self):
+        """
+        LocalTransport updates the checksums as the file is copied.
+        """
+        transport = LocalTransport(self.archive)
+        fakefile = StringIO(u"This is the artifact")
+        checksums = Checksums(["sha256", "md5"])
+
+        with override_settings(ARCHIVE_BUFFER_SIZE=4):
+            transport.archive_file(
+                fakefile, "/temp/temp.gz", checksums=checksums)
+
+        self.assertEqual(
+            {"sha256": hashlib.sha256(b"This is the artifact").hexdigest(),
+             "md5": hashlib.md5(b"This is the artifact").hexdigest()},
+            checksums.hexdigests())
+
+    def test_archive_file_with_partial_writes(self):
+        """
+        LocalTransport keeps writing until all the data has been written.
+        """
+        transport = LocalTransport(self.archive)
+        fakefile = StringIO(u"This is the artifact")
+        write = os.write
+
+        with mock.patch("archives.transports.os.write") as mock_write:
+            mock_write.side_effect = lambda fd, data: write(fd, data[:3])
+            size = transport.archive_file(fakefile, "/temp/temp.gz")
+
+        self.assertEqual(20, size)
+        self.assertEqual(7, mock_write.call_count)
+        filename = os.path.join(self.basedir, "temp/temp.gz")
+        self.assertEqual(file(filename).read(), "This is the artifact")
+
+    def test_archive_file_replaces_existing_file(self):
+        """
+        LocalTransport replaces an existing file rather than writing over it,
+        so that no stale data is left after the new artifact.
+        """
+        filename = os.path.join(self.basedir, "temp/temp.gz")
+        os.makedirs(os.path.dirname(filename))
+        with open(filename, "w") as f:
+            f.write("This is a much longer, older artifact")
+        transport = LocalTransport(self.archive)
+
+        size = transport.archive_file(
+            StringIO(u"This is the artifact"), "/temp/temp.gz")
+
+        self.assertEqual(20, size)
+        self.assertEqual(file(filename).read(), "This is the artifact")
+        self.assertEqual(["temp.gz"], os.listdir(os.path.dirname(filename)))
+
+    def test_archive_file_with_failure(self):
+        """
+        If reading the fileobj fails, the temporary file is removed, and the
+        existing file is untouched.
+        """
+        filename = os.path.join(self.basedir, "temp/temp.gz")
+        os.makedirs(os.path.dirname(filename))
+        with open(filename, "w") as f:
+            f.write("This is the old artifact")
+        transport = LocalTransport(self.archive)
+        fakefile = mock.Mock()
+        fakefile.read.side_effect = IOError("Connection reset")
+
+        with self.assertRaises(IOError):
+            transport.archive_file(fakefile, "/temp/temp.gz")
+
+        self.assertEqual(file(filename).read(), "This is the old artifact")
+        self.assertEqual(["temp.gz"], os.listdir(os.path.dirname(filename)))
+
     def test_archive_from_url(self):
         """
         archive_from_url takes a valid URL and opens the file and then passes
         it to archive_file.
         """
-        fakefile = StringIO(u"Entirely new artifact")
+        fakefile = FakeResponse(u"Entirely new artifact")
 
         mock_request = mock.Mock()
         with mock.patch("archives.transports.urllib2") as urllib2_mock:
@@ -56,7 +151,7 @@ class LocalTransportTest(TestCase):
             transport.archive_url(
                 "http://example.com/testing", "/temp/temp.gz",
                 "username", "password")
-        urllib2_mock.urlopen.assert_called_once_with(mock_request)
+        urllib2_mock.urlopen.assert_called_once_with(mock_request, timeout=60)
         urllib2_mock.Request.assert_called_once_with(
             "http://example.com/testing")
         mock_request.assert_has_calls(
@@ -76,6 +171,85 @@ class LocalTransportTest(TestCase):
 
         self.assertTrue(os.path.exists(dirname))
 
+    def test_generate_checksums(self):
+        """
+        generate_checksums writes the checksums of the artifacts to the
+        checksum file in each directory, replacing existing entries for the
+        same files.
+        """
+        transport = LocalTransport(self.archive)
+        build = BuildFactory.create()
+        items = []
+        for path, content in [("/temp/file1.gz", "First artifact"),
+                              ("/temp/file2.gz", "Second artifact")]:
+            checksums = Checksums()
+            transport.archive_file(
+                StringIO(content), path, checksums=checksums)
+            item = ArchiveArtifact.objects.create(
+                build=build, archive=self.archive, archived_path=path,
+                artifact=ArtifactFactory.create(build=build))
+            item.set_checksums(checksums)
+            items.append(item)
+        # Files archived without checksums are read.
+        items[1].sha256 = ""
+        checksum_filename = os.path.join(self.basedir, "temp/SHA256SUMS")
+        with open(checksum_filename, "w") as f:
+            f.write("%s  file1.gz\n%s  other.gz\n" % ("0" * 64, "1" * 64))
+
+        transport.generate_checksums(items)
+        # Generating the checksums again doesn't duplicate them.
+        transport.generate_checksums(items)
+
+        self.assertEqual(
+            ["%s  file1.gz" % hashlib.sha256(b"First artifact").hexdigest(),
+             "%s  file2.gz" % hashlib.sha256(b"Second artifact").hexdigest(),
+             "%s  other.gz" % ("1" * 64)],
+            sorted(file(checksum_filename).read().splitlines()))
+        self.assertEqual(
+            ["SHA256SUMS", "file1.gz", "file2.gz"],
+            sorted(os.listdir(os.path.dirname(checksum_filename))))
+
+    def test_store_blob(self):
+        """
+        store_blob stores the archived file as the blob for its content, or
+        replaces it with a link to the blob if it's already stored.
+        """
+        transport = LocalTransport(self.archive)
+        sha256 = hashlib.sha256(b"This is the artifact").hexdigest()
+        transport.archive_file(
+            StringIO(u"This is the artifact"), "/temp1/temp.gz")
+        transport.archive_file(
+            StringIO(u"This is the artifact"), "/temp2/temp.gz")
+
+        transport.store_blob("/temp1/temp.gz", sha256)
+        transport.store_blob("/temp2/temp.gz", sha256)
+
+        blob = os.path.join(self.basedir, ".blobs", sha256[:2], sha256)
+        self.assertEqual(file(blob).read(), "This is the artifact")
+        self.assertEqual(3, os.stat(blob).st_nlink)
+        for path in ["temp1/temp.gz", "temp2/temp.gz"]:
+            filename = os.path.join(self.basedir, path)
+            self.assertEqual(os.stat(blob).st_ino, os.stat(filename).st_ino)
+        self.assertEqual(
+            ["temp.gz"], os.listdir(os.path.join(self.basedir, "temp2")))
+
+    def test_link_blob(self):
+        """
+        link_blob links the filename to an existing blob.
+        """
+        transport = LocalTransport(self.archive)
+        sha256 = hashlib.sha256(b"This is the artifact").hexdigest()
+        transport.archive_file(
+            StringIO(u"This is the artifact"), "/temp1/temp.gz")
+        transport.store_blob("/temp1/temp.gz", sha256)
+
+        transport.link_blob(sha256, "/temp2/temp.gz")
+
+        blob = os.path.join(self.basedir, ".blobs", sha256[:2], sha256)
+        filename = os.path.join(self.basedir, "temp2/temp.gz")
+        self.assertEqual(os.stat(blob).st_ino, os.stat(filename).st_ino)
+        self.assertEqual(file(filename).read(), "This is the artifact")
+
     def test_link_filename_to_filename(self):
         """
         LocalTransport.link_filename_to_filename should hardlink the source to
@@ -137,6 +311,7 @@ class SshTransportTest(TestCase):
     def setUp(self):
         self.archive = ArchiveFactory.create(
             transport="ssh", basedir="/var/tmp")
+        self.addCleanup(ssh_pool.close_all)
 
     def test_get_ssh_clients(self):
         """
@@ -162,7 +337,8 @@ class SshTransportTest(TestCase):
     def test_archive_file(self):
         """
         archive_file should ensure that there's a directory relative to the
-        base to hold the file, and then stream the file to the remote server.
+        base to hold the file over SFTP, and then stream the file to the
+        remote server.
         """
         mock_ssh = mock.Mock()
         mock_stdout = mock.Mock()
@@ -176,11 +352,11 @@ class SshTransportTest(TestCase):
                 return_value=(mock_ssh, mock_sftp)):
             transport.start()
             transport.archive_file(fakefile, "/temp/temp.gz")
-        mock_ssh.exec_command.assert_called_once_with(
-            "mkdir -p `dirname /var/tmp/temp/temp.gz`")
+        mock_sftp.makedirs.assert_called_once_with("/var/tmp/temp")
+        self.assertFalse(mock_ssh.exec_command.called)
 
         mock_sftp.stream_file_to_remote.assert_called_once_with(
-            fakefile, "/var/tmp/temp/temp.gz")
+            fakefile, "/var/tmp/temp/temp.gz", checksums=None)
 
         mock_ssh.close.assert_called_once()
 
@@ -209,16 +385,91 @@ class SshTransportTest(TestCase):
         transport = SshTransport(self.archive)
 
         with mock.patch.object(transport, "_run_command") as mock_run:
-            transport.generate_checksums(archived_artifact)
+            transport.generate_checksums([archived_artifact])
+
+        mock_run.assert_called_once_with(
+            "cd /var/tmp/srv/builds/200101.01 && "
+            "(sha256sum artifact_filename; cat SHA256SUMS 2>/dev/null) | "
+            "awk '!seen[substr($0, 67)]++' > SHA256SUMS.tmp.$$ && "
+            "mv SHA256SUMS.tmp.$$ SHA256SUMS")
+
+    def test_generate_checksums_by_directory(self):
+        """
+        generate_checksums should send a single command for each directory,
+        using the checksums calculated when the artifacts were archived.
+        """
+        build = BuildFactory.create()
+        archived_artifacts = [
+            ArchiveArtifact.objects.create(
+                build=build, archive=self.archive,
+                artifact=ArtifactFactory.create(build=build),
+                archived_path=path, sha256=checksum)
+            for path, checksum in [
+                ("/srv/builds/1/file1.gz", "a" * 64),
+                ("/srv/builds/2/file1.gz", "b" * 64),
+                ("/srv/builds/1/file 2.gz", "c" * 64),
+                ("/srv/builds/1/file3.gz", "")]]
+
+        transport = SshTransport(self.archive)
+
+        with mock.patch.object(transport, "_run_command") as mock_run:
+            transport.generate_checksums(archived_artifacts)
+
+        self.assertEqual([
+            mock.call(
+                "cd /var/tmp/srv/builds/1 && "
+                "(printf '%%s\\n' '%s  file1.gz' '%s  file 2.gz'; "
+                "sha256sum file3.gz; cat SHA256SUMS 2>/dev/null) | "
+                "awk '!seen[substr($0, 67)]++' > SHA256SUMS.tmp.$$ && "
+                "mv SHA256SUMS.tmp.$$ SHA256SUMS" % ("a" * 64, "c" * 64)),
+            mock.call(
+                "cd /var/tmp/srv/builds/2 && "
+                "(printf '%%s\\n' '%s  file1.gz'; "
+                "cat SHA256SUMS 2>/dev/null) | "
+                "awk '!seen[substr($0, 67)]++' > SHA256SUMS.tmp.$$ && "
+                "mv SHA256SUMS.tmp.$$ SHA256SUMS" % ("b" * 64))],
+            mock_run.call_args_list)
+
+    def test_store_blob(self):
+        """
+        store_blob should link the archived file and the blob for its
+        content with a single command.
+        """
+        transport = SshTransport(self.archive)
+        transport.sftp_client = mock.Mock()
+
+        with mock.patch.object(transport, "_run_command") as mock_run:
+            transport.store_blob("/temp/temp.gz", "abcdef")
+
+        transport.sftp_client.makedirs.assert_called_once_with(
+            "/var/tmp/.blobs/ab")
+        mock_run.assert_called_once_with(
+            "if [ -e \"/var/tmp/.blobs/ab/abcdef\" ]; "
+            "then ln -f \"/var/tmp/.blobs/ab/abcdef\" "
+            "\"/var/tmp/temp/temp.gz\"; "
+            "else ln \"/var/tmp/temp/temp.gz\" "
+            "\"/var/tmp/.blobs/ab/abcdef\"; fi")
+
+    def test_link_blob(self):
+        """
+        link_blob should link the filename to the blob.
+        """
+        transport = SshTransport(self.archive)
+        transport.sftp_client = mock.Mock()
+
+        with mock.patch.object(transport, "_run_command") as mock_run:
+            transport.link_blob("abcdef", "/temp/temp.gz")
 
+        transport.sftp_client.makedirs.assert_called_once_with(
+            "/var/tmp/temp")
         mock_run.assert_called_once_with(
-            "cd `dirname /var/tmp/srv/builds/200101.01/artifact_filename` "
-            "&& sha256sum artifact_filename >> SHA256SUMS")
+            "ln -f \"/var/tmp/.blobs/ab/abcdef\" \"/var/tmp/temp/temp.gz\"")
 
     def test_link_filename_to_filename(self):
         """
-        archive_file should ensure that there's a directory relative to the
-        base to hold the file, and then stream the file to the remote server.
+        link_filename_to_filename should ensure that there's a directory
+        relative to the base to hold the destination, and then link it to
+        the source.
         """
         mock_ssh = mock.Mock()
         mock_stdout = mock.Mock()
@@ -232,9 +483,9 @@ class SshTransportTest(TestCase):
             transport.start()
             transport.link_filename_to_filename(
                 "/temp/temp.gz", "/temp2/temp.gz")
-        mock_ssh.exec_command.assert_has_calls(
-            [mock.call("mkdir -p `dirname /var/tmp/temp2/temp.gz`"),
-             mock.call('ln "/var/tmp/temp/temp.gz" "/var/tmp/temp2/temp.gz"')])
+        mock_sftp.makedirs.assert_called_once_with("/var/tmp/temp2")
+        mock_ssh.exec_command.assert_called_once_with(
+            'ln "/var/tmp/temp/temp.gz" "/var/tmp/temp2/temp.gz"')
 
         mock_ssh.close.assert_called_once()
 
@@ -259,3 +510,224 @@ class SshTransportTest(TestCase):
                        '&& ln -sf "1234" current')])
         self.assertEqual("/var/tmp/project/current", current_dir)
         mock_ssh.close.assert_called_once()
+
+
+class SFTPClientTest(TestCase):
+
+    def test_makedirs(self):
+        """
+        makedirs creates the missing directories, and remembers the
+        directories which exist so they aren't checked again.
+        """
+        client = SFTPClient.__new__(SFTPClient)
+        client.directories = set()
+        existing = set(["/var"])
+
+        def stat(path):
+            if path not in existing:
+                raise IOError(2, "No such file")
+
+        with mock.patch.object(client, "stat", side_effect=stat) as mock_stat:
+            with mock.patch.object(
+                    client, "mkdir", side_effect=existing.add) as mock_mkdir:
+                client.makedirs("/var/tmp/builds/1")
+                client.makedirs("/var/tmp/builds/2")
+                client.makedirs("/var/tmp/builds/1")
+
+        self.assertEqual(
+            [mock.call("/var/tmp"), mock.call("/var/tmp/builds"),
+             mock.call("/var/tmp/builds/1"), mock.call("/var/tmp/builds/2")],
+            mock_mkdir.call_args_list)
+        self.assertEqual(
+            [mock.call("/var/tmp/builds/1"), mock.call("/var/tmp/builds"),
+             mock.call("/var/tmp"), mock.call("/var"),
+             mock.call("/var/tmp/builds/2")],
+            mock_stat.call_args_list)
+
+    def test_makedirs_created_elsewhere(self):
+        """
+        If the directory is created by another connection after it's been
+        checked, makedirs doesn't fail.
+        """
+        client = SFTPClient.__new__(SFTPClient)
+        client.directories = set(["/var/tmp"])
+
+        with mock.patch.object(
+                client, "stat", side_effect=[IOError(2, "No such file"),
+                                             mock.Mock()]):
+            with mock.patch.object(
+                    client, "mkdir", side_effect=IOError(17, "File exists")):
+                client.makedirs("/var/tmp/builds")
+
+        self.assertIn("/var/tmp/builds", client.directories)
+
+    def test_stream_file_to_remote(self):
+        """
+        stream_file_to_remote writes the fileobj to the remote file, updating
+        the checksums as it's streamed.
+        """
+        client = SFTPClient.__new__(SFTPClient)
+        remote = mock.Mock()
+        checksums = Checksums()
+        fakefile = StringIO(u"This is the artifact")
+
+        with mock.patch.object(
+                client, "file", return_value=remote) as mock_file:
+            with mock.patch.object(client, "stat") as mock_stat:
+                mock_stat.return_value.st_size = 20
+                with mock.patch.object(client, "posix_rename") as mock_rename:
+                    size = client.stream_file_to_remote(
+                        fakefile, "/var/tmp/temp.gz", checksums=checksums)
+
+        self.assertEqual(20, size)
+        remote.write.assert_called_once_with("This is the artifact")
+        remote.close.assert_called_once_with()
+        [temporary, mode], _ = mock_file.call_args
+        self.assertTrue(temporary.startswith("/var/tmp/temp.gz.tmp-"))
+        mock_rename.assert_called_once_with(temporary, "/var/tmp/temp.gz")
+        self.assertEqual(
+            {"sha256": hashlib.sha256(b"This is the artifact").hexdigest()},
+            checksums.hexdigests())
+
+    def test_stream_file_to_remote_size_mismatch(self):
+        """
+        If the size of the written file doesn't match, the temporary file is
+        removed rather than renamed into place.
+        """
+        client = SFTPClient.__new__(SFTPClient)
+        remote = mock.Mock()
+
+        with mock.patch.object(
+                client, "file", return_value=remote) as mock_file:
+            with mock.patch.object(client, "stat") as mock_stat:
+                mock_stat.return_value.st_size = 10
+                with mock.patch.object(client, "posix_rename") as mock_rename:
+                    with mock.patch.object(client, "remove") as mock_remove:
+                        with self.assertRaises(IOError):
+                            client.stream_file_to_remote(
+                                StringIO(u"This is the artifact"),
+                                "/var/tmp/temp.gz")
+
+        [temporary, mode], _ = mock_file.call_args
+        mock_remove.assert_called_once_with(temporary)
+        self.assertFalse(mock_rename.called)
+
+
+@override_settings(ARCHIVE_DOWNLOAD_RETRIES=2, ARCHIVE_DOWNLOAD_BACKOFF=0)
+class ResumableDownloadTest(TestCase):
+
+    content = b"".join(chr(x % 256) for x in range(100000))
+
+    def start_server(self, **kwargs):
+        server = StubHTTPServer(self.content, **kwargs)
+        server.start()
+        self.addCleanup(server.stop)
+        return server
+
+    def read_all(self, download):
+        chunks = []
+        while True:
+            data = download.read(4096)
+            if not data:
+                return b"".join(chunks)
+            chunks.append(data)
+
+    def test_download(self):
+        """
+        ResumableDownload reads the body of the URL, sending the headers.
+        """
+        server = self.start_server()
+
+        download = ResumableDownload(server.url)
+
+        self.assertEqual(self.content, self.read_all(download))
+        self.assertEqual([None], server.ranges)
+
+    def test_resumes_dropped_connections(self):
+        """
+        If the connection is dropped part way through, the download is
+        resumed from where it was dropped.
+        """
+        server = self.start_server(failures=2, drop_after=30000)
+
+        download = ResumableDownload(server.url)
+
+        self.assertEqual(self.content, self.read_all(download))
+        self.assertEqual(
+            [None, "bytes=30000-", "bytes=60000-"], server.ranges)
+
+    def test_resume_without_range_support(self):
+        """
+        If the server doesn't support ranges, the data that has already been
+        read is skipped.
+        """
+        server = self.start_server(
+            failures=1, drop_after=30000, supports_ranges=False)
+
+        download = ResumableDownload(server.url)
+
+        self.assertEqual(self.content, self.read_all(download))
+        self.assertEqual([None, "bytes=30000-"], server.ranges)
+
+    def test_too_many_failures(self):
+        """
+        The download fails if it's resumed more than ARCHIVE_DOWNLOAD_RETRIES
+        times without reading any data.
+        """
+        server = self.start_server(failures=3, drop_after=0)
+
+        download = ResumableDownload(server.url)
+
+        with self.assertRaises(IOError):
+            self.read_all(download)
+        self.assertEqual(3, len(server.ranges))
+
+    @override_settings(ARCHIVE_DOWNLOAD_TIMEOUT=0.1)
+    def test_resumes_after_timeout(self):
+        """
+        If the server stops responding for longer than the
+        ARCHIVE_DOWNLOAD_TIMEOUT, the download is resumed.
+        """
+        server = self.start_server(failures=1, drop_after=30000, stall=0.5)
+
+        download = ResumableDownload(server.url)
+
+        self.assertEqual(self.content, self.read_all(download))
+        self.assertEqual([None, None], server.ranges)
+
+    def test_backoff(self):
+        """
+        The wait before resuming doubles after each failure.
+        """
+        server = self.start_server(failures=2, drop_after=0)
+
+        with override_settings(ARCHIVE_DOWNLOAD_BACKOFF=2):
+            with mock.patch("archives.transports.time.sleep") as mock_sleep:
+                download = ResumableDownload(server.url)
+                self.assertEqual(self.content, self.read_all(download))
+
+        self.assertEqual(
+            [mock.call(2), mock.call(4)], mock_sleep.call_args_list)
+
+    def test_archive_url(self):
+        """
+        Transports archive the complete artifact when the connection is
+        dropped.
+        """
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        archive = ArchiveFactory.create(transport="local", basedir=basedir)
+        server = self.start_server(failures=1, drop_after=50000)
+        checksums = Checksums()
+
+        size = LocalTransport(archive).archive_url(
+            server.url, "/temp/artifact.img", "username", "password",
+            checksums=checksums)
+
+        self.assertEqual(100000, size)
+        self.assertEqual(
+            self.content, open(os.path.join(basedir, "temp/artifact.img"),
+                               "rb").read())
+        self.assertEqual(
+            hashlib.sha256(self.content).hexdigest(),
+            checksums.hexdigests()["sha256"])
@@ -1,12 +1,136 @@
 import os
+import time
+import errno
+import socket
+import httplib
 import urllib2
 import logging
 import base64
+import functools
+import pipes
 import subprocess
+import uuid
+from collections import OrderedDict
 
 from paramiko import SSHClient, WarningPolicy
 
+from archives.pool import ssh_pool
 from archives.sftpclient import SFTPClient
+from jenkins.utils import DefaultSettings
+
+
+transport_settings = DefaultSettings({
+    # Artifacts are copied to local archives in chunks of this many bytes.
+    "ARCHIVE_BUFFER_SIZE": 64 * 1024,
+    # Socket timeout in seconds for downloading artifacts from Jenkins.
+    "ARCHIVE_DOWNLOAD_TIMEOUT": 60,
+    # Failed downloads are resumed this many times, waiting
+    # ARCHIVE_DOWNLOAD_BACKOFF seconds, doubling after each failure.
+    "ARCHIVE_DOWNLOAD_RETRIES": 5,
+    "ARCHIVE_DOWNLOAD_BACKOFF": 2,
+})
+
+
+class ResumableDownload(object):
+    """
+    A file object for the body of a URL, which resumes the download from
+    where it failed with a Range request if the connection fails, or ends
+    before the Content-Length has been read.
+    """
+    def __init__(self, url, headers=None):
+        self.url = url
+        self.headers = headers or {}
+        self.offset = 0
+        self.length = None
+        self.failures = 0
+        self.response = None
+
+    def _open(self):
+        """
+        Requests the URL from the current offset.
+        """
+        request = urllib2.Request(self.url)
+        for name, value in self.headers.items():
+            request.add_header(name, value)
+        if self.offset:
+            request.add_header("Range", "bytes=%d-" % self.offset)
+        response = urllib2.urlopen(
+            request, timeout=transport_settings.ARCHIVE_DOWNLOAD_TIMEOUT)
+        content_length = response.info().get("Content-Length")
+        partial = self.offset and response.getcode() == 206
+        if self.offset and not partial:
+            logging.warning(
+                "%s doesn't support ranges, skipping %d bytes",
+                self.url, self.offset)
+            self._skip(response, self.offset)
+        if self.length is None and content_length is not None:
+            self.length = int(content_length) + (self.offset if partial else 0)
+        self.response = response
+
+    def _skip(self, response, count):
+        """
+        Reads and discards count bytes from the response.
+        """
+        while count > 0:
+            data = response.read(
+                min(count, transport_settings.ARCHIVE_BUFFER_SIZE))
+            if not data:
+                raise IOError("%s ended while resuming" % self.url)
+            count -= len(data)
+
+    def _retry(self, error):
+        """
+        Closes the failed response and waits before resuming, or raises the
+        error if the download has failed too many times.
+        """
+        self.close()
+        self.failures += 1
+        if self.failures > transport_settings.ARCHIVE_DOWNLOAD_RETRIES:
+            raise error
+        delay = transport_settings.ARCHIVE_DOWNLOAD_BACKOFF * 2 ** (
+            self.failures - 1)
+        logging.warning(
+            "Download of %s failed after %d bytes (%s), resuming in %ss",
+            self.url, self.offset, error, delay)
+        time.sleep(delay)
+
+    def read(self, size=-1):
+        """
+        Reads up to size bytes, resuming the download if it fails.
+        """
+        while True:
+            try:
+                if self.response is None:
+                    self._open()
+                data = self.response.read(size)
+            except urllib2.HTTPError as e:
+                # Errors from the server other than the connection failing
+                # won't be fixed by trying again.
+                if e.code < 500:
+                    raise
+                self._retry(e)
+                continue
+            except (IOError, socket.error, httplib.HTTPException) as e:
+                self._retry(e)
+                continue
+            if data or size == 0:
+                self.offset += len(data)
+                self.failures = 0
+                return data
+            if self.length is not None and self.offset < self.length:
+                self._retry(IOError(
+                    "%s ended after %d of %d bytes" % (
+                        self.url, self.offset, self.length)))
+                continue
+            return data
+
+    def close(self):
+        if self.response is not None:
+            try:
+                self.response.close()
+            except Exception:
+                pass
+            self.response = None
 
 
 class Transport(object):
@@ -15,6 +139,8 @@ class Transport(object):
     jenkins and writing them to the target archive.
     """
     checksum_filename = "SHA256SUMS"
+    # Content-addressed archives store each file once in this directory.
+    blob_directory = ".blobs"
 
     def __init__(self, archive):
         self.archive = archive
@@ -29,14 +155,52 @@ class Transport(object):
         Finalize the archiving.
         """
 
-    def generate_checksums(self, archived_artifact):
-        """
-        Generates checksum files for the specified artifact on the archive.
-        """
-        self._run_command("cd `dirname %s` && sha256sum %s >> %s" % (
-            self.get_relative_filename(archived_artifact.archived_path),
-            archived_artifact.artifact.filename,
-            self.checksum_filename))
+    def generate_checksums(self, archived_artifacts):
+        """
+        Generates checksum files for the specified artifacts on the archive.
+
+        The checksum file in each directory is rewritten with a single
+        command, see _get_checksums_command.
+        """
+        directories = OrderedDict()
+        for archived_artifact in archived_artifacts:
+            path = self.get_relative_filename(archived_artifact.archived_path)
+            directories.setdefault(os.path.dirname(path), OrderedDict())[
+                os.path.basename(path)] = archived_artifact.sha256
+        for directory, checksums in directories.items():
+            self._run_command(
+                self._get_checksums_command(directory, checksums))
+
+    def _get_checksums_command(self, directory, checksums):
+        """
+        Returns a shell command which adds the checksums, a dictionary
+        mapping filenames to the sha256 calculated when they were archived, to
+        the checksum file in the directory.
+
+        Files without a stored checksum are read to calculate it. Existing
+        entries for the files are replaced, and the new checksum file is
+        renamed into place so that it's never partially written.
+        """
+        commands = []
+        stored = ["%s  %s" % (checksum, filename)
+                  for filename, checksum in checksums.items() if checksum]
+        if stored:
+            commands.append(
+                "printf '%%s\\n' %s" % " ".join(map(pipes.quote, stored)))
+        missing = [filename for filename, checksum in checksums.items()
+                   if not checksum]
+        if missing:
+            commands.append("sha256sum %s" % " ".join(
+                map(pipes.quote, missing)))
+        commands.append("cat %s 2>/dev/null" % self.checksum_filename)
+        temporary = "%s.tmp.$$" % self.checksum_filename
+        # The filename starts at character 67 of each line, after the
+        # checksum and two spaces, only the first line for each is kept.
+        return (
+            "cd %s && (%s) | awk '!seen[substr($0, 67)]++' > %s && "
+            "mv %s %s" % (
+                pipes.quote(directory), "; ".join(commands), temporary,
+                temporary, self.checksum_filename))
 
     def get_relative_filename(self, filename):
         """
@@ -63,33 +227,57 @@ class Transport(object):
         """
         raise NotImplemented
 
+    def get_blob_path(self, sha256):
+        """
+        Returns the path of the blob for content with the sha256 in a
+        content-addressed archive.
+        """
+        return "/%s/%s/%s" % (self.blob_directory, sha256[:2], sha256)
+
+    def store_blob(self, filename, sha256):
+        """
+        Makes the archived filename a link to the blob for its content,
+        storing it as the blob if there isn't one already.
+        """
+        raise NotImplemented
+
+    def link_blob(self, sha256, filename):
+        """
+        Links the filename to the existing blob for the sha256.
+        """
+        raise NotImplemented
+
     def _open_url(self, url, username, password):
         """
-        Opens a URL with the correct authentication header, and returns the
-        file object for the body.
+        Opens a URL with the correct authentication header, and returns a
+        ResumableDownload for the body.
         """
-        request = urllib2.Request(url)
-        request.add_header(
-            "Authorization",
-            "Basic " + base64.b64encode(username + ":" + password))
-        return urllib2.urlopen(request)
+        download = ResumableDownload(url, {
+            "Authorization":
+            "Basic " + base64.b64encode(username + ":" + password)})
+        download.read(0)
+        return download
 
-    def archive_file(self, fileobj, filename):
+    def archive_file(self, fileobj, filename, checksums=None):
         """
         Archives a single artifact from the fileobj to the
         destination path.
 
+        If provided, the checksums are updated with the artifact as it's
+        archived.
+
         Returns the number of bytes archived.
         """
         raise NotImplemented
 
-    def archive_url(self, url, destination_path, username, password):
+    def archive_url(
+            self, url, destination_path, username, password, checksums=None):
         """
         Archives a single fileobj to the destination path.
         """
         logging.info("Attempting to archive %s to %s", url, destination_path)
         f = self._open_url(url, username, password)
-        return self.archive_file(f, destination_path)
+        return self.archive_file(f, destination_path, checksums=checksums)
 
 
 class LocalTransport(Transport):
@@ -104,11 +292,14 @@ class LocalTransport(Transport):
         if not os.path.exists(self.archive.basedir):
             os.makedirs(self.archive.basedir)
 
-    def archive_file(self, fileobj, filename):
+    def archive_file(self, fileobj, filename, checksums=None):
         """
         Archives a single artifact from the fileobj to the
         destination path.
 
+        If provided, the checksums are updated with the artifact as it's
+        archived.
+
         Returns the number of bytes archived.
         """
         filename = self.get_relative_filename(filename)
@@ -117,13 +308,47 @@ class LocalTransport(Transport):
         logging.info(
             "LocalTransport archiving artifact to %s", filename)
 
+        # The artifact is written to a temporary file alongside the
+        # destination, and renamed over it once it's complete, so that a
+        # partially copied artifact is never visible in the archive.
+        temporary = "%s.tmp-%s" % (filename, uuid.uuid4().hex)
+        fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            try:
+                size = self._copy_to_fd(fileobj, fd, checksums=checksums)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.rename(temporary, filename)
+        except Exception:
+            os.unlink(temporary)
+            raise
+        return size
+
+    def _copy_to_fd(self, fileobj, fd, checksums=None):
+        """
+        Copies the fileobj to the file descriptor in chunks of
+        ARCHIVE_BUFFER_SIZE bytes, so that large artifacts aren't read into
+        memory, updating the checksums with each chunk.
+
+        Returns the number of bytes written.
+        """
         # We use the low-level stuff here because Python2 returns None from
         # fileobj.write()
-        try:
-            fd = os.open(filename, os.O_RDWR | os.O_CREAT)
-            size = os.write(fd, fileobj.read())
-        finally:
-            os.close(fd)
+        size = 0
+        while True:
+            data = fileobj.read(transport_settings.ARCHIVE_BUFFER_SIZE)
+            if not data:
+                break
+            data = bytes(data)
+            if checksums is not None:
+                checksums.update(data)
+            data = memoryview(data)
+            # os.write may write less than it was given.
+            while data:
+                written = os.write(fd, data)
+                data = data[written:]
+                size += written
         return size
 
     def _run_command(self, command):
@@ -148,6 +373,44 @@ class LocalTransport(Transport):
         if not os.path.exists(destination):
             os.link(source, destination)
 
+    def _replace_with_link(self, source, destination):
+        """
+        Hard links the source to the destination, replacing the destination
+        if it exists.
+        """
+        if not os.path.exists(os.path.dirname(destination)):
+            os.makedirs(os.path.dirname(destination))
+        temporary = "%s.tmp-%s" % (destination, uuid.uuid4().hex)
+        os.link(source, temporary)
+        os.rename(temporary, destination)
+
+    def store_blob(self, filename, sha256):
+        """
+        Makes the archived filename a link to the blob for its content,
+        storing it as the blob if there isn't one already.
+        """
+        blob = self.get_relative_filename(self.get_blob_path(sha256))
+        filename = self.get_relative_filename(filename)
+        if not os.path.exists(blob):
+            if not os.path.exists(os.path.dirname(blob)):
+                os.makedirs(os.path.dirname(blob))
+            try:
+                os.link(filename, blob)
+                return
+            except OSError as e:
+                # Another task stored the same content first.
+                if e.errno != errno.EEXIST:
+                    raise
+        self._replace_with_link(blob, filename)
+
+    def link_blob(self, sha256, filename):
+        """
+        Links the filename to the existing blob for the sha256.
+        """
+        self._replace_with_link(
+            self.get_relative_filename(self.get_blob_path(sha256)),
+            self.get_relative_filename(filename))
+
     def link_to_current(self, path):
         """
         Link the path to the "current" directory in the parent directory.
@@ -163,6 +426,21 @@ class LocalTransport(Transport):
         return current_dir
 
 
+def discard_connection_on_error(method):
+    """
+    Marks the connection of the SshTransport as failed if the method raises
+    an exception, so that it isn't returned to the pool.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except Exception:
+            self.connection_failed = True
+            raise
+    return wrapper
+
+
 class SshTransport(Transport):
     """
     Archives artifacts using ssh.
@@ -182,6 +460,15 @@ class SshTransport(Transport):
             ssh_client.get_transport())
         return ssh_client, sftp_client
 
+    def _get_pool_key(self):
+        """
+        Connections are shared by transports for the same archive, unless
+        the details used to connect have changed.
+        """
+        return (self.archive.pk, self.archive.host, self.archive.username,
+                self.archive.ssh_credentials_id)
+
+    @discard_connection_on_error
     def _run_command(self, command):
         """
         Runs a command over the ssh connection, makes sure it finishes.
@@ -192,27 +479,44 @@ class SshTransport(Transport):
 
     def start(self):
         """
-        Opens the ssh connection.
+        Takes an ssh connection from the pool, connecting if there are no
+        healthy connections to the archive.
         """
-        self.ssh_client, self.sftp_client = self._get_ssh_clients()
+        self.connection = ssh_pool.acquire(
+            self._get_pool_key(), self._get_ssh_clients)
+        self.ssh_client = self.connection.ssh_client
+        self.sftp_client = self.connection.sftp_client
+        self.connection_failed = False
 
     def end(self):
         """
-        Closes the ssh connection.
+        Returns the ssh connection to the pool, or closes it if an operation
+        on it failed.
         """
-        self.ssh_client.close()
+        ssh_pool.release(
+            self._get_pool_key(), self.connection,
+            discard=self.connection_failed)
 
-    def archive_file(self, fileobj, filename):
+    @discard_connection_on_error
+    def archive_file(self, fileobj, filename, checksums=None):
         """
         Uploads the artifact_url to the destination on
         the remote server, underneath the target's basedir.
         """
         destination = self.get_relative_filename(filename)
-        self._run_command("mkdir -p `dirname %s`" % destination)
-        # TODO: raise exception if the command fails
+        self._make_directory(os.path.dirname(destination))
         logging.info(
             "SshTransport archiving artifact to %s", filename)
-        return self.sftp_client.stream_file_to_remote(fileobj, destination)
+        return self.sftp_client.stream_file_to_remote(
+            fileobj, destination, checksums=checksums)
+
+    @discard_connection_on_error
+    def _make_directory(self, directory):
+        """
+        Creates the directory over SFTP, unless it's already known to exist
+        for the connection.
+        """
+        self.sftp_client.makedirs(directory)
 
     def link_filename_to_filename(self, source, destination):
         """
@@ -223,9 +527,32 @@ class SshTransport(Transport):
 
         # TODO: Use the return value from the call to work out if we were
         # successful or not.
-        self._run_command("mkdir -p `dirname %s`" % destination)
+        self._make_directory(os.path.dirname(destination))
         self._run_command("ln \"%s\" \"%s\"" % (source, destination))
 
+    def store_blob(self, filename, sha256):
+        """
+        Makes the archived filename a link to the blob for its content,
+        storing it as the blob if there isn't one already.
+        """
+        blob = self.get_relative_filename(self.get_blob_path(sha256))
+        filename = self.get_relative_filename(filename)
+        self._make_directory(os.path.dirname(blob))
+        self._run_command(
+            "if [ -e \"%(blob)s\" ]; "
+            "then ln -f \"%(blob)s\" \"%(filename)s\"; "
+            "else ln \"%(filename)s\" \"%(blob)s\"; fi" % {
+                "blob": blob, "filename": filename})
+
+    def link_blob(self, sha256, filename):
+        """
+        Links the filename to the existing blob for the sha256.
+        """
+        blob = self.get_relative_filename(self.get_blob_path(sha256))
+        filename = self.get_relative_filename(filename)
+        self._make_directory(os.path.dirname(filename))
+        self._run_command("ln -f \"%s\" \"%s\"" % (blob, filename))
+
     def link_to_current(self, path):
         """
         Link the path to the "current" directory in the parent directory.
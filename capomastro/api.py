@@ -1,13 +1,83 @@
+from datetime import timedelta
+
+from django.core.exceptions import ValidationError
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
 
 from rest_framework import viewsets, routers, serializers
-from rest_framework.decorators import action
+from rest_framework.decorators import action, link, list_route
+from rest_framework.exceptions import ParseError
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 
-from jenkins.models import JenkinsServer, Job, JobType, Build, Artifact
-from projects.models import Project, Dependency
+from capomastro.pagination import KeysetPaginator
+from jenkins.models import (
+    JenkinsServer, Job, JobType, Build, Artifact, JobDailyStats)
+from jenkins.stats import get_duration_trends
+from jenkins.priorities import API
+from projects.models import (
+    Project, Dependency, ProjectBuild, ProjectBuildArtifact)
 from projects.helpers import build_dependency
+from projects.utils import get_queue_wait_by_priority
+
+
+class KeysetPaginationMixin(object):
+    """
+    Paginates the list of objects using a KeysetPaginator, the next and
+    previous links use opaque "after" and "before" cursors.
+
+    The queryset can be filtered by passing any of the filter_fields as query
+    parameters, invalid values are rejected with a 400.
+    """
+    keyset_ordering = None
+    page_size = 20
+    filter_fields = ()
+
+    def get_queryset(self):
+        queryset = super(KeysetPaginationMixin, self).get_queryset()
+        filters = {}
+        for name in self.filter_fields:
+            value = self.request.QUERY_PARAMS.get(name)
+            if not value:
+                continue
+            field = queryset.model._meta.get_field(name)
+            if field.rel:
+                field = field.rel.get_related_field()
+            try:
+                filters[name] = field.to_python(value)
+            except ValidationError:
+                raise ParseError("Invalid value for %s: %s" % (name, value))
+        return queryset.filter(**filters)
+
+    def get_page_url(self, key, cursor):
+        """
+        Returns the URL to the page identified by the cursor.
+        """
+        if cursor is None:
+            return
+        params = self.request.QUERY_PARAMS.copy()
+        params.pop("after", None)
+        params.pop("before", None)
+        params[key] = cursor
+        return self.request.build_absolute_uri(
+            "%s?%s" % (self.request.path, params.urlencode()))
+
+    def list(self, request, *args, **kwargs):
+        paginator = KeysetPaginator(
+            self.filter_queryset(self.get_queryset()), self.keyset_ordering,
+            self.page_size)
+        page = paginator.page(
+            after=request.QUERY_PARAMS.get("after"),
+            before=request.QUERY_PARAMS.get("before"))
+        serializer = self.get_serializer(page.object_list, many=True)
+        return Response({
+            "count": paginator.count,
+            "count_is_approximate": paginator.count_is_approximate,
+            "count_is_truncated": paginator.count_is_truncated,
+            "next": self.get_page_url("after", page.next_cursor),
+            "previous": self.get_page_url("before", page.previous_cursor),
+            "results": serializer.data,
+        })
 
 
 class JenkinsServerViewSet(viewsets.ModelViewSet):
@@ -34,8 +104,54 @@ class JobTypeViewSet(viewsets.ModelViewSet):
     serializer_class = JobTypeSerializer
 
 
-class BuildViewSet(viewsets.ModelViewSet):
+class BuildViewSet(KeysetPaginationMixin, viewsets.ModelViewSet):
     model = Build
+    keyset_ordering = ("-number", "-id")
+    filter_fields = ("job",)
+
+
+class JobDailyStatsSerializer(serializers.ModelSerializer):
+
+    success_rate = serializers.Field()
+
+    class Meta:
+        model = JobDailyStats
+        exclude = ("duration_histogram", "queue_time_histogram")
+
+
+class JobDailyStatsViewSet(
+        KeysetPaginationMixin, viewsets.ReadOnlyModelViewSet):
+    model = JobDailyStats
+    serializer_class = JobDailyStatsSerializer
+    keyset_ordering = ("-date", "-id")
+    filter_fields = ("job", "date")
+
+    def get_days(self, request):
+        """
+        Returns the number of days requested, defaulting to 7.
+        """
+        try:
+            return max(int(request.QUERY_PARAMS.get("days", 7)), 1)
+        except ValueError:
+            raise ParseError("Invalid number of days")
+
+    @list_route()
+    def trends(self, request):
+        """
+        Compares the median build durations of the jobs over the last "days"
+        days (defaulting to 7) with the preceding period.
+        """
+        return Response(get_duration_trends(days=self.get_days(request)))
+
+    @list_route()
+    def queue_waits(self, request):
+        """
+        Returns the number of dependency builds, and the average and maximum
+        seconds they waited to start, for each priority class of the
+        ProjectBuilds requested in the last "days" days (defaulting to 7).
+        """
+        since = timezone.now() - timedelta(days=self.get_days(request))
+        return Response(get_queue_wait_by_priority(since=since))
 
 
 class ArtifactViewSet(viewsets.ModelViewSet):
@@ -46,6 +162,31 @@ class ProjectViewSet(viewsets.ModelViewSet):
     model = Project
 
 
+class ProjectBuildArtifactSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = ProjectBuildArtifact
+        fields = (
+            "artifact", "build", "filename", "url", "size", "checksum",
+            "archive_url")
+
+
+class ProjectBuildViewSet(KeysetPaginationMixin, viewsets.ModelViewSet):
+    model = ProjectBuild
+    keyset_ordering = ("-requested_at", "-id")
+    filter_fields = ("project",)
+
+    @link()
+    def manifest(self, request, pk=None):
+        """
+        Returns the manifest of the artifacts for the ProjectBuild.
+        """
+        projectbuild = get_object_or_404(ProjectBuild, pk=pk)
+        serializer = ProjectBuildArtifactSerializer(
+            projectbuild.manifest.all(), many=True)
+        return Response(serializer.data)
+
+
 class DependencyViewSet(viewsets.ModelViewSet):
     model = Dependency
 
@@ -59,7 +200,7 @@ class DependencyViewSet(viewsets.ModelViewSet):
         """
         dependency = get_object_or_404(Dependency, pk=pk)
         if not dependency.is_building:
-            build_dependency(dependency)
+            build_dependency(dependency, priority=API)
         return Response("", status=202)
 
 router = routers.DefaultRouter()
@@ -67,6 +208,8 @@ router.register(r"servers", JenkinsServerViewSet)
 router.register(r"jobs", JobViewSet)
 router.register(r"jobtypes", JobTypeViewSet)
 router.register(r"builds", BuildViewSet)
+router.register(r"jobstats", JobDailyStatsViewSet)
 router.register(r"artifacts", ArtifactViewSet)
 router.register(r"projects", ProjectViewSet)
+router.register(r"projectbuilds", ProjectBuildViewSet)
 router.register(r"dependencies", DependencyViewSet)
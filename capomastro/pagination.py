@@ -0,0 +1,269 @@
+import base64
+import binascii
+import datetime
+import json
+
+from django.db import connection
+from django.db.models import Q
+
+from jenkins.utils import DefaultSettings
+
+
+pagination_settings = DefaultSettings({
+    "PAGINATION_COUNT_LIMIT": 1000,
+})
+
+
+class InvalidCursor(Exception):
+    """
+    Raised when a pagination cursor can't be decoded.
+    """
+
+
+def encode_cursor(values):
+    """
+    Encodes the list of values as an opaque string for use in URLs.
+    """
+    values = [x.isoformat() if isinstance(x, datetime.datetime) else x
+              for x in values]
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+
+def decode_cursor(cursor, fields):
+    """
+    Decodes a cursor created by encode_cursor, converting the values with the
+    model fields they were taken from.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError, binascii.Error, UnicodeEncodeError):
+        raise InvalidCursor(cursor)
+    if not isinstance(values, list) or len(values) != len(fields):
+        raise InvalidCursor(cursor)
+    try:
+        return [field.to_python(value) for field, value in zip(
+            fields, values)]
+    except Exception:
+        raise InvalidCursor(cursor)
+
+
+def get_keyset_filter(ordering, values, reverse=False):
+    """
+    Returns a Q object that selects the rows that come after the values in
+    the ordering, or before the values if reverse is True.
+
+    e.g. for ordering ["-requested_at", "-id"], this generates
+
+      requested_at < X OR (requested_at = X AND id < Y)
+    """
+    keyset_filter = None
+    for index, field in enumerate(ordering):
+        name = field.lstrip("-")
+        descending = field.startswith("-") != reverse
+        clause = Q(**{"%s__%s" % (name, descending and "lt" or "gt"):
+                      values[index]})
+        for previous_field, value in zip(ordering[:index], values[:index]):
+            clause &= Q(**{previous_field.lstrip("-"): value})
+        if keyset_filter is None:
+            keyset_filter = clause
+        else:
+            keyset_filter |= clause
+    return keyset_filter
+
+
+def reverse_ordering(ordering):
+    """
+    Returns the ordering with the direction of each field reversed.
+    """
+    return [x[1:] if x.startswith("-") else "-" + x for x in ordering]
+
+
+class KeysetPage(object):
+    """
+    A page of objects from a KeysetPaginator.
+    """
+    def __init__(self, object_list, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __repr__(self):
+        return "<KeysetPage of %d objects>" % len(self)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    @property
+    def next_cursor(self):
+        """
+        The cursor to request the page that follows this one.
+        """
+        if self.has_next() and self.object_list:
+            return self.paginator.get_cursor(self.object_list[-1])
+
+    @property
+    def previous_cursor(self):
+        """
+        The cursor to request the page that precedes this one.
+        """
+        if self.has_previous() and self.object_list:
+            return self.paginator.get_cursor(self.object_list[0])
+
+
+class KeysetPaginator(object):
+    """
+    Paginates a QuerySet by filtering on the values of the ordering fields
+    for the last (or first) object on the current page, rather than using an
+    OFFSET.
+
+    The ordering fields must uniquely identify a row, and there should be an
+    index on them, e.g. ("-requested_at", "-id").
+    """
+    def __init__(self, queryset, ordering, per_page):
+        self.queryset = queryset
+        self.ordering = list(ordering)
+        self.per_page = per_page
+        self._count = None
+        self._count_is_approximate = False
+        self._count_is_truncated = False
+        self.fields = [
+            queryset.model._meta.get_field(x.lstrip("-"))
+            for x in self.ordering]
+
+    def __getstate__(self):
+        """
+        Pages can be cached along with their paginator, so we count the
+        objects up front rather than pickling (and evaluating) the QuerySet.
+        """
+        self.count
+        state = self.__dict__.copy()
+        state["queryset"] = None
+        return state
+
+    def get_cursor(self, obj):
+        """
+        Returns the cursor which identifies the position of obj.
+        """
+        return encode_cursor(
+            [getattr(obj, field.attname) for field in self.fields])
+
+    def _fetch(self, queryset, ordering):
+        """
+        Returns one more than a page of objects so that we know whether or not
+        there are more.
+        """
+        objects = list(queryset.order_by(*ordering)[:self.per_page + 1])
+        return objects[:self.per_page], len(objects) > self.per_page
+
+    def first_page(self):
+        objects, has_next = self._fetch(self.queryset, self.ordering)
+        return KeysetPage(objects, self, has_next, False)
+
+    def last_page(self):
+        objects, has_previous = self._fetch(
+            self.queryset, reverse_ordering(self.ordering))
+        return KeysetPage(
+            list(reversed(objects)), self, False, has_previous)
+
+    def page(self, after=None, before=None):
+        """
+        Returns the page of objects following the after cursor, or preceding
+        the before cursor.
+
+        Invalid cursors return the first page, and if there are no objects
+        after the cursor we return the last page.
+        """
+        try:
+            if after:
+                values = decode_cursor(after, self.fields)
+                objects, has_next = self._fetch(
+                    self.queryset.filter(
+                        get_keyset_filter(self.ordering, values)),
+                    self.ordering)
+                if not objects:
+                    return self.last_page()
+                return KeysetPage(objects, self, has_next, True)
+            if before:
+                values = decode_cursor(before, self.fields)
+                objects, has_previous = self._fetch(
+                    self.queryset.filter(
+                        get_keyset_filter(self.ordering, values, True)),
+                    reverse_ordering(self.ordering))
+                if not objects:
+                    return self.first_page()
+                return KeysetPage(
+                    list(reversed(objects)), self, True, has_previous)
+        except InvalidCursor:
+            pass
+        return self.first_page()
+
+    @property
+    def count(self):
+        """
+        Returns the number of objects, counting at most PAGINATION_COUNT_LIMIT
+        rows.
+
+        Beyond that the count is estimated where possible, otherwise it's
+        PAGINATION_COUNT_LIMIT and there are more objects than that.
+        """
+        if self._count is None:
+            limit = pagination_settings.PAGINATION_COUNT_LIMIT
+            count = self.queryset[:limit + 1].count()
+            if count > limit:
+                estimate = self.estimate_count()
+                if estimate is not None and estimate > limit:
+                    count = estimate
+                    self._count_is_approximate = True
+                else:
+                    count = limit
+                    self._count_is_truncated = True
+            self._count = count
+        return self._count
+
+    @property
+    def count_is_approximate(self):
+        """
+        Returns True if count is an estimate rather than the exact number.
+        """
+        self.count
+        return self._count_is_approximate
+
+    @property
+    def count_is_truncated(self):
+        """
+        Returns True if there are more objects than the count, which can't be
+        estimated.
+        """
+        self.count
+        return self._count_is_truncated
+
+    def estimate_count(self):
+        """
+        Returns the query planner's estimate of the number of rows for the
+        QuerySet, or None if the database doesn't provide one.
+        """
+        if connection.vendor != "postgresql":
+            return None
+        sql, params = self.queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
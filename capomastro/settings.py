@@ -10,6 +10,9 @@ https://docs.djangoproject.com/en/1.6/ref/settings/
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
+from datetime import timedelta
+
+from kombu import Exchange, Queue
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 
 
@@ -113,13 +116,48 @@ REST_FRAMEWORK = {
 
 SITE_ID = 1
 
+# The artifacts of a build are archived by a chord, which needs a result
+# backend to run its callback. The amqp backend creates a queue for each
+# result, so only the tasks in the chord's header store their results.
+CELERY_RESULT_BACKEND = "amqp"
+CELERY_IGNORE_RESULT = True
+
+# Builds are queued in the builds queue, which RabbitMQ only orders by the
+# message priority if it's declared with x-max-priority, this must be at
+# least the highest of the CELERY_BUILD_PRIORITIES.
+#
+# Artifacts are copied to the archives by the workers consuming the archives
+# queue, the concurrency of these workers bounds the number of transfers at
+# once, whatever the number of builds being archived.
+CELERY_QUEUES = (
+    Queue("celery", Exchange("celery"), routing_key="celery"),
+    Queue("builds", Exchange("builds"), routing_key="builds",
+          queue_arguments={"x-max-priority": 9}),
+    Queue("archives", Exchange("archives"), routing_key="archives"),
+)
+CELERY_ROUTES = {
+    "jenkins.tasks.build_job": {"queue": "builds"},
+    "archives.tasks.archive_artifact_from_jenkins": {"queue": "archives"},
+    "archives.tasks.archive_artifact_to_archives": {"queue": "archives"},
+    "archives.tasks.link_artifact_in_archive": {"queue": "archives"},
+}
+
 try:
     from local_settings import *  # noqa
 except ImportError, e:
     pass
 
-from archives.tasks import process_build_artifacts, generate_checksums
+from archives.tasks import process_build_artifacts
 from projects.tasks import process_build_dependencies, send_email_to_requestor
 
+# process_build_artifacts generates the checksums once the artifacts have been
+# archived.
 POST_BUILD_TASKS = [process_build_dependencies, process_build_artifacts,
-                    generate_checksums, send_email_to_requestor]
+                    send_email_to_requestor]
+
+CELERYBEAT_SCHEDULE = {
+    "queue-scheduled-builds": {
+        "task": "projects.tasks.queue_scheduled_builds",
+        "schedule": timedelta(minutes=1),
+    },
+}
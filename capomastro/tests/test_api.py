@@ -1,13 +1,21 @@
+from datetime import date, timedelta
+
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User, Permission
+from django.utils import timezone
 
 from rest_framework import status
 from rest_framework.test import APITestCase
 
 import mock
 
-from jenkins.tests.factories import JobTypeWithParamsFactory, BuildFactory
-from projects.tests.factories import DependencyFactory
+from jenkins.models import JobDailyStats
+from jenkins.priorities import API
+from jenkins.tests.factories import (
+    JobTypeWithParamsFactory, JobFactory, BuildFactory, ArtifactFactory)
+from projects.models import (
+    ProjectBuild, ProjectBuildArtifact, ProjectBuildDependency)
+from projects.tests.factories import DependencyFactory, ProjectBuildFactory
 
 
 class JobTypeAPITest(APITestCase):
@@ -51,8 +59,8 @@ class DependencyBuildAPITest(APITestCase):
             response = self.client.post(url)
 
         self.assertEqual(status.HTTP_202_ACCEPTED, response.status_code)
-        build_job_mock.delay.assert_called_once_with(
-            dependency.job.pk)
+        build_job_mock.apply_async.assert_called_once_with(
+            (dependency.job.pk,), {"priority": API}, priority=6)
 
     def test_build_dependency_already_building(self):
         """
@@ -68,4 +76,162 @@ class DependencyBuildAPITest(APITestCase):
             response = self.client.post(url)
 
         self.assertEqual(status.HTTP_202_ACCEPTED, response.status_code)
-        self.assertFalse(build_job_mock.delay.called)
+        self.assertFalse(build_job_mock.apply_async.called)
+
+
+class BuildAPITest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("testing")
+
+    def test_builds_are_paginated(self):
+        """
+        The builds for a job are paginated with cursors.
+        """
+        self.client.force_authenticate(user=self.user)
+        builds = BuildFactory.create_batch(25)
+        job_builds = BuildFactory.create_batch(21, job=builds[0].job)
+
+        url = reverse("build-list")
+        response = self.client.get(url, {"job": builds[0].job.pk})
+
+        self.assertEqual(22, response.data["count"])
+        self.assertFalse(response.data["count_is_approximate"])
+        self.assertEqual(20, len(response.data["results"]))
+        self.assertIsNone(response.data["previous"])
+        self.assertEqual(
+            job_builds[-1].build_id, response.data["results"][0]["build_id"])
+
+        response = self.client.get(response.data["next"])
+        self.assertEqual(
+            [job_builds[0].build_id, builds[0].build_id],
+            [x["build_id"] for x in response.data["results"]])
+        self.assertIsNone(response.data["next"])
+        self.assertIsNotNone(response.data["previous"])
+
+    def test_builds_with_invalid_filter(self):
+        """
+        Invalid values for the filters are rejected.
+        """
+        self.client.force_authenticate(user=self.user)
+
+        url = reverse("build-list")
+        response = self.client.get(url, {"job": "abc"})
+
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+
+class JobDailyStatsAPITest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("testing")
+
+    def test_job_stats(self):
+        """
+        The daily stats can be filtered by job, without the histograms.
+        """
+        self.client.force_authenticate(user=self.user)
+        job = JobFactory.create()
+        JobDailyStats.objects.create(
+            job=JobFactory.create(), date=date(2014, 6, 6))
+        JobDailyStats.objects.create(
+            job=job, date=date(2014, 6, 6), build_count=4, success_count=3,
+            duration_p50=1000, duration_histogram={"73": 1})
+
+        url = reverse("jobdailystats-list")
+        response = self.client.get(url, {"job": job.pk})
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        [stats] = response.data["results"]
+        self.assertEqual(0.75, stats["success_rate"])
+        self.assertEqual(1000, stats["duration_p50"])
+        self.assertNotIn("duration_histogram", stats)
+        self.assertNotIn("queue_time_histogram", stats)
+
+    def test_job_stats_with_invalid_date(self):
+        """
+        An invalid date to filter the stats is rejected.
+        """
+        self.client.force_authenticate(user=self.user)
+
+        url = reverse("jobdailystats-list")
+        response = self.client.get(url, {"date": "2014-13-45"})
+
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_job_stats_trends(self):
+        """
+        The trends of the build durations are available from the API.
+        """
+        self.client.force_authenticate(user=self.user)
+        job = JobFactory.create()
+        JobDailyStats.objects.create(
+            job=job, date=timezone.now().date(), build_count=1,
+            success_count=1, duration_p50=1000)
+
+        url = reverse("jobdailystats-trends")
+        response = self.client.get(url, {"days": "3"})
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(
+            [{"job": job.pk, "builds": 1, "success_rate": 1.0,
+              "duration": 1000, "queue_time": None,
+              "previous_duration": None, "change": None}],
+            response.data)
+        response = self.client.get(url, {"days": "x"})
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_job_stats_queue_waits(self):
+        """
+        The queue waits of the dependency builds of recent projectbuilds are
+        available by priority from the API.
+        """
+        self.client.force_authenticate(user=self.user)
+        dependency = DependencyFactory.create()
+        for age, queue_wait in [(0, 10), (0, 20), (10, 300)]:
+            projectbuild = ProjectBuildFactory.create(priority=API)
+            ProjectBuild.objects.filter(pk=projectbuild.pk).update(
+                requested_at=timezone.now() - timedelta(days=age))
+            ProjectBuildDependency.objects.create(
+                projectbuild=projectbuild, dependency=dependency,
+                queue_wait=queue_wait)
+
+        url = reverse("jobdailystats-queue-waits")
+        response = self.client.get(url, {"days": "3"})
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(
+            {API: {"count": 2, "average": 15, "maximum": 20}}, response.data)
+        response = self.client.get(url, {"days": "x"})
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+
+class ProjectBuildAPITest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("testing")
+
+    def test_projectbuild_manifest(self):
+        """
+        The manifest of the artifacts for a projectbuild is available.
+        """
+        self.client.force_authenticate(user=self.user)
+        projectbuild = ProjectBuildFactory.create()
+        artifact = ArtifactFactory.create(filename="file1.gz")
+        ProjectBuildArtifact.objects.create(
+            projectbuild=projectbuild, artifact=artifact,
+            build=artifact.build, filename=artifact.filename,
+            url=artifact.url, size=1024,
+            archive_url="http://example.com/file1.gz")
+
+        url = reverse(
+            "projectbuild-manifest", kwargs={"pk": projectbuild.pk})
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(
+            [{"artifact": artifact.pk, "build": artifact.build.pk,
+              "filename": "file1.gz", "url": artifact.url, "size": 1024,
+              "checksum": "", "archive_url": "http://example.com/file1.gz"}],
+            response.data)
@@ -0,0 +1,146 @@
+from __future__ import unicode_literals
+
+from datetime import timedelta
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+import mock
+
+from capomastro.pagination import (
+    KeysetPaginator, encode_cursor, decode_cursor, InvalidCursor)
+from jenkins.models import Build
+from jenkins.tests.factories import JobFactory, BuildFactory
+from projects.models import ProjectBuild
+from projects.tests.factories import ProjectFactory, ProjectBuildFactory
+
+
+class CursorTest(TestCase):
+
+    def test_encode_and_decode_cursor(self):
+        """
+        The cursor should roundtrip the values, converting them with the model
+        fields.
+        """
+        fields = [ProjectBuild._meta.get_field("requested_at"),
+                  ProjectBuild._meta.get_field("id")]
+        now = timezone.now()
+
+        self.assertEqual(
+            [now, 23], decode_cursor(encode_cursor([now, 23]), fields))
+
+    def test_decode_invalid_cursor(self):
+        """
+        Invalid cursors should raise InvalidCursor.
+        """
+        fields = [Build._meta.get_field("number")]
+        for cursor in ["abc", encode_cursor([1, 2]), encode_cursor(["a"])]:
+            self.assertRaises(InvalidCursor, decode_cursor, cursor, fields)
+
+
+class KeysetPaginatorTest(TestCase):
+
+    def setUp(self):
+        self.job = JobFactory.create()
+        self.builds = BuildFactory.create_batch(7, job=self.job)
+        self.paginator = KeysetPaginator(
+            Build.objects.filter(job=self.job), ("-number", "-id"), 3)
+
+    def test_first_page(self):
+        """
+        Without a cursor we should get the first page.
+        """
+        page = self.paginator.page()
+
+        self.assertEqual(
+            [self.builds[6], self.builds[5], self.builds[4]], list(page))
+        self.assertTrue(page.has_next())
+        self.assertFalse(page.has_previous())
+        self.assertIsNone(page.previous_cursor)
+
+    def test_following_pages(self):
+        """
+        We can follow the next_cursor to the end of the objects.
+        """
+        page = self.paginator.page(after=self.paginator.page().next_cursor)
+        self.assertEqual(
+            [self.builds[3], self.builds[2], self.builds[1]], list(page))
+        self.assertTrue(page.has_next())
+        self.assertTrue(page.has_previous())
+
+        page = self.paginator.page(after=page.next_cursor)
+        self.assertEqual([self.builds[0]], list(page))
+        self.assertFalse(page.has_next())
+        self.assertIsNone(page.next_cursor)
+
+    def test_previous_pages(self):
+        """
+        We can follow the previous_cursor back to the start of the objects.
+        """
+        page = self.paginator.page(after=self.paginator.page().next_cursor)
+        page = self.paginator.page(before=page.previous_cursor)
+
+        self.assertEqual(
+            [self.builds[6], self.builds[5], self.builds[4]], list(page))
+        self.assertFalse(page.has_previous())
+        self.assertTrue(page.has_next())
+
+    def test_pages_use_a_single_query(self):
+        """
+        Fetching a page shouldn't count the objects.
+        """
+        cursor = self.paginator.page().next_cursor
+        with self.assertNumQueries(1):
+            list(self.paginator.page(after=cursor))
+
+    def test_ordering_with_ties(self):
+        """
+        Objects with the same value in the first ordering field should be
+        paginated by the second field.
+        """
+        project = ProjectFactory.create()
+        requested_at = timezone.now() - timedelta(days=1)
+        projectbuilds = [
+            ProjectBuildFactory.create(project=project) for x in range(5)]
+        ProjectBuild.objects.filter(project=project).update(
+            requested_at=requested_at)
+        paginator = KeysetPaginator(
+            ProjectBuild.objects.filter(project=project),
+            ("-requested_at", "-id"), 2)
+
+        pages = [paginator.page()]
+        while pages[-1].has_next():
+            pages.append(paginator.page(after=pages[-1].next_cursor))
+
+        self.assertEqual(
+            list(reversed(projectbuilds)), [x for p in pages for x in p])
+
+    def test_count(self):
+        """
+        The count is exact when below the PAGINATION_COUNT_LIMIT.
+        """
+        self.assertEqual(7, self.paginator.count)
+        self.assertFalse(self.paginator.count_is_approximate)
+
+    @override_settings(PAGINATION_COUNT_LIMIT=5)
+    def test_count_above_limit(self):
+        """
+        Above the PAGINATION_COUNT_LIMIT, the count is the database's
+        estimate.
+        """
+        with mock.patch.object(
+                self.paginator, "estimate_count", return_value=100):
+            self.assertEqual(100, self.paginator.count)
+        self.assertTrue(self.paginator.count_is_approximate)
+        self.assertFalse(self.paginator.count_is_truncated)
+
+    @override_settings(PAGINATION_COUNT_LIMIT=5)
+    def test_count_above_limit_without_estimate(self):
+        """
+        If the database can't estimate the count, it's truncated to the
+        PAGINATION_COUNT_LIMIT.
+        """
+        self.assertEqual(5, self.paginator.count)
+        self.assertFalse(self.paginator.count_is_approximate)
+        self.assertTrue(self.paginator.count_is_truncated)
@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from jenkins.models import JenkinsServer, Job, Build, Artifact, JobType
+from jenkins.models import (
+    JenkinsServer, Job, Build, Artifact, JobType, JobDailyStats)
 
 
 class BuildAdmin(admin.ModelAdmin):
@@ -10,8 +11,15 @@ class BuildAdmin(admin.ModelAdmin):
     search_fields = ("build_id", "job")
 
 
+class JobDailyStatsAdmin(admin.ModelAdmin):
+    list_display = ("job", "date", "build_count", "duration_p50",
+                    "duration_p95")
+    list_filter = ("date",)
+
+
 admin.site.register(JenkinsServer)
 admin.site.register(Job)
 admin.site.register(JobType)
 admin.site.register(Build, BuildAdmin)
 admin.site.register(Artifact)
+admin.site.register(JobDailyStats, JobDailyStatsAdmin)
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jenkins', '0002_build_job_phase_index'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='build',
+            index_together=set([('job', 'phase'), ('job', 'number')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jenkins', '0003_build_job_number_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='build',
+            name='reuse_key',
+            field=models.CharField(default=b'', max_length=40, editable=False, db_index=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import jenkins.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jenkins', '0005_build_phase_timestamps'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobDailyStats',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('date', models.DateField()),
+                ('build_count', models.PositiveIntegerField(default=0)),
+                ('success_count', models.PositiveIntegerField(default=0)),
+                ('duration_p50', models.PositiveIntegerField(null=True, blank=True)),
+                ('duration_p95', models.PositiveIntegerField(null=True, blank=True)),
+                ('queue_time_p50', models.PositiveIntegerField(null=True, blank=True)),
+                ('queue_time_p95', models.PositiveIntegerField(null=True, blank=True)),
+                ('samples', jenkins.fields.JSONField(null=True, editable=False, blank=True)),
+                ('job', models.ForeignKey(related_name='daily_stats', to='jenkins.Job')),
+            ],
+            options={
+                'ordering': ['-date', 'job'],
+                'verbose_name_plural': 'job daily stats',
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='jobdailystats',
+            unique_together=set([('job', 'date')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='jobdailystats',
+            index_together=set([('date', 'job')]),
+        ),
+    ]
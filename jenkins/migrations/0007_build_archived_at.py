@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jenkins', '0006_jobdailystats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='build',
+            name='archived_at',
+            field=models.DateTimeField(null=True, editable=False, blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jenkins', '0007_build_archived_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='artifact',
+            name='fingerprint',
+            field=models.CharField(default=b'', max_length=32, blank=True),
+            preserve_default=True,
+        ),
+    ]
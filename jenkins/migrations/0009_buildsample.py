@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import jenkins.fields
+from jenkins.stats import add_sample, update_rollup
+
+
+def populate_samples(apps, schema_editor):
+    """
+    Move the samples recorded for each build into BuildSamples, and count
+    them in the histograms.
+    """
+    JobDailyStats = apps.get_model("jenkins", "JobDailyStats")
+    BuildSample = apps.get_model("jenkins", "BuildSample")
+    Build = apps.get_model("jenkins", "Build")
+    for stats in JobDailyStats.objects.exclude(samples=None):
+        build_pks = set(Build.objects.filter(
+            pk__in=stats.samples.keys()).values_list("pk", flat=True))
+        stats.build_count = stats.success_count = 0
+        for build_pk, values in stats.samples.items():
+            if int(build_pk) not in build_pks:
+                continue
+            sample = BuildSample.objects.create(
+                build_id=build_pk, stats=stats,
+                duration=values.get("duration"),
+                success=bool(values.get("success")),
+                queue_time=values.get("queue_time"))
+            add_sample(stats, sample)
+        update_rollup(stats)
+        stats.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jenkins', '0008_artifact_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BuildSample',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('duration', models.PositiveIntegerField(null=True, blank=True)),
+                ('success', models.BooleanField(default=False)),
+                ('queue_time', models.PositiveIntegerField(null=True, blank=True)),
+                ('build', models.OneToOneField(related_name='sample', to='jenkins.Build')),
+                ('stats', models.ForeignKey(related_name='build_samples', to='jenkins.JobDailyStats')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AddField(
+            model_name='jobdailystats',
+            name='duration_histogram',
+            field=jenkins.fields.JSONField(null=True, editable=False, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='jobdailystats',
+            name='queue_time_histogram',
+            field=jenkins.fields.JSONField(null=True, editable=False, blank=True),
+            preserve_default=True,
+        ),
+        migrations.RunPython(populate_samples),
+        migrations.RemoveField(
+            model_name='jobdailystats',
+            name='samples',
+        ),
+    ]
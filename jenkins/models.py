@@ -1,3 +1,5 @@
+from datetime import timedelta
+
 from django.core.urlresolvers import reverse
 from django.db import models
 from django.utils.encoding import python_2_unicode_compatible
@@ -82,9 +84,17 @@ class Build(models.Model):
     parameters = fields.JSONField(blank=True, null=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     requested_by = models.ForeignKey(User, null=True, editable=False, blank=True)
+    reuse_key = models.CharField(
+        max_length=40, blank=True, default="", editable=False, db_index=True)
+    # The times we were notified that the build STARTED and was FINALIZED.
+    started_at = models.DateTimeField(null=True, blank=True, editable=False)
+    finalized_at = models.DateTimeField(null=True, blank=True, editable=False)
+    # Set when all the artifacts have been copied to the default archive.
+    archived_at = models.DateTimeField(null=True, blank=True, editable=False)
 
     class Meta:
         ordering = ["-number"]
+        index_together = [("job", "phase"), ("job", "number")]
 
     def __str__(self):
         return self.build_id or "%s %s" % (self.job, self.number)
@@ -98,6 +108,25 @@ class Build(models.Model):
             return Build.FINALIZED
         return phase
 
+    def get_start_time(self):
+        """
+        Returns the time the build started, builds recorded before we kept
+        the notification times were created when they started.
+        """
+        return self.started_at or self.created_at
+
+    def get_end_time(self):
+        """
+        Returns the time the build was FINALIZED, or the start time plus the
+        duration reported by Jenkins if we weren't notified, or None if the
+        build hasn't finished.
+        """
+        if self.finalized_at is not None:
+            return self.finalized_at
+        if self.duration is not None:
+            return self.get_start_time() + timedelta(
+                milliseconds=self.duration)
+
     @property
     def console_log_summary(self):
         """
@@ -124,6 +153,63 @@ class Artifact(models.Model):
     build = models.ForeignKey(Build)
     filename = models.CharField(max_length=255)
     url = models.CharField(max_length=255)
+    # The MD5 fingerprint Jenkins recorded for the artifact, if any.
+    fingerprint = models.CharField(max_length=32, blank=True, default="")
 
     def __str__(self):
         return "%s for %s" % (self.filename, self.build)
+
+
+@python_2_unicode_compatible
+class JobDailyStats(models.Model):
+    """
+    Daily rollup of the builds of a Job, see jenkins.stats.
+
+    The durations and queue times are counted in fixed-size histograms, so
+    that adding a build doesn't need the other builds of the day, and the
+    percentiles are estimated from them.
+    """
+    job = models.ForeignKey(Job, related_name="daily_stats")
+    date = models.DateField()
+    build_count = models.PositiveIntegerField(default=0)
+    success_count = models.PositiveIntegerField(default=0)
+    # Durations are in milliseconds, as reported by Jenkins.
+    duration_p50 = models.PositiveIntegerField(null=True, blank=True)
+    duration_p95 = models.PositiveIntegerField(null=True, blank=True)
+    # Queue times are in seconds, see ProjectBuildDependency.queue_wait.
+    queue_time_p50 = models.PositiveIntegerField(null=True, blank=True)
+    queue_time_p95 = models.PositiveIntegerField(null=True, blank=True)
+    duration_histogram = fields.JSONField(
+        blank=True, null=True, editable=False)
+    queue_time_histogram = fields.JSONField(
+        blank=True, null=True, editable=False)
+
+    class Meta:
+        ordering = ["-date", "job"]
+        unique_together = [("job", "date")]
+        index_together = [("date", "job")]
+        verbose_name_plural = "job daily stats"
+
+    def __str__(self):
+        return "%s on %s" % (self.job, self.date)
+
+    @property
+    def success_rate(self):
+        if self.build_count:
+            return float(self.success_count) / self.build_count
+
+
+@python_2_unicode_compatible
+class BuildSample(models.Model):
+    """
+    The values of a build counted in the JobDailyStats, so that they can be
+    replaced when the build is imported more than once.
+    """
+    build = models.OneToOneField(Build, related_name="sample")
+    stats = models.ForeignKey(JobDailyStats, related_name="build_samples")
+    duration = models.PositiveIntegerField(null=True, blank=True)
+    success = models.BooleanField(default=False)
+    queue_time = models.PositiveIntegerField(null=True, blank=True)
+
+    def __str__(self):
+        return "Sample of %s" % self.build
@@ -0,0 +1,45 @@
+from jenkins.utils import DefaultSettings, PRIORITY_PARAMETER
+
+
+# Priority classes for requested builds, most urgent first.
+INTERACTIVE = "interactive"
+API = "api"
+AUTOMATED = "automated"
+BACKFILL = "backfill"
+
+PRIORITY_CHOICES = [
+    (INTERACTIVE, "Interactive"),
+    (API, "API"),
+    (AUTOMATED, "Automated"),
+    (BACKFILL, "Backfill"),
+]
+
+priority_settings = DefaultSettings({
+    # Celery message priorities, higher values are consumed first.
+    "CELERY_BUILD_PRIORITIES": {
+        INTERACTIVE: 9, API: 6, AUTOMATED: 3, BACKFILL: 0},
+    # Jenkins Priority Sorter priorities, lower values are built first.
+    "JENKINS_BUILD_PRIORITIES": {
+        INTERACTIVE: 1, API: 2, AUTOMATED: 3, BACKFILL: 4},
+})
+
+
+def get_celery_priority(priority):
+    """
+    Returns the Celery message priority for the priority class.
+    """
+    return priority_settings.CELERY_BUILD_PRIORITIES[priority]
+
+
+def get_jenkins_priority(priority):
+    """
+    Returns the Jenkins queue priority for the priority class.
+    """
+    return priority_settings.JENKINS_BUILD_PRIORITIES[priority]
+
+
+def get_priority_params(priority):
+    """
+    Returns the build parameters which pass the priority class to Jenkins.
+    """
+    return {PRIORITY_PARAMETER: str(get_jenkins_priority(priority))}
@@ -0,0 +1,178 @@
+import math
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Avg, Sum
+from django.utils import timezone
+
+from jenkins.models import BuildSample, JobDailyStats
+
+
+# The durations and queue times are counted in histograms with buckets which
+# grow by HISTOGRAM_GROWTH, so the percentiles are estimated to within 5%.
+HISTOGRAM_GROWTH = 1.1
+HISTOGRAM_SIZE = 256
+
+
+def get_bucket(value):
+    """
+    Returns the histogram bucket for the value, bucket n counts the values
+    from HISTOGRAM_GROWTH ** (n - 1) up to HISTOGRAM_GROWTH ** n, and bucket
+    0 counts the values below 1.
+    """
+    if value < 1:
+        return 0
+    bucket = int(math.log(value) / math.log(HISTOGRAM_GROWTH)) + 1
+    return min(bucket, HISTOGRAM_SIZE - 1)
+
+
+def update_histogram(histogram, value, count=1):
+    """
+    Returns a copy of the histogram, a dictionary mapping buckets to the
+    number of values in them, with count added to the bucket for the value.
+    """
+    histogram = dict(histogram or {})
+    bucket = str(get_bucket(value))
+    histogram[bucket] = histogram.get(bucket, 0) + count
+    if not histogram[bucket]:
+        del histogram[bucket]
+    return histogram
+
+
+def get_percentile(histogram, percent):
+    """
+    Returns the nearest-rank percentile of the values counted in the
+    histogram, estimated as the middle of its bucket, or None if there are no
+    values.
+    """
+    buckets = sorted((int(x), count) for x, count in (histogram or {}).items())
+    total = sum(count for _, count in buckets)
+    if not total:
+        return
+    rank = max(int(math.ceil(percent / 100.0 * total)), 1)
+    seen = 0
+    for bucket, count in buckets:
+        seen += count
+        if seen >= rank:
+            break
+    if bucket == 0:
+        return 0
+    return int(round(HISTOGRAM_GROWTH ** (bucket - 0.5)))
+
+
+def add_sample(stats, sample, count=1):
+    """
+    Adds the values of the BuildSample to the rollup, or removes them if
+    count is -1.
+    """
+    stats.build_count += count
+    if sample.success:
+        stats.success_count += count
+    if sample.duration is not None:
+        stats.duration_histogram = update_histogram(
+            stats.duration_histogram, sample.duration, count)
+    if sample.queue_time is not None:
+        stats.queue_time_histogram = update_histogram(
+            stats.queue_time_histogram, sample.queue_time, count)
+
+
+def update_rollup(stats):
+    """
+    Recalculates the percentiles of the JobDailyStats from its histograms.
+    """
+    stats.duration_p50 = get_percentile(stats.duration_histogram, 50)
+    stats.duration_p95 = get_percentile(stats.duration_histogram, 95)
+    stats.queue_time_p50 = get_percentile(stats.queue_time_histogram, 50)
+    stats.queue_time_p95 = get_percentile(stats.queue_time_histogram, 95)
+
+
+def update_build_sample(build, **values):
+    """
+    Updates the sample for the build in the rollup for the day the build
+    started, replacing the values previously counted for the build.
+    """
+    date = timezone.localtime(build.get_start_time(), timezone.utc).date()
+    with transaction.atomic():
+        stats, _ = JobDailyStats.objects.select_for_update().get_or_create(
+            job_id=build.job_id, date=date)
+        try:
+            sample = BuildSample.objects.get(build=build)
+        except BuildSample.DoesNotExist:
+            sample = BuildSample(build=build)
+        else:
+            previous = stats
+            if sample.stats_id != stats.pk:
+                previous = JobDailyStats.objects.select_for_update().get(
+                    pk=sample.stats_id)
+            add_sample(previous, sample, -1)
+            if previous is not stats:
+                update_rollup(previous)
+                previous.save()
+        sample.stats = stats
+        for name, value in values.items():
+            setattr(sample, name, value)
+        add_sample(stats, sample)
+        update_rollup(stats)
+        stats.save()
+        sample.save()
+    return stats
+
+
+def record_build(build):
+    """
+    Records the outcome and duration of an imported build in the rollup.
+    """
+    return update_build_sample(
+        build, duration=build.duration, success=build.status == "SUCCESS")
+
+
+def record_queue_time(build, queue_time):
+    """
+    Records the number of seconds that the build waited to start in the
+    rollup.
+    """
+    return update_build_sample(build, queue_time=queue_time)
+
+
+def get_duration_trends(days=7, today=None):
+    """
+    Returns a list comparing the median build duration of each job over the
+    last number of days with the preceding period, the jobs that slowed down
+    the most come first.
+
+    This reads the daily rollups rather than the builds, the durations are
+    the average of the daily medians.
+    """
+    if today is None:
+        today = timezone.now().date()
+    current_start = today - timedelta(days=days - 1)
+    previous_start = current_start - timedelta(days=days)
+
+    def get_period(start, end):
+        period = JobDailyStats.objects.filter(
+            date__gte=start, date__lte=end, duration_p50__isnull=False)
+        return dict(
+            (x.pop("job"), x) for x in period.values("job").annotate(
+                builds=Sum("build_count"), successes=Sum("success_count"),
+                duration=Avg("duration_p50"),
+                queue_time=Avg("queue_time_p50")).order_by())
+
+    current = get_period(current_start, today)
+    previous = get_period(previous_start, current_start - timedelta(days=1))
+
+    trends = []
+    for job_pk, stats in current.items():
+        trend = {"job": job_pk, "builds": stats["builds"],
+                 "success_rate": float(stats["successes"]) / stats["builds"],
+                 "duration": int(stats["duration"]),
+                 "queue_time": stats["queue_time"] and int(
+                     stats["queue_time"]),
+                 "previous_duration": None, "change": None}
+        if job_pk in previous:
+            trend["previous_duration"] = int(previous[job_pk]["duration"])
+            if trend["previous_duration"]:
+                trend["change"] = (
+                    float(trend["duration"]) / trend["previous_duration"] - 1)
+        trends.append(trend)
+    return sorted(
+        trends, key=lambda x: (x["change"] is None, -(x["change"] or 0)))
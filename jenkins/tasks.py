@@ -1,17 +1,27 @@
 import logging
+import os
 
 from django.contrib.auth.models import User
 
 from celery import shared_task
 
 from jenkins.models import Job, Build, Artifact
+from jenkins.priorities import get_priority_params
+from jenkins.stats import record_build
 from jenkins.utils import get_job_xml_for_upload
 
 
+# The fields of a build's fingerprints used by extract_fingerprints.
+FINGERPRINT_TREE = "fingerprint[fileName,hash,original[name,number]]"
+
+
 @shared_task
-def build_job(job_pk, build_id=None, params=None, user=None):
+def build_job(job_pk, build_id=None, params=None, user=None, priority=None):
     """
     Request building Job.
+
+    The priority class of the build is passed to Jenkins so that the Jenkins
+    queue can be ordered by priority.
     """
     # TODO: If a job is already queued, then this can throw
     # WillNotBuild: <jenkinsapi.job.Job job> is already queued
@@ -23,6 +33,8 @@ def build_job(job_pk, build_id=None, params=None, user=None):
         params["BUILD_ID"] = build_id
     if user is not None:
         params["REQUESTOR"] = user
+    if priority is not None:
+        params.update(get_priority_params(priority))
     client.build_job(job.name, params=params)
 
 
@@ -56,6 +68,38 @@ def extract_requestor_from_params(params):
                 return
 
 
+def extract_fingerprints(build, build_result):
+    """
+    Returns a dictionary mapping the filenames of the artifacts of the build
+    to the MD5 fingerprints Jenkins recorded for them.
+
+    Jenkins also lists the fingerprints of files the build used which were
+    produced by other builds, only the files which originated from this
+    build are included.
+
+    Filenames which were fingerprinted with different fingerprints are left
+    out, as it isn't known which of the artifacts has which fingerprint.
+
+    jenkinsapi doesn't provide the fingerprints of a build, so only the
+    fields we need are requested from the build's API.
+    """
+    fingerprints = {}
+    ambiguous = set()
+    data = build_result.poll(tree=FINGERPRINT_TREE)
+    for fingerprint in data.get("fingerprint", []):
+        original = fingerprint.get("original") or {}
+        if (original.get("name"), original.get("number")) != (
+                build.job.name, build.number):
+            continue
+        filename = os.path.basename(fingerprint["fileName"])
+        if fingerprints.setdefault(
+                filename, fingerprint["hash"]) != fingerprint["hash"]:
+            ambiguous.add(filename)
+    for filename in ambiguous:
+        del fingerprints[filename]
+    return fingerprints
+
+
 @shared_task
 def import_build_for_job(build_pk):
     """
@@ -88,11 +132,14 @@ def import_build_for_job(build_pk):
     Build.objects.filter(
         job=build.job, number=build.number).update(**build_details)
     build = Build.objects.get(job=build.job, number=build.number)
+    record_build(build)
+    fingerprints = extract_fingerprints(build, build_result)
     for artifact in build_result.get_artifacts():
         artifact_details = {
             "filename": artifact.filename,
             "url": artifact.url,
-            "build": build
+            "build": build,
+            "fingerprint": fingerprints.get(artifact.filename, ""),
         }
         logging.info("Importing artifact %s", artifact_details)
         Artifact.objects.create(**artifact_details)
@@ -12,3 +12,13 @@ def build_time_to_timedelta(value):
     if value is None:
         return ""
     return timedelta(milliseconds=value)
+
+
+@register.filter(is_safe=True)
+def as_percentage(value, signed=False):
+    """
+    Converts a fraction to a percentage, with a sign if signed is True.
+    """
+    if value is None:
+        return ""
+    return ("%+.0f%%" if signed else "%.0f%%") % (value * 100)
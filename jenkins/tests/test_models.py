@@ -1,4 +1,7 @@
+from datetime import timedelta
+
 from django.test import TestCase
+from django.utils import timezone
 
 from httmock import HTTMock
 from jenkinsapi.jenkins import Jenkins
@@ -46,6 +49,25 @@ class BuildTest(TestCase):
         self.assertEquals(Build.COMPLETED, 'COMPLETED')
         self.assertEquals(Build.FINALIZED, 'FINALIZED')
 
+    def test_get_start_and_end_time(self):
+        """
+        The start and end times of a build come from the notifications, or
+        the creation time and duration of builds without them.
+        """
+        now = timezone.now()
+        build = BuildFactory.create(duration=None)
+        self.assertEqual(build.created_at, build.get_start_time())
+        self.assertIsNone(build.get_end_time())
+
+        build.duration = 90000
+        self.assertEqual(
+            build.created_at + timedelta(seconds=90), build.get_end_time())
+
+        build.started_at = now - timedelta(minutes=5)
+        build.finalized_at = now
+        self.assertEqual(now - timedelta(minutes=5), build.get_start_time())
+        self.assertEqual(now, build.get_end_time())
+
     def test_console_log_summary(self):
         """
         Builds should have long console logs shortened to display the last n
@@ -0,0 +1,189 @@
+from __future__ import unicode_literals
+from datetime import date, datetime
+
+from django.test import TestCase
+from django.utils import timezone
+
+from jenkins.models import BuildSample, JobDailyStats
+from jenkins.stats import (
+    get_percentile, update_histogram, record_build, record_queue_time,
+    get_duration_trends)
+from .factories import BuildFactory, JobFactory
+
+
+def utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+class PercentileTestMixin(object):
+
+    def assertPercentile(self, expected, value):
+        """
+        Percentiles are estimated from histograms to within 5%.
+        """
+        self.assertAlmostEqual(expected, value, delta=expected * 0.05)
+
+
+class GetPercentileTest(PercentileTestMixin, TestCase):
+
+    def test_get_percentile(self):
+        """
+        get_percentile returns the nearest-rank percentile of the values in
+        the histogram.
+        """
+        histogram = None
+        for value in [15, 20, 35, 40, 50, 0]:
+            histogram = update_histogram(histogram, value)
+        self.assertPercentile(20, get_percentile(histogram, 50))
+        self.assertPercentile(50, get_percentile(histogram, 95))
+        self.assertEqual(0, get_percentile(histogram, 0))
+        self.assertPercentile(40, get_percentile(histogram, 80))
+
+    def test_get_percentile_with_no_values(self):
+        """
+        get_percentile returns None if there are no values.
+        """
+        self.assertIsNone(get_percentile(None, 50))
+        self.assertIsNone(get_percentile(
+            update_histogram(update_histogram(None, 10), 10, -1), 50))
+
+    def test_update_histogram(self):
+        """
+        The values are counted in buckets, so the size of the histogram
+        doesn't depend on the number of values.
+        """
+        histogram = None
+        for value in range(1, 100000, 7):
+            histogram = update_histogram(histogram, value)
+        self.assertTrue(len(histogram) < 130)
+        self.assertEqual(len(range(1, 100000, 7)), sum(histogram.values()))
+
+
+class RecordBuildTest(PercentileTestMixin, TestCase):
+
+    def test_record_build(self):
+        """
+        record_build adds the build to the rollup for the day it started.
+        """
+        job = JobFactory.create()
+        for duration, status in [(1000, "SUCCESS"), (3000, "FAILURE"),
+                                 (2000, "SUCCESS")]:
+            record_build(BuildFactory.create(
+                job=job, duration=duration, status=status,
+                started_at=utc(2014, 6, 6, 23, 30)))
+        record_build(BuildFactory.create(
+            job=job, duration=5000, started_at=utc(2014, 6, 7, 0, 30)))
+
+        stats = JobDailyStats.objects.get(job=job, date=date(2014, 6, 6))
+        self.assertEqual(3, stats.build_count)
+        self.assertEqual(2, stats.success_count)
+        self.assertPercentile(2000, stats.duration_p50)
+        self.assertPercentile(3000, stats.duration_p95)
+        self.assertIsNone(stats.queue_time_p50)
+        self.assertEqual(2.0 / 3, stats.success_rate)
+        stats = JobDailyStats.objects.get(job=job, date=date(2014, 6, 7))
+        self.assertEqual(1, stats.build_count)
+        self.assertPercentile(5000, stats.duration_p50)
+
+    def test_record_build_is_idempotent(self):
+        """
+        Recording a build again replaces its sample in the rollup.
+        """
+        build = BuildFactory.create(
+            duration=1000, status="FAILURE", started_at=utc(2014, 6, 6))
+        record_build(build)
+        build.duration = 2000
+        build.status = "SUCCESS"
+        record_build(build)
+
+        stats = JobDailyStats.objects.get(job=build.job)
+        self.assertEqual(1, stats.build_count)
+        self.assertEqual(1, stats.success_count)
+        self.assertPercentile(2000, stats.duration_p50)
+        self.assertEqual(1, sum(stats.duration_histogram.values()))
+
+    def test_record_build_on_another_day(self):
+        """
+        If the build is recorded again for a different day, it's moved to the
+        rollup for that day.
+        """
+        build = BuildFactory.create(
+            duration=1000, status="SUCCESS", started_at=utc(2014, 6, 6))
+        record_build(build)
+        build.started_at = utc(2014, 6, 7)
+        record_build(build)
+
+        stats = JobDailyStats.objects.get(job=build.job, date=date(2014, 6, 6))
+        self.assertEqual(
+            (0, 0, None), (stats.build_count, stats.success_count,
+                           stats.duration_p50))
+        stats = JobDailyStats.objects.get(job=build.job, date=date(2014, 6, 7))
+        self.assertEqual(1, stats.build_count)
+        self.assertPercentile(1000, stats.duration_p50)
+
+    def test_record_queue_time(self):
+        """
+        record_queue_time adds the queue time to the sample for the build.
+        """
+        build = BuildFactory.create(duration=1000, started_at=utc(2014, 6, 6))
+        record_build(build)
+        record_queue_time(build, 30)
+
+        stats = JobDailyStats.objects.get(job=build.job)
+        self.assertEqual(1, stats.build_count)
+        self.assertPercentile(1000, stats.duration_p50)
+        self.assertPercentile(30, stats.queue_time_p50)
+        self.assertPercentile(30, stats.queue_time_p95)
+        sample = BuildSample.objects.get(build=build)
+        self.assertEqual(
+            (1000, True, 30),
+            (sample.duration, sample.success, sample.queue_time))
+
+
+class GetDurationTrendsTest(TestCase):
+
+    def create_stats(self, job, day, duration, builds=1, successes=1,
+                     queue_time=None):
+        return JobDailyStats.objects.create(
+            job=job, date=date(2014, 6, day), build_count=builds,
+            success_count=successes, duration_p50=duration,
+            queue_time_p50=queue_time)
+
+    def test_get_duration_trends(self):
+        """
+        get_duration_trends compares the durations over the last days with the
+        preceding period, jobs which slowed down the most come first.
+        """
+        job1, job2, job3 = JobFactory.create_batch(3)
+        self.create_stats(job1, 6, 1000)
+        self.create_stats(job1, 9, 1000, builds=2, successes=1)
+        self.create_stats(job1, 10, 2000, builds=2, successes=2,
+                          queue_time=10)
+        self.create_stats(job2, 5, 2000)
+        self.create_stats(job2, 10, 3000)
+        self.create_stats(job3, 10, 500)
+        # Outside of both periods.
+        self.create_stats(job3, 1, 100)
+
+        trends = get_duration_trends(days=3, today=date(2014, 6, 10))
+
+        self.assertEqual(
+            [{"job": job1.pk, "builds": 4, "success_rate": 0.75,
+              "duration": 1500, "queue_time": 10,
+              "previous_duration": 1000, "change": 0.5},
+             {"job": job2.pk, "builds": 1, "success_rate": 1.0,
+              "duration": 3000, "queue_time": None,
+              "previous_duration": 2000, "change": 0.5},
+             {"job": job3.pk, "builds": 1, "success_rate": 1.0,
+              "duration": 500, "queue_time": None,
+              "previous_duration": None, "change": None}],
+            sorted(trends[:2], key=lambda x: x["job"]) + trends[2:])
+
+    def test_get_duration_trends_queries(self):
+        """
+        get_duration_trends reads the rollups in two queries.
+        """
+        for job in JobFactory.create_batch(5):
+            self.create_stats(job, 9, 1000)
+        with self.assertNumQueries(2):
+            get_duration_trends(days=3, today=date(2014, 6, 10))
@@ -6,9 +6,10 @@ import mock
 import jenkinsapi
 
 from jenkins.models import Build
+from jenkins.priorities import INTERACTIVE, priority_settings
 from jenkins.tasks import (
     build_job, push_job_to_jenkins, import_build_for_job,
-    delete_job_from_jenkins, extract_requestor_from_params)
+    delete_job_from_jenkins, extract_requestor_from_params, FINGERPRINT_TREE)
 from .factories import (
     JobFactory, JenkinsServerFactory, JobTypeFactory, BuildFactory)
 
@@ -68,6 +69,21 @@ class BuildJobTaskTest(TestCase):
         mock_jenkins.return_value.build_job.assert_called_with(
             job.name, params={"MYTEST": "500"})
 
+    @override_settings(CELERY_ALWAYS_EAGER=True)
+    def test_build_job_with_priority(self):
+        """
+        If we provide a priority class, then the Jenkins priority should be
+        passed with the job build request.
+        """
+        job = JobFactory.create(server=self.server)
+        with mock.patch(
+                "jenkins.models.Jenkins",
+                spec=jenkinsapi.jenkins.Jenkins) as mock_jenkins:
+            build_job(job.pk, priority=INTERACTIVE)
+
+        mock_jenkins.return_value.build_job.assert_called_with(
+            job.name, params={"BUILD_PRIORITY": "1"})
+
     @override_settings(CELERY_ALWAYS_EAGER=True)
     def test_build_job_with_params_and_build_id(self):
         """
@@ -105,6 +121,22 @@ class BuildJobTaskTest(TestCase):
               "MYTEST": "500", "BUILD_ID": "20140312.1",
               "REQUESTOR": "testing"})
 
+    def test_build_job_queue_supports_priorities(self):
+        """
+        build_job is routed to a queue declared with x-max-priority, so that
+        RabbitMQ consumes the builds in priority order.
+        """
+        queue = build_job.app.amqp.router.route({}, build_job.name)["queue"]
+
+        self.assertIn(queue.name, build_job.app.amqp.queues)
+        self.assertEqual(
+            queue.queue_arguments,
+            build_job.app.amqp.queues[queue.name].queue_arguments)
+        max_priority = queue.queue_arguments["x-max-priority"]
+        self.assertTrue(all(
+            0 <= x <= max_priority for x in
+            priority_settings.CELERY_BUILD_PRIORITIES.values()))
+
 
 class ImportBuildTaskTest(TestCase):
 
@@ -147,6 +179,7 @@ class ImportBuildTaskTest(TestCase):
 
         mock_job = mock.Mock(spec=jenkinsapi.job.Job)
         mock_build = mock.Mock(_data={"duration": 1000})
+        mock_build.poll.return_value = {}
 
         mock_job.get_build.return_value = mock_build
 
@@ -178,6 +211,54 @@ class ImportBuildTaskTest(TestCase):
         self.assertEqual("This is the log", build.console_log)
         self.assertEqual(parameters, build.parameters)
         self.assertEqual(user, build.requested_by)
+        stats = build.job.daily_stats.get()
+        self.assertEqual(1, stats.build_count)
+        self.assertAlmostEqual(1000, stats.duration_p50, delta=50)
+
+    @override_settings(
+        CELERY_ALWAYS_EAGER=True, NOTIFICATION_HOST="http://example.com")
+    def test_import_build_for_job_with_fingerprints(self):
+        """
+        The fingerprints Jenkins recorded for the artifacts are imported,
+        ignoring the fingerprints of files from other builds.
+        """
+        build = BuildFactory.create(number=5)
+        original = {"name": build.job.name, "number": 5}
+
+        mock_job = mock.Mock(spec=jenkinsapi.job.Job)
+        mock_build = mock.Mock(_data={"duration": 1000})
+        mock_build.poll.return_value = {"fingerprint": [
+            {"fileName": "output/file1.gz", "hash": "a" * 32,
+             "original": original},
+            {"fileName": "file2.gz", "hash": "b" * 32, "original": original},
+            {"fileName": "first/file3.gz", "hash": "c" * 32,
+             "original": original},
+            {"fileName": "second/file3.gz", "hash": "d" * 32,
+             "original": original},
+            {"fileName": "file4.gz", "hash": "e" * 32,
+             "original": {"name": build.job.name, "number": 4}},
+            {"fileName": "file5.gz", "hash": "f" * 32,
+             "original": {"name": "upstream", "number": 5}}]}
+        mock_job.get_build.return_value = mock_build
+        mock_build.get_status.return_value = "SUCCESS"
+        mock_build.get_result_url.return_value = "http://localhost/123"
+        mock_build.get_console.return_value = "This is the log"
+        mock_build.get_actions.return_value = {"parameters": []}
+        mock_build.get_artifacts.return_value = [
+            mock.Mock(filename=filename, url="http://localhost/" + filename)
+            for filename in (
+                "file1.gz", "file2.gz", "file3.gz", "file4.gz", "file5.gz")]
+
+        with mock.patch("jenkins.models.Jenkins") as mock_jenkins:
+            mock_jenkins.return_value.get_job.return_value = mock_job
+            import_build_for_job(build.pk)
+
+        mock_build.poll.assert_called_once_with(tree=FINGERPRINT_TREE)
+        fingerprints = dict(
+            build.artifact_set.values_list("filename", "fingerprint"))
+        self.assertEqual(
+            {"file1.gz": "a" * 32, "file2.gz": "b" * 32, "file3.gz": "",
+             "file4.gz": "", "file5.gz": ""}, fingerprints)
 
 
 job_xml = """
@@ -215,6 +296,12 @@ class CreateJobTaskTest(TestCase):
              "<name>REQUESTOR</name>"
              "<description>The username requesting the build</description>"
              "<defaultValue /></hudson.model.TextParameterDefinition>"
+             "<hudson.model.TextParameterDefinition>"
+             "<name>BUILD_PRIORITY</name>"
+             "<description>The priority of the build in the queue"
+             "</description>"
+             "<defaultValue>3</defaultValue>"
+             "</hudson.model.TextParameterDefinition>"
              "</parameterDefinitions>"
              "</hudson.model.ParametersDefinitionProperty></project>" %
                 job.server.pk).strip())
@@ -249,6 +336,12 @@ class CreateJobTaskTest(TestCase):
              "<name>REQUESTOR</name>"
              "<description>The username requesting the build</description>"
              "<defaultValue /></hudson.model.TextParameterDefinition>"
+             "<hudson.model.TextParameterDefinition>"
+             "<name>BUILD_PRIORITY</name>"
+             "<description>The priority of the build in the queue"
+             "</description>"
+             "<defaultValue>3</defaultValue>"
+             "</hudson.model.TextParameterDefinition>"
              "</parameterDefinitions>"
              "</hudson.model.ParametersDefinitionProperty></project>" %
                 job.server.pk).strip())
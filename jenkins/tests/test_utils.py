@@ -9,7 +9,8 @@ import mock
 from jenkins.utils import (
     get_notifications_url, DefaultSettings, get_job_xml_for_upload,
     get_context_for_template, generate_job_name, parse_parameters_from_job,
-    JenkinsParameter, parameter_to_xml, add_parameter_to_job)
+    JenkinsParameter, parameter_to_xml, add_parameter_to_job,
+    normalize_build_parameters, get_build_reuse_key)
 from .factories import (
     JobFactory, JobTypeFactory, JenkinsServerFactory, JobTypeWithParamsFactory)
 
@@ -220,3 +221,40 @@ class AddParametersToXMLTest(TestCase):
            "description": "Testing Element",
            "defaultValue": "DEFAULT"}],
           parse_parameters_from_job(new_xml))
+
+
+class BuildReuseKeyTest(TestCase):
+
+    def test_normalize_build_parameters(self):
+        """
+        The parameters from a dictionary or Jenkins should be normalized to
+        the same sorted list, without the bookkeeping parameters.
+        """
+        from_dict = normalize_build_parameters(
+            {"BUILD_ID": "20140312.1", "BRANCH": "trunk", "DEBUG": 1})
+        from_jenkins = normalize_build_parameters(
+            [{"name": "DEBUG", "value": "1"},
+             {"name": "REQUESTOR", "value": "testing"},
+             {"name": "BUILD_PRIORITY", "value": "3"},
+             {"name": "BRANCH", "value": "trunk"}])
+        self.assertEqual([("BRANCH", "trunk"), ("DEBUG", "1")], from_dict)
+        self.assertEqual(from_dict, from_jenkins)
+        self.assertEqual([], normalize_build_parameters(None))
+
+    def test_get_build_reuse_key(self):
+        """
+        The key should depend on the job, the parameters and the configuration
+        of the job's JobType.
+        """
+        job = JobFactory.create()
+        key = get_build_reuse_key(job, {"BRANCH": "trunk", "BUILD_ID": "1"})
+
+        self.assertEqual(key, get_build_reuse_key(
+            job, {"BRANCH": "trunk", "BUILD_ID": "2"}))
+        self.assertNotEqual(
+            key, get_build_reuse_key(job, {"BRANCH": "stable"}))
+        self.assertNotEqual(
+            key, get_build_reuse_key(JobFactory.create(), {"BRANCH": "trunk"}))
+
+        job.jobtype.config_xml += "<!-- changed -->"
+        self.assertNotEqual(key, get_build_reuse_key(job, {"BRANCH": "trunk"}))
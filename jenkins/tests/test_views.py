@@ -4,12 +4,14 @@ from django.test import TestCase
 from django.test.client import RequestFactory
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 from django_webtest import WebTest
 import mock
 
 from jenkins.views import NotificationHandlerView
-from jenkins.models import Build
+from jenkins.models import Build, JobDailyStats
+from jenkins.utils import get_build_reuse_key
 from .factories import (
     JobFactory, JenkinsServerFactory, BuildFactory, JobTypeFactory)
 
@@ -98,6 +100,8 @@ class NotificationHandlerTest(TestCase):
         build = Build.objects.get(job=self.job, number=11)
         self.assertEqual("", build.status)
         self.assertEqual(Build.STARTED, build.phase)
+        self.assertIsNotNone(build.started_at)
+        self.assertIsNone(build.finalized_at)
 
     def test_handle_started_notification_with_build_id(self):
         """
@@ -117,6 +121,26 @@ class NotificationHandlerTest(TestCase):
         build = Build.objects.get(job=self.job, number=11)
         self.assertEqual("20140312.2", build.build_id)
 
+    def test_handle_notification_records_reuse_key(self):
+        """
+        The build should record the reuse key for the build parameters, so
+        that the build can be reused in place of identical builds.
+        """
+        started = {
+            "build": {
+                "number": 11,
+                "phase": "STARTED",
+                "parameters": {"BUILD_ID": "20140312.2", "BRANCH": "trunk"},
+                "url": "job/mytestjob/11/"},
+            "name": "mytestjob",
+            "url": "job/mytestjob/"}
+        self._get_response_with_data(started)
+
+        build = Build.objects.get(job=self.job, number=11)
+        self.assertEqual(
+            get_build_reuse_key(self.job, {"BRANCH": "trunk"}),
+            build.reuse_key)
+
     def test_handle_completed_notification(self):
         """
         When a build starts we get a COMPLETED notification, we don't do
@@ -189,6 +213,7 @@ class NotificationHandlerTest(TestCase):
         # This gets properly populated by the task that runs.
         self.assertEqual("job/mytestjob/11/", build.url)
         self.assertEqual(Build.FINALIZED, build.phase)
+        self.assertIsNotNone(build.finalized_at)
         mock_postprocess_build.assert_called_once_with(build)
 
     def test_handle_finalized_notification_with_no_started_build(self):
@@ -213,6 +238,8 @@ class NotificationHandlerTest(TestCase):
         # This gets properly populated by the task that runs.
         self.assertEqual("job/mytestjob/20/", build.url)
         self.assertEqual(Build.FINALIZED, build.phase)
+        self.assertIsNone(build.started_at)
+        self.assertIsNotNone(build.finalized_at)
         mock_postprocess_build.assert_called_once_with(build)
 
     def test_handle_finished_notification_with_build_id(self):
@@ -373,3 +400,29 @@ class BuildDetailTest(WebTest):
         self.assertEqual(200, response.status_code)
         self.assertEqual(
             build, response.context["build"])
+
+
+class JobStatsViewTest(WebTest):
+
+    def setUp(self):
+        self.user = User.objects.create_user("testing")
+
+    def test_job_stats(self):
+        """
+        The job stats view should list the duration trends of the jobs.
+        """
+        job = JobFactory.create()
+        JobDailyStats.objects.create(
+            job=job, date=timezone.now().date(), build_count=2,
+            success_count=1, duration_p50=65000)
+        response = self.app.get(
+            reverse("job_stats"), {"days": "14"}, user="testing")
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(14, response.context["days"])
+        [trend] = response.context["trends"]
+        self.assertEqual(job, trend["job"])
+        self.assertEqual(0.5, trend["success_rate"])
+        self.assertContains(response, job.name)
+        self.assertContains(response, "0:01:05")
+        self.assertContains(response, "50%")
@@ -12,4 +12,5 @@ urlpatterns = patterns("",
         JenkinsServerJobBuildsIndexView.as_view(), name="jenkinsserver_job_builds_index"),
     url(r"^builds/(?P<pk>\d+)/$", BuildDetailView.as_view(), name="build_detail"),
     url(r"^builds/(?P<pk>\d+)/console/$", BuildDetailConsoleView.as_view(), name="build_detail_console"),
+    url(r"^stats/$", JobStatsView.as_view(), name="job_stats"),
 )
@@ -1,3 +1,5 @@
+import hashlib
+import json
 from urlparse import urljoin
 import xml.etree.ElementTree as ET
 
@@ -10,6 +12,14 @@ from django.utils.text import slugify
 
 PARAMETERS = ".//properties/hudson.model.ParametersDefinitionProperty/parameterDefinitions/"
 
+# The parameter used to pass the priority of a build to Jenkins, the Priority
+# Sorter plugin can be configured to order the queue using this parameter.
+PRIORITY_PARAMETER = "BUILD_PRIORITY"
+
+# These parameters identify who requested a build and why, rather than
+# affecting what gets built.
+BOOKKEEPING_PARAMETERS = ("BUILD_ID", "REQUESTOR", PRIORITY_PARAMETER)
+
 
 def get_notifications_url(base, server):
     """
@@ -37,6 +47,8 @@ def get_job_xml_for_upload(job, server):
     """
     Return config_xml run through the template mechanism.
     """
+    from jenkins.priorities import get_jenkins_priority, AUTOMATED
+
     template = Template(job.jobtype.config_xml)
     context = get_context_for_template(job, server)
     # We need to strip leading/trailing whitespace in order to avoid having the
@@ -46,6 +58,10 @@ def get_job_xml_for_upload(job, server):
         "REQUESTOR", "The username requesting the build", "")
 
     job_xml = add_parameter_to_job(requestor, job_xml)
+    priority = JenkinsParameter(
+        PRIORITY_PARAMETER, "The priority of the build in the queue",
+        str(get_jenkins_priority(AUTOMATED)))
+    job_xml = add_parameter_to_job(priority, job_xml)
     return job_xml
 
 
@@ -140,7 +156,40 @@ def add_parameter_to_job(param, job):
         parameters = root.find(".//hudson.model.ParametersDefinitionProperty")
         if parameters is None:
             parameters = ET.SubElement(root, "hudson.model.ParametersDefinitionProperty")
+        parameters_container = parameters.find("parameterDefinitions")
+        if parameters_container is None:
             parameters_container = ET.SubElement(parameters, "parameterDefinitions")
 
     parameters_container.append(parameter_to_xml(param))
     return ET.tostring(root)
+
+
+def normalize_build_parameters(params):
+    """
+    Returns a sorted list of (name, value) pairs from the params, which can be
+    a dictionary, or a list of dictionaries with name and value keys as
+    returned by Jenkins, without the bookkeeping parameters.
+    """
+    if not params:
+        return []
+    if isinstance(params, dict):
+        params = params.items()
+    else:
+        params = [(x["name"], x.get("value")) for x in params]
+    return sorted(
+        (unicode(name), unicode(value if value is not None else ""))
+        for name, value in params if name not in BOOKKEEPING_PARAMETERS)
+
+
+def get_build_reuse_key(job, params):
+    """
+    Returns a key which identifies builds of the job with the params using
+    the current configuration of the job's JobType.
+
+    Builds with the same key are expected to produce the same result.
+    """
+    config_hash = hashlib.sha1(
+        job.jobtype.config_xml.encode("utf-8")).hexdigest()
+    key = json.dumps(
+        [job.pk, normalize_build_parameters(params), config_hash])
+    return hashlib.sha1(key).hexdigest()
@@ -1,13 +1,17 @@
 import json
 import logging
 
+from django.db import transaction
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from django.views.generic import View, ListView, DetailView, TemplateView
 from braces.views import LoginRequiredMixin, CsrfExemptMixin
 
 from jenkins.models import JenkinsServer, Build, Job, JobType
 from jenkins.helpers import postprocess_build
+from jenkins.utils import get_build_reuse_key
+from jenkins.stats import get_duration_trends
 
 
 class NotificationHandlerView(CsrfExemptMixin, View):
@@ -48,26 +52,37 @@ class NotificationHandlerView(CsrfExemptMixin, View):
         # version of the Notification plugin
         build_phase = Build.translate_build_phase(notification["build"]["phase"])
 
-        if "parameters" in notification["build"]:
-            build_id = notification["build"]["parameters"].get("BUILD_ID")
+        parameters = notification["build"].get("parameters", {})
+        build_id = parameters.get("BUILD_ID", build_id)
+        reuse_key = get_build_reuse_key(job, parameters)
 
+        # The build is recorded in a transaction so that any state derived
+        # from the build (e.g. Dependency.building_count) is updated with it.
         if Build.STARTED == build_phase:
-            job.build_set.create(
-                number=build_number, build_id=build_id, phase=build_phase)
+            with transaction.atomic():
+                job.build_set.create(
+                    number=build_number, build_id=build_id, phase=build_phase,
+                    reuse_key=reuse_key, started_at=timezone.now())
         elif Build.FINALIZED == build_phase:
             build_status = notification["build"]["status"]
             build_url = notification["build"]["url"]
-            try:
-                existing_build = job.build_set.get(number=build_number)
-            except Build.DoesNotExist:
-                existing_build = job.build_set.create(
-                    number=build_number, build_id=build_id, phase=build_phase,
-                    status=build_status, url=build_url)
-            else:
-                existing_build.status = build_status
-                existing_build.phase = build_phase
-                existing_build.url = build_url
-                existing_build.save()
+            with transaction.atomic():
+                try:
+                    existing_build = job.build_set.get(number=build_number)
+                except Build.DoesNotExist:
+                    existing_build = job.build_set.create(
+                        number=build_number, build_id=build_id,
+                        phase=build_phase, status=build_status, url=build_url,
+                        reuse_key=reuse_key, finalized_at=timezone.now())
+                else:
+                    existing_build.reuse_key = (
+                        existing_build.reuse_key or reuse_key)
+                    existing_build.status = build_status
+                    existing_build.phase = build_phase
+                    existing_build.url = build_url
+                    existing_build.finalized_at = (
+                        existing_build.finalized_at or timezone.now())
+                    existing_build.save()
             postprocess_build(existing_build)
 
         return HttpResponse(status=200)
@@ -135,7 +150,32 @@ class BuildDetailConsoleView(LoginRequiredMixin, DetailView):
     template_name = "jenkins/build_detail_console.html"
 
 
+class JobStatsView(LoginRequiredMixin, TemplateView):
+
+    template_name = "jenkins/job_stats.html"
+
+    def get_context_data(self, **kwargs):
+        """
+        Compare the recent build durations of the jobs with the preceding
+        period, from the daily rollups.
+        """
+        context = super(JobStatsView, self).get_context_data(**kwargs)
+        try:
+            days = max(int(self.request.GET.get("days", 7)), 1)
+        except ValueError:
+            days = 7
+        trends = get_duration_trends(days=days)
+        jobs = Job.objects.select_related("server").in_bulk(
+            [x["job"] for x in trends])
+        for trend in trends:
+            trend["job"] = jobs[trend["job"]]
+        context["trends"] = trends
+        context["days"] = days
+        return context
+
+
 __all__ = [
     "NotificationHandlerView", "JenkinsServerListView",
     "JenkinsServerDetailView", "JenkinsServerJobBuildsIndexView",
-    "JobTypeDetailView", "BuildDetailView", "BuildDetailConsoleView"]
+    "JobTypeDetailView", "BuildDetailView", "BuildDetailConsoleView",
+    "JobStatsView"]
@@ -0,0 +1,39 @@
+from django.apps import AppConfig
+from django.db.models.signals import post_save, post_delete
+
+
+class ProjectsConfig(AppConfig):
+
+    name = "projects"
+
+    def ready(self):
+        from jenkins.models import Job, Build
+        from projects.models import (
+            Project, Dependency, ProjectDependency, ProjectBuild,
+            update_dependency_build_state)
+        from projects.caching import (
+            invalidate_dependency_index, invalidate_build, invalidate_project,
+            invalidate_dependency, invalidate_projectdependency,
+            invalidate_projectbuild)
+
+        for model in [Job, Dependency, ProjectDependency]:
+            for signal in [post_save, post_delete]:
+                signal.connect(
+                    invalidate_dependency_index, sender=model,
+                    dispatch_uid="invalidate_dependency_index_%s" % (
+                        model._meta.model_name))
+
+        # The dependency build state must be updated before the cached
+        # dashboards are invalidated.
+        handlers = [
+            (Build, update_dependency_build_state),
+            (Build, invalidate_build),
+            (Project, invalidate_project),
+            (Dependency, invalidate_dependency),
+            (ProjectDependency, invalidate_projectdependency),
+            (ProjectBuild, invalidate_projectbuild),
+        ]
+        for model, handler in handlers:
+            for signal in [post_save, post_delete]:
+                signal.connect(
+                    handler, sender=model, dispatch_uid=handler.__name__)
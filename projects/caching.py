@@ -0,0 +1,280 @@
+import time
+from collections import namedtuple
+
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+from jenkins.utils import DefaultSettings
+
+
+cache_settings = DefaultSettings({
+    "DEPENDENCY_INDEX_TIMEOUT": 60 * 60,
+    "DASHBOARD_CACHE_TIMEOUT": 60 * 60,
+})
+
+DEPENDENCY_INDEX_VERSION_KEY = "projects:dependency-index:version"
+PROJECT_VERSION_KEY = "projects:project:version:%s"
+DEPENDENCY_VERSION_KEY = "projects:dependency:version:%s"
+
+# A single row of the reverse dependency index, project_dependency is None for
+# dependencies of the job that aren't used in any project.
+DependencyIndexEntry = namedtuple(
+    "DependencyIndexEntry", ["dependency", "project_dependency", "auto_track"])
+
+
+def is_cache_shared():
+    """
+    Returns True if the configured cache is shared between processes.
+
+    The celery workers invalidate the cached data when builds are recorded, so
+    a per-process cache would keep serving stale data in the web processes.
+    """
+    return not isinstance(caches["default"], (LocMemCache, DummyCache))
+
+
+def get_dashboard_cache_timeout():
+    """
+    Returns the timeout for the cached dashboard data and template fragments,
+    if the cache isn't shared between processes, then this is 0 so that
+    nothing is cached.
+    """
+    if not is_cache_shared():
+        return 0
+    return cache_settings.DASHBOARD_CACHE_TIMEOUT
+
+
+def get_version(key):
+    """
+    Returns the current version stored in the cache for key.
+
+    If the version has been lost from the cache, then we start a new version
+    based on the current time, so that we never reuse an old version for
+    which stale entries might still be cached.
+    """
+    version = cache.get(key)
+    if version is None:
+        version = int(time.time() * 1000)
+        cache.add(key, version, None)
+        version = cache.get(key, version)
+    return version
+
+
+def bump_version(key):
+    """
+    Increments the version stored in the cache for key, this invalidates any
+    cache entries stored against the previous version.
+    """
+    try:
+        return cache.incr(key)
+    except ValueError:
+        return get_version(key)
+
+
+def get_project_version(project_pk):
+    """
+    Returns the version of the cached data for a project, this changes
+    whenever anything displayed for the project changes.
+    """
+    return get_version(PROJECT_VERSION_KEY % project_pk)
+
+
+def bump_project_version(project_pk):
+    """
+    Invalidates the cached data for a project.
+    """
+    return bump_version(PROJECT_VERSION_KEY % project_pk)
+
+
+def get_dependency_version(dependency_pk):
+    """
+    Returns the version of the cached data for a dependency, this changes
+    whenever anything displayed for the dependency changes.
+    """
+    return get_version(DEPENDENCY_VERSION_KEY % dependency_pk)
+
+
+def bump_dependency_version(dependency_pk):
+    """
+    Invalidates the cached data for a dependency.
+    """
+    return bump_version(DEPENDENCY_VERSION_KEY % dependency_pk)
+
+
+def bump_versions_for_job(job_pk):
+    """
+    Invalidates the cached data for the dependencies associated with the
+    job_pk, and the projects that use them.
+    """
+    dependency_pks = set()
+    project_pks = set()
+    for entry in get_dependency_index(job_pk):
+        dependency_pks.add(entry.dependency.pk)
+        if entry.project_dependency is not None:
+            project_pks.add(entry.project_dependency.project_id)
+    for dependency_pk in dependency_pks:
+        bump_dependency_version(dependency_pk)
+    for project_pk in project_pks:
+        bump_project_version(project_pk)
+
+
+def get_or_set(key, func, timeout=None):
+    """
+    Returns the value for key from the cache, if it's not cached, then the
+    value returned by calling func is cached.
+
+    If the cache isn't shared between processes, then func is always called.
+    """
+    if not is_cache_shared():
+        return func()
+    value = cache.get(key)
+    if value is None:
+        value = func()
+        if timeout is None:
+            timeout = get_dashboard_cache_timeout()
+        cache.set(key, value, timeout)
+    return value
+
+
+def get_dependency_index_key(job_pk):
+    """
+    Returns the cache key used to store the dependency index for a job.
+    """
+    return "projects:dependency-index:%d:%s" % (
+        get_version(DEPENDENCY_INDEX_VERSION_KEY), job_pk)
+
+
+def build_dependency_index(job_pk):
+    """
+    Returns a list of DependencyIndexEntry for all Dependencies associated
+    with the job_pk, with an entry for each Project that uses the Dependency.
+    """
+    from projects.models import Dependency, ProjectDependency
+
+    dependencies = list(Dependency.objects.filter(job__pk=job_pk))
+    project_dependencies = ProjectDependency.objects.filter(
+        dependency__in=dependencies).select_related(
+        "project").order_by("pk")
+
+    projects_by_dependency = {}
+    for project_dependency in project_dependencies:
+        projects_by_dependency.setdefault(
+            project_dependency.dependency_id, []).append(project_dependency)
+
+    index = []
+    for dependency in dependencies:
+        used_by = projects_by_dependency.get(dependency.pk)
+        if not used_by:
+            index.append(DependencyIndexEntry(dependency, None, False))
+            continue
+        for project_dependency in used_by:
+            # Avoid pickling another copy of the dependency into the cache.
+            project_dependency.dependency = dependency
+            index.append(DependencyIndexEntry(
+                dependency, project_dependency, project_dependency.auto_track))
+    return index
+
+
+def get_dependency_index(job_pk):
+    """
+    Returns the list of DependencyIndexEntry for the job_pk from the cache,
+    building and caching it if necessary.
+
+    NOTE: The objects in the index are not updated when builds are recorded,
+    so the ProjectDependency.current_build and the Dependency build state
+    shouldn't be read from them.
+
+    If the cache isn't shared between processes, then the index is always
+    built from the database.
+    """
+    if not is_cache_shared():
+        return build_dependency_index(job_pk)
+    key = get_dependency_index_key(job_pk)
+    index = cache.get(key)
+    if index is None:
+        index = build_dependency_index(job_pk)
+        cache.set(key, index, cache_settings.DEPENDENCY_INDEX_TIMEOUT)
+    return index
+
+
+def get_dependencies_for_job(job_pk):
+    """
+    Returns the list of Dependencies associated with the job_pk.
+    """
+    dependencies = []
+    for entry in get_dependency_index(job_pk):
+        if entry.dependency not in dependencies:
+            dependencies.append(entry.dependency)
+    return dependencies
+
+
+def get_autotracking_for_job(job_pk):
+    """
+    Returns a list of (dependency, project_dependency) tuples for the
+    auto-tracked ProjectDependencies associated with the job_pk.
+    """
+    return [(entry.dependency, entry.project_dependency)
+            for entry in get_dependency_index(job_pk) if entry.auto_track]
+
+
+def invalidate_dependency_index(**kwargs):
+    """
+    Signal handler which invalidates the dependency index for all jobs.
+
+    Dependencies and ProjectDependencies change rarely in comparison to builds
+    so it's simpler to invalidate the complete index than to track which jobs
+    were affected by a change.
+    """
+    bump_version(DEPENDENCY_INDEX_VERSION_KEY)
+
+
+def invalidate_build(instance, **kwargs):
+    """
+    Signal handler which invalidates the cached data for the dependencies and
+    projects affected by a Build.
+    """
+    if instance.job_id is not None:
+        bump_versions_for_job(instance.job_id)
+
+
+def invalidate_project(instance, **kwargs):
+    """
+    Signal handler which invalidates the cached data for a Project.
+    """
+    bump_project_version(instance.pk)
+
+
+def invalidate_dependency(instance, **kwargs):
+    """
+    Signal handler which invalidates the cached data for a Dependency.
+    """
+    bump_dependency_version(instance.pk)
+
+
+def invalidate_projectdependency(instance, **kwargs):
+    """
+    Signal handler which invalidates the cached data for the Project and
+    Dependency of a ProjectDependency.
+    """
+    bump_project_version(instance.project_id)
+    bump_dependency_version(instance.dependency_id)
+
+
+def invalidate_projectbuild(instance, **kwargs):
+    """
+    Signal handler which invalidates the cached data for the Project of a
+    ProjectBuild.
+
+    The dependencies display the number of builds of the projects that use
+    them, so these are invalidated when a new ProjectBuild is created.
+    """
+    from projects.models import ProjectDependency
+
+    bump_project_version(instance.project_id)
+    # post_delete doesn't provide created.
+    if kwargs.get("created", True):
+        dependency_pks = ProjectDependency.objects.filter(
+            project=instance.project_id).values_list(
+            "dependency", flat=True)
+        for dependency_pk in dependency_pks:
+            bump_dependency_version(dependency_pk)
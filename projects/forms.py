@@ -1,8 +1,12 @@
 from django import forms
+from django.db import transaction
 
 from jenkins.models import JenkinsServer, JobType
+from projects.caching import (
+    invalidate_dependency_index, bump_project_version,
+    bump_dependency_version)
 from projects.models import (
-    Project, Dependency, ProjectDependency)
+    Project, Dependency, ProjectDependency, get_current_builds)
 from jenkins.helpers import create_job
 from jenkins.tasks import push_job_to_jenkins
 
@@ -16,34 +20,42 @@ class ProjectForm(forms.ModelForm):
         model = Project
 
     def save(self, commit=True):
-        project = super(ProjectForm, self).save(commit=False)
-        project.save()
-
-        requested_dependencies = set(self.cleaned_data["dependencies"])
-        current_dependencies = set(
-            [x.dependency for x in ProjectDependency.objects.filter(
-                project=project)])
-
-        dependencies_to_remove = current_dependencies - requested_dependencies
-        dependencies_to_add = requested_dependencies - current_dependencies
-
-        for dependency in dependencies_to_remove:
-            ProjectDependency.objects.get(
-                project=project, dependency=dependency).delete()
-
-        auto_track = self.data.get("auto_track", False)
-        # Set remaining dependencies for this project to use the auto_track
-        # value requested.
-        ProjectDependency.objects.filter(
-            project=project).update(auto_track=auto_track)
-
-        # TODO: This probably shouldn't use the get_current_build if
-        # auto_track=False
+        with transaction.atomic():
+            project = super(ProjectForm, self).save(commit=False)
+            project.save()
+
+            requested_dependencies = set(self.cleaned_data["dependencies"])
+            current_dependency_pks = set(ProjectDependency.objects.filter(
+                project=project).values_list("dependency", flat=True))
+
+            dependencies_to_add = [
+                x for x in requested_dependencies
+                if x.pk not in current_dependency_pks]
+            ProjectDependency.objects.filter(project=project).exclude(
+                dependency__in=requested_dependencies).delete()
+
+            auto_track = self.data.get("auto_track", False)
+            # Set remaining dependencies for this project to use the
+            # auto_track value requested.
+            ProjectDependency.objects.filter(
+                project=project).update(auto_track=auto_track)
+
+            # TODO: This probably shouldn't use the current build if
+            # auto_track=False
+            current_builds = get_current_builds(dependencies_to_add)
+            ProjectDependency.objects.bulk_create([
+                ProjectDependency(
+                    project=project, dependency=dependency,
+                    auto_track=auto_track,
+                    current_build_id=current_builds.get(dependency.pk))
+                for dependency in dependencies_to_add])
+
+        # Neither update nor bulk_create send signals, so we need to
+        # invalidate the cached data for the changes ourselves.
+        invalidate_dependency_index()
+        bump_project_version(project.pk)
         for dependency in dependencies_to_add:
-            ProjectDependency.objects.create(
-                project=project, dependency=dependency,
-                auto_track=auto_track,
-                current_build=dependency.get_current_build())
+            bump_dependency_version(dependency.pk)
         return project
 
 
@@ -1,23 +1,96 @@
+from datetime import timedelta
+
+from django.utils import timezone
+
+from archives.tasks import archive_projectbuild_dependencies
 from jenkins.tasks import build_job
 from jenkins.models import Build
+from jenkins.priorities import AUTOMATED, get_celery_priority
+from jenkins.utils import DefaultSettings, get_build_reuse_key
 from projects.models import ProjectDependency
+from projects.utils import finalize_projectbuild
+
 
+reuse_settings = DefaultSettings({
+    "REUSE_DEPENDENCY_BUILDS": False,
+    "REUSE_DEPENDENCY_BUILDS_MAX_AGE": 60 * 60,
+    "SHARE_DEPENDENCY_BUILDS": True,
+    "SHARE_DEPENDENCY_BUILDS_MAX_AGE": 2 * 60 * 60,
+})
 
-def build_dependency(dependency, build_id=None, user=None):
+
+def build_dependency(dependency, build_id=None, user=None, priority=AUTOMATED):
     """
     Queues a build of the job associated with the depenency along with
     any parameters that might be needed.
+
+    The priority class determines the priority of the task in the Celery
+    queue, and of the build in the Jenkins queue.
     """
     build_parameters = dependency.get_build_parameters()
-    kwargs = {}
+    kwargs = {"priority": priority}
     if build_parameters:
         kwargs["params"] = build_parameters
     if build_id:
         kwargs["build_id"] = build_id
     if user:
         kwargs["user"] = user.username
-    build_job.delay(
-        dependency.job.pk, **kwargs)
+    build_job.apply_async(
+        (dependency.job.pk,), kwargs, priority=get_celery_priority(priority))
+
+
+def get_reusable_builds(dependencies):
+    """
+    Returns a dictionary mapping the pks of the dependencies to the most
+    recent successful build of the dependency's job with the same parameters
+    and job configuration, if it's within REUSE_DEPENDENCY_BUILDS_MAX_AGE
+    seconds.
+
+    Dependencies without a job have no builds to reuse.
+    """
+    keys = dict(
+        (get_build_reuse_key(
+            dependency.job, dependency.get_build_parameters()),
+         dependency.pk) for dependency in dependencies
+        if dependency.job_id is not None)
+    if not keys:
+        return {}
+    cutoff = timezone.now() - timedelta(
+        seconds=reuse_settings.REUSE_DEPENDENCY_BUILDS_MAX_AGE)
+    builds = Build.objects.filter(
+        reuse_key__in=keys.keys(), phase=Build.FINALIZED, status="SUCCESS",
+        created_at__gte=cutoff).order_by("number")
+
+    reusable_builds = {}
+    for build in builds:
+        # Later builds replace earlier ones.
+        reusable_builds[keys[build.reuse_key]] = build
+    return reusable_builds
+
+
+def get_inflight_build_keys(dependencies, exclude=None):
+    """
+    Returns a dictionary mapping the pks of the dependencies to the BUILD_ID
+    of a build of the dependency that has been queued for another
+    ProjectBuild, and hasn't finished yet.
+
+    Builds queued more than SHARE_DEPENDENCY_BUILDS_MAX_AGE seconds ago are
+    assumed to have been lost.
+    """
+    from projects.models import ProjectBuildDependency
+
+    if not dependencies:
+        return {}
+    cutoff = timezone.now() - timedelta(
+        seconds=reuse_settings.SHARE_DEPENDENCY_BUILDS_MAX_AGE)
+    waiting = ProjectBuildDependency.objects.filter(
+        dependency__in=dependencies, build__isnull=True,
+        projectbuild__requested_at__gte=cutoff).exclude(queued_build_key="")
+    if exclude is not None:
+        waiting = waiting.exclude(projectbuild=exclude)
+    # Later builds replace earlier ones.
+    return dict(waiting.order_by("projectbuild__requested_at").values_list(
+        "dependency", "queued_build_key"))
 
 
 def build_project(project, user=None, dependencies=None, **kwargs):
@@ -33,14 +106,31 @@ def build_project(project, user=None, dependencies=None, **kwargs):
     if automated is True, then we are handling an automatically created
     ProjectBuild, and we should create ProjectBuildDependencies with builds
     for all dependencies.
+
+    if reuse_builds is True (defaulting to the REUSE_DEPENDENCY_BUILDS
+    setting), then recent successful builds of the dependencies with the
+    same parameters and job configuration are used rather than queueing new
+    builds.
+
+    if share_builds is True (defaulting to the SHARE_DEPENDENCY_BUILDS
+    setting), then builds of the dependencies that are already queued for
+    other ProjectBuilds are shared rather than queueing identical builds.
+
+    The priority is the priority class for queueing the dependency builds,
+    defaulting to automated.
     """
     queue_build = kwargs.pop("queue_build", True)
+    reuse_builds = kwargs.pop(
+        "reuse_builds", reuse_settings.REUSE_DEPENDENCY_BUILDS)
+    share_builds = kwargs.pop(
+        "share_builds", reuse_settings.SHARE_DEPENDENCY_BUILDS)
     dependencies = dependencies and dependencies or []
     from projects.models import ProjectBuild, ProjectBuildDependency
 
     automated = kwargs.pop("automated", False)
+    priority = kwargs.pop("priority", AUTOMATED)
 
-    options = {"project": project, "requested_by": user}
+    options = {"project": project, "requested_by": user, "priority": priority}
     if automated:
         options["phase"] = Build.FINALIZED
 
@@ -57,15 +147,41 @@ def build_project(project, user=None, dependencies=None, **kwargs):
     dependencies_not_to_build = ProjectDependency.objects.filter(
         project=project).exclude(pk__in=dependencies_to_build)
 
+    all_reused = False
     if not automated:
-        for dependency in dependencies_to_build.order_by(
-                "dependency__job__pk"):
+        dependencies_to_build = list(dependencies_to_build.order_by(
+            "dependency__job__pk").select_related("dependency__job__jobtype"))
+        reusable_builds = {}
+        if reuse_builds:
+            reusable_builds = get_reusable_builds(
+                [x.dependency for x in dependencies_to_build])
+        inflight_build_keys = {}
+        if share_builds and queue_build:
+            inflight_build_keys = get_inflight_build_keys(
+                [x.dependency for x in dependencies_to_build], exclude=build)
+        reused_dependencies = []
+        for dependency in dependencies_to_build:
+            reused_build = reusable_builds.get(dependency.dependency_id)
             kwargs = {"projectbuild": build,
-                      "dependency": dependency.dependency}
-            ProjectBuildDependency.objects.create(**kwargs)
-            if queue_build:
+                      "dependency": dependency.dependency,
+                      "build": reused_build}
+            if queue_build and reused_build is None:
+                kwargs["queued_build_key"] = inflight_build_keys.get(
+                    dependency.dependency_id, build.build_key)
+            projectbuild_dependency = ProjectBuildDependency.objects.create(
+                **kwargs)
+            if reused_build is not None:
+                reused_dependencies.append(projectbuild_dependency.pk)
+            if kwargs.get("queued_build_key") == build.build_key:
                 build_dependency(
-                    dependency.dependency, build_id=build.build_key, user=user)
+                    dependency.dependency, build_id=build.build_key, user=user,
+                    priority=priority)
+        # If every dependency was reused, there are no builds to wait for.
+        all_reused = dependencies_to_build and len(reusable_builds) == len(
+            dependencies_to_build)
+        if reused_dependencies:
+            # The reused builds are archived with the rest of this build.
+            archive_projectbuild_dependencies.delay(reused_dependencies)
 
     # If it's automated, then we create a ProjectBuildDependency for each
     # dependency of the project and prepopulate it with the last known build.
@@ -82,6 +198,12 @@ def build_project(project, user=None, dependencies=None, **kwargs):
                   "dependency": dependency.dependency,
                   "build": last_known_build}
         ProjectBuildDependency.objects.create(**kwargs)
+
+    # Automated ProjectBuilds have the manifest written once the build that
+    # triggered them is recorded, see process_project_dependency.
+    if not automated and all_reused:
+        build.status = "SUCCESS"
+        finalize_projectbuild(build)
     return build
 
 
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+def populate_build_state(apps, schema_editor):
+    """
+    Populate the last_build and building_count for existing dependencies.
+    """
+    Dependency = apps.get_model("projects", "Dependency")
+    Build = apps.get_model("jenkins", "Build")
+    for dependency in Dependency.objects.filter(job__isnull=False):
+        builds = Build.objects.filter(job=dependency.job_id)
+        dependency.last_build = builds.filter(
+            phase="FINALIZED").order_by("-number").first()
+        dependency.building_count = builds.filter(phase="STARTED").count()
+        dependency.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jenkins', '0002_build_job_phase_index'),
+        ('projects', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dependency',
+            name='building_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='dependency',
+            name='last_build',
+            field=models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.SET_NULL, blank=True, editable=False, to='jenkins.Build', null=True),
+            preserve_default=True,
+        ),
+        migrations.RunPython(populate_build_state),
+    ]
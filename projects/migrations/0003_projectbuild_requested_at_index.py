@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0002_dependency_build_state'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='projectbuild',
+            index_together=set([('project', 'requested_at', 'id')]),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import projects.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0003_projectbuild_requested_at_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='projectbuild',
+            name='build_key',
+            field=models.CharField(default=projects.models.generate_build_key, max_length=32, db_index=True),
+            preserve_default=True,
+        ),
+    ]
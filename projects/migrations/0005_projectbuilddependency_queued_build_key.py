@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0004_projectbuild_build_key_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='projectbuilddependency',
+            name='queued_build_key',
+            field=models.CharField(default=b'', max_length=32, db_index=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
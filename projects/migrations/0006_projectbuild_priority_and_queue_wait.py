@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0005_projectbuilddependency_queued_build_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='projectbuild',
+            name='priority',
+            field=models.CharField(default=b'automated', max_length=16, choices=[(b'interactive', b'Interactive'), (b'api', b'API'), (b'automated', b'Automated'), (b'backfill', b'Backfill')]),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='projectbuilddependency',
+            name='queue_wait',
+            field=models.PositiveIntegerField(null=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
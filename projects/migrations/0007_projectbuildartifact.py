@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import urlparse
+
+from django.db import models, migrations
+from django.db.models import Q
+
+
+def populate_manifests(apps, schema_editor):
+    """
+    Write the manifests for existing FINALIZED ProjectBuilds.
+    """
+    ProjectBuild = apps.get_model("projects", "ProjectBuild")
+    ProjectBuildArtifact = apps.get_model("projects", "ProjectBuildArtifact")
+    Artifact = apps.get_model("jenkins", "Artifact")
+    ArchiveArtifact = apps.get_model("archives", "ArchiveArtifact")
+    for projectbuild in ProjectBuild.objects.filter(phase="FINALIZED"):
+        archived_items = {}
+        for item in ArchiveArtifact.objects.filter(
+                projectbuild_dependency__projectbuild=projectbuild,
+                archive__default=True).select_related(
+                "archive").order_by("pk"):
+            archived_items.setdefault(item.artifact_id, item)
+        shared_builds = projectbuild.dependencies.exclude(
+            queued_build_key__in=["", projectbuild.build_key]).values_list(
+            "build", flat=True)
+        artifacts = Artifact.objects.filter(
+            Q(build__build_id=projectbuild.build_key) |
+            Q(build__in=shared_builds))
+        entries = []
+        for artifact in artifacts:
+            item = archived_items.get(artifact.pk)
+            size, archive_url = None, ""
+            if item:
+                if item.archived_at:
+                    size = item.archived_size
+                archive_url = urlparse.urljoin(
+                    item.archive.base_url,
+                    (item.archived_path or "").lstrip("/"))
+            entries.append(ProjectBuildArtifact(
+                projectbuild=projectbuild, artifact=artifact,
+                build_id=artifact.build_id, filename=artifact.filename,
+                url=artifact.url, size=size, archive_url=archive_url))
+        ProjectBuildArtifact.objects.bulk_create(entries)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('archives', '0001_initial'),
+        ('jenkins', '0004_build_reuse_key'),
+        ('projects', '0006_projectbuild_priority_and_queue_wait'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProjectBuildArtifact',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('filename', models.CharField(max_length=255)),
+                ('url', models.CharField(max_length=255)),
+                ('size', models.BigIntegerField(null=True, blank=True)),
+                ('checksum', models.CharField(default=b'', max_length=64, blank=True)),
+                ('archive_url', models.CharField(default=b'', max_length=255, blank=True)),
+                ('artifact', models.ForeignKey(related_name='+', to='jenkins.Artifact')),
+                ('build', models.ForeignKey(related_name='+', to='jenkins.Build')),
+                ('projectbuild', models.ForeignKey(related_name='manifest', to='projects.ProjectBuild')),
+            ],
+            options={
+                'ordering': ['filename', 'id'],
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='projectbuildartifact',
+            index_together=set([('projectbuild', 'filename', 'id')]),
+        ),
+        migrations.RunPython(populate_manifests),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import projects.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0007_projectbuildartifact'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='next_scheduled_build',
+            field=models.DateTimeField(db_index=True, null=True, editable=False, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='schedule',
+            field=models.CharField(default=b'', help_text=b'Build the project on a cron-like schedule in UTC, "minute hour day-of-month month day-of-week".', max_length=100, blank=True, validators=[projects.models.validate_schedule]),
+            preserve_default=True,
+        ),
+    ]
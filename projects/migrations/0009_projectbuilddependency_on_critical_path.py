@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0008_project_schedule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='projectbuilddependency',
+            name='on_critical_path',
+            field=models.BooleanField(default=False),
+            preserve_default=True,
+        ),
+    ]
@@ -1,13 +1,15 @@
 import uuid
 from django.core.urlresolvers import reverse
 
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 from django.core.exceptions import ValidationError
 
 from jenkins.models import Job, Build, Artifact
+from jenkins.priorities import PRIORITY_CHOICES, AUTOMATED
+from projects.schedules import parse_schedule, get_next_scheduled_time
 
 
 def validate_parameters(value):
@@ -18,6 +20,15 @@ def validate_parameters(value):
             "Invalid parameters entered.  Must be separated by newline.")
 
 
+def validate_schedule(value):
+    try:
+        parse_schedule(value)
+    except ValueError:
+        raise ValidationError(
+            "Invalid schedule entered.  Must be five cron fields, "
+            "e.g. \"0 2 * * 1-5\".")
+
+
 @python_2_unicode_compatible
 class Dependency(models.Model):
 
@@ -27,20 +38,36 @@ class Dependency(models.Model):
     parameters = models.TextField(
         null=True, blank=True, validators=[validate_parameters])
 
+    # These are maintained from the builds of the job, see
+    # update_dependency_build_state.
+    last_build = models.ForeignKey(
+        Build, null=True, blank=True, editable=False, related_name="+",
+        on_delete=models.SET_NULL)
+    building_count = models.PositiveIntegerField(default=0, editable=False)
+
     class Meta:
         verbose_name_plural = "dependencies"
 
+    def __init__(self, *args, **kwargs):
+        super(Dependency, self).__init__(*args, **kwargs)
+        self._loaded_job_id = self.job_id
+
     def __str__(self):
         return self.name
 
+    def save(self, **kwargs):
+        if not self.pk or self.job_id != self._loaded_job_id:
+            for key, value in get_build_state_for_job(self.job_id).items():
+                setattr(self, key, value)
+        super(Dependency, self).save(**kwargs)
+        self._loaded_job_id = self.job_id
+
     def get_current_build(self):
         """
         Return the most recent build
         """
-        if self.job is not None:
-            finished_builds = self.job.build_set.filter(phase=Build.FINALIZED)
-            if finished_builds.count() > 0:
-                return finished_builds.order_by("-number")[0]
+        if self.job_id is not None:
+            return self.last_build
 
     def get_build_parameters(self):
         """
@@ -63,8 +90,55 @@ class Dependency(models.Model):
         TODO: What happens if we never get the "FINALIZED" / "COMPLETED"
         notifications? Status gets left as "UNKNOWN"
         """
-        return Build.objects.filter(
-            job=self.job, phase=Build.STARTED).exists()
+        return self.building_count > 0
+
+
+def get_build_state_for_job(job_pk):
+    """
+    Returns a dictionary with the last_build_id and building_count for the
+    builds of the job_pk.
+    """
+    if job_pk is None:
+        return {"last_build_id": None, "building_count": 0}
+    builds = Build.objects.filter(job__pk=job_pk)
+    last_build = builds.filter(phase=Build.FINALIZED).order_by(
+        "-number").values_list("pk", flat=True).first()
+    return {
+        "last_build_id": last_build,
+        "building_count": builds.filter(phase=Build.STARTED).count()}
+
+
+def get_current_builds(dependencies):
+    """
+    Returns a dictionary mapping the pks of the dependencies to the pk of the
+    current build for each dependency, in a single query.
+    """
+    if not dependencies:
+        return {}
+    return dict(Dependency.objects.filter(
+        pk__in=[x.pk for x in dependencies], job__isnull=False).values_list(
+        "pk", "last_build"))
+
+
+def update_dependency_build_state(sender, instance, **kwargs):
+    """
+    Signal handler which updates the last_build and building_count for the
+    dependencies associated with the job of a saved or deleted Build.
+    """
+    if instance.job_id is None:
+        return
+    with transaction.atomic():
+        # Lock the dependencies before recomputing their state, so that
+        # concurrent updates for builds of the same job are serialised and
+        # the last to commit sees the builds saved by the others.
+        dependency_pks = list(Dependency.objects.select_for_update().filter(
+            job__pk=instance.job_id).values_list("pk", flat=True))
+        if not dependency_pks:
+            return
+        state = get_build_state_for_job(instance.job_id)
+        Dependency.objects.filter(pk__in=dependency_pks).update(
+            last_build=state["last_build_id"],
+            building_count=state["building_count"])
 
 
 @python_2_unicode_compatible
@@ -101,6 +175,27 @@ class Project(models.Model):
     description = models.TextField(null=True, blank=True)
     dependencies = models.ManyToManyField(
         Dependency, through=ProjectDependency)
+    schedule = models.CharField(
+        max_length=100, blank=True, default="",
+        validators=[validate_schedule],
+        help_text="Build the project on a cron-like schedule in UTC, "
+                  "\"minute hour day-of-month month day-of-week\".")
+    # This is maintained from the schedule, see queue_scheduled_builds.
+    next_scheduled_build = models.DateTimeField(
+        null=True, blank=True, editable=False, db_index=True)
+
+    def __init__(self, *args, **kwargs):
+        super(Project, self).__init__(*args, **kwargs)
+        self._loaded_schedule = self.schedule
+
+    def save(self, **kwargs):
+        if not self.pk or self.schedule != self._loaded_schedule:
+            self.next_scheduled_build = None
+            if self.schedule:
+                self.next_scheduled_build = get_next_scheduled_time(
+                    self.schedule, timezone.now())
+        super(Project, self).save(**kwargs)
+        self._loaded_schedule = self.schedule
 
     def get_current_artifacts(self):
         """
@@ -108,10 +203,7 @@ class Project(models.Model):
         associated with the project dependencies at their current dependency
         level.
         """
-        current_builds = []
-        for dependency in ProjectDependency.objects.filter(project=self):
-            current_builds.append(dependency.current_build)
-        return Artifact.objects.filter(build__in=current_builds)
+        return Artifact.objects.filter(build__projectdependency__project=self)
 
     def get_current_projectbuild(self):
         """
@@ -135,6 +227,17 @@ class ProjectBuildDependency(models.Model):
         Build, blank=True, null=True,
         related_name="projectbuild_dependencies")
     dependency = models.ForeignKey(Dependency)
+    # The BUILD_ID of the build we're waiting for, this is the build_key of
+    # the ProjectBuild that queued the build, which may have been queued for
+    # another ProjectBuild and shared with this one.
+    queued_build_key = models.CharField(
+        max_length=32, blank=True, default="", db_index=True)
+    # The number of seconds between the ProjectBuild being requested and the
+    # build starting.
+    queue_wait = models.PositiveIntegerField(null=True, blank=True)
+    # Set when the ProjectBuild is FINALIZED if this was the last dependency
+    # to finish building, see mark_critical_path.
+    on_critical_path = models.BooleanField(default=False)
 
     class Meta:
         verbose_name_plural = "project build dependencies"
@@ -161,11 +264,17 @@ class ProjectBuild(models.Model):
     phase = models.CharField(max_length=25, default="UNKNOWN")
     build_id = models.CharField(max_length=20)
     archived = models.DateTimeField(null=True, blank=True)
-    build_key = models.CharField(max_length=32, default=generate_build_key)
+    build_key = models.CharField(
+        max_length=32, default=generate_build_key, db_index=True)
+    priority = models.CharField(
+        max_length=16, choices=PRIORITY_CHOICES, default=AUTOMATED)
 
     build_dependencies = models.ManyToManyField(
         Build, through=ProjectBuildDependency)
 
+    class Meta:
+        index_together = [("project", "requested_at", "id")]
+
     def __str__(self):
         return "%s %s" % (self.project.name, self.build_key)
 
@@ -174,8 +283,13 @@ class ProjectBuild(models.Model):
         Returns a QuerySet of Artifact objects representing the Artifacts
         associated with the builds of the project dependencies for this
         project build.
+
+        These are the builds recorded for the dependencies, whether they were
+        built for this project build, shared with another, reused or the last
+        known build of the dependency.
         """
-        return Artifact.objects.filter(build__build_id=self.build_key)
+        return Artifact.objects.filter(build__in=self.dependencies.filter(
+            build__isnull=False).values("build"))
 
     @property
     def can_be_archived(self):
@@ -186,7 +300,44 @@ class ProjectBuild(models.Model):
         return (
             self.phase == Build.FINALIZED
             and not self.archived
-            and self.get_current_artifacts().exists())
+            and self.manifest.exists())
+
+    def write_manifest(self):
+        """
+        Records the current artifacts for this ProjectBuild in the manifest,
+        along with the archived details of any that are already in the
+        default archive.
+
+        This is written when the ProjectBuild is FINALIZED, the manifest is
+        then read rather than finding the artifacts from the builds.
+        """
+        from archives.models import ArchiveArtifact
+        from projects.caching import bump_project_version
+
+        archived_items = {}
+        for item in ArchiveArtifact.objects.filter(
+                projectbuild_dependency__projectbuild=self,
+                archive__default=True).select_related("archive").order_by(
+                "pk"):
+            archived_items.setdefault(item.artifact_id, item)
+
+        entries = []
+        for artifact in self.get_current_artifacts():
+            item = archived_items.get(artifact.pk)
+            entries.append(ProjectBuildArtifact(
+                projectbuild=self, artifact=artifact,
+                build_id=artifact.build_id, filename=artifact.filename,
+                url=artifact.url,
+                size=item.archived_size if item and item.archived_at else None,
+                checksum=item.sha256 if item and item.archived_at else "",
+                archive_url=item.get_url() if item else ""))
+        with transaction.atomic():
+            self.manifest.all().delete()
+            ProjectBuildArtifact.objects.bulk_create(entries)
+        # The manifest of the current ProjectBuild is displayed for the
+        # project.
+        bump_project_version(self.project_id)
+        return entries
 
     def save(self, **kwargs):
         if not self.pk:
@@ -200,10 +351,46 @@ class ProjectBuild(models.Model):
         """
         return reverse("project_projectbuild_detail",
                        kwargs={
-                           "project_pk": self.project.pk, "build_pk": self.pk
+                           "project_pk": self.project_id, "build_pk": self.pk
                        })
 
 
+@python_2_unicode_compatible
+class ProjectBuildArtifact(models.Model):
+    """
+    An entry in the manifest of the artifacts produced by a ProjectBuild.
+
+    The archive_url, size and checksum are recorded when the artifact is
+    archived.
+    """
+    projectbuild = models.ForeignKey(ProjectBuild, related_name="manifest")
+    artifact = models.ForeignKey(Artifact, related_name="+")
+    build = models.ForeignKey(Build, related_name="+")
+    filename = models.CharField(max_length=255)
+    url = models.CharField(max_length=255)
+    size = models.BigIntegerField(null=True, blank=True)
+    checksum = models.CharField(max_length=64, blank=True, default="")
+    archive_url = models.CharField(max_length=255, blank=True, default="")
+
+    class Meta:
+        ordering = ["filename", "id"]
+        index_together = [("projectbuild", "filename", "id")]
+
+    def __str__(self):
+        return "%s for %s" % (self.filename, self.projectbuild)
+
+    @property
+    def archived(self):
+        return bool(self.archive_url)
+
+    def get_url(self):
+        """
+        Returns the URL to download the artifact from the archive if it's been
+        archived, otherwise the URL in Jenkins.
+        """
+        return self.archive_url or self.url
+
+
 def generate_projectbuild_id(projectbuild):
     """
     Generates a daily-unique id for a given project.
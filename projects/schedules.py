@@ -0,0 +1,145 @@
+import random
+from datetime import datetime, time, timedelta
+
+from django.db.models import F
+from django.utils import timezone
+
+from celery.schedules import crontab
+
+from jenkins.utils import DefaultSettings
+
+
+schedule_settings = DefaultSettings({
+    # Scheduled builds are spread across this many seconds after they're due.
+    "SCHEDULED_BUILD_WINDOW": 30 * 60,
+    # Each scheduled build is delayed by up to this many seconds at random.
+    "SCHEDULED_BUILD_JITTER": 60,
+    # Queued builds older than this are not counted in the queue depth.
+    "SCHEDULED_BUILD_QUEUE_MAX_AGE": 6 * 60 * 60,
+})
+
+
+def parse_schedule(schedule):
+    """
+    Parses a cron-like schedule "minute hour day-of-month month day-of-week"
+    into a celery crontab.
+
+    Raises ValueError if the schedule can't be parsed.
+    """
+    fields = schedule.split()
+    if len(fields) != 5:
+        raise ValueError(
+            "Schedule must have five fields: %r" % schedule)
+    minute, hour, day_of_month, month_of_year, day_of_week = fields
+    try:
+        return crontab(
+            minute=minute, hour=hour, day_of_week=day_of_week,
+            day_of_month=day_of_month, month_of_year=month_of_year)
+    except Exception as e:
+        raise ValueError("Invalid schedule %r: %s" % (schedule, e))
+
+
+def get_next_scheduled_time(schedule, after):
+    """
+    Returns the first time after the datetime after that matches the
+    schedule, schedules are in UTC.
+
+    As with celery's crontab, the day-of-month and day-of-week must both
+    match.
+    """
+    cron = parse_schedule(schedule)
+    start = after.astimezone(timezone.utc).replace(
+        second=0, microsecond=0) + timedelta(minutes=1)
+    day = start.date()
+    # A schedule for the 29th February may not match for four years.
+    for _ in range(366 * 4 + 1):
+        if (day.month in cron.month_of_year and
+                day.day in cron.day_of_month and
+                day.isoweekday() % 7 in cron.day_of_week):
+            for hour in sorted(cron.hour):
+                for minute in sorted(cron.minute):
+                    scheduled = datetime.combine(
+                        day, time(hour, minute, tzinfo=timezone.utc))
+                    if scheduled >= start:
+                        return scheduled
+        day += timedelta(days=1)
+
+
+def get_queue_depths():
+    """
+    Returns a dictionary mapping the pks of JenkinsServers to the number of
+    dependency builds that are queued on the server but haven't started.
+
+    The build of a ProjectBuildDependency is only recorded when it's
+    FINALIZED, so builds that have started are found by their build_id.
+    """
+    from jenkins.models import Build
+    from projects.models import ProjectBuildDependency
+
+    cutoff = timezone.now() - timedelta(
+        seconds=schedule_settings.SCHEDULED_BUILD_QUEUE_MAX_AGE)
+    # Shared builds are only counted for the ProjectBuild that queued them.
+    queued = list(ProjectBuildDependency.objects.filter(
+        build__isnull=True, dependency__job__isnull=False,
+        queued_build_key=F("projectbuild__build_key"),
+        projectbuild__requested_at__gte=cutoff).values_list(
+        "dependency__job", "queued_build_key", "dependency__job__server"))
+    if not queued:
+        return {}
+    started = set(Build.objects.filter(
+        job__in=set(x[0] for x in queued),
+        build_id__in=set(x[1] for x in queued)).values_list(
+        "job", "build_id"))
+    depths = {}
+    for job_pk, build_key, server_pk in queued:
+        if (job_pk, build_key) not in started:
+            depths[server_pk] = depths.get(server_pk, 0) + 1
+    return depths
+
+
+def get_servers_for_projects(projects):
+    """
+    Returns a dictionary mapping the pks of the projects to the set of pks of
+    the JenkinsServers that their dependencies are built on.
+    """
+    from projects.models import ProjectDependency
+
+    servers = dict((project.pk, set()) for project in projects)
+    for project_pk, server_pk in ProjectDependency.objects.filter(
+            project__in=servers.keys(),
+            dependency__job__isnull=False).values_list(
+            "project", "dependency__job__server").distinct():
+        servers[project_pk].add(server_pk)
+    return servers
+
+
+def get_scheduled_build_delays(projects, queue_depths=None):
+    """
+    Returns a dictionary mapping the pks of the projects to the number of
+    seconds to delay their scheduled builds by.
+
+    Projects are grouped by the busiest server their dependencies are built
+    on. The builds for each server are spread evenly across the
+    SCHEDULED_BUILD_WINDOW, starting later in the window for servers which
+    already have builds queued, and each build is delayed by a random jitter.
+    """
+    if queue_depths is None:
+        queue_depths = get_queue_depths()
+    window = schedule_settings.SCHEDULED_BUILD_WINDOW
+    jitter = schedule_settings.SCHEDULED_BUILD_JITTER
+
+    projects_by_server = {}
+    for project_pk, server_pks in sorted(
+            get_servers_for_projects(projects).items()):
+        server_pk = max(
+            server_pks or [None], key=lambda x: queue_depths.get(x, 0))
+        projects_by_server.setdefault(server_pk, []).append(project_pk)
+
+    delays = {}
+    for server_pk, project_pks in projects_by_server.items():
+        depth = queue_depths.get(server_pk, 0)
+        slots = depth + len(project_pks)
+        for index, project_pk in enumerate(project_pks):
+            delays[project_pk] = int(
+                window * (depth + index) / slots + random.uniform(0, jitter))
+    return delays
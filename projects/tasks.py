@@ -7,24 +7,36 @@ from django.contrib.sites.models import Site
 
 from celery import shared_task
 
+from projects.caching import get_autotracking_for_job, bump_versions_for_job
 from projects.helpers import build_project
-from projects.models import ProjectBuildDependency
-from projects.models import ProjectBuild
+from projects.models import ProjectBuildDependency, ProjectDependency
+from projects.models import ProjectBuild, Project
+from projects.utils import finalize_projectbuild
+from projects.schedules import (
+    get_next_scheduled_time, get_scheduled_build_delays)
 from jenkins.models import Build
+from jenkins.priorities import AUTOMATED
+from jenkins.stats import record_queue_time
 
 
-def get_projectbuild_dependency_for_build(build):
+def get_projectbuild_dependencies_for_build(build):
     """
-    Returns the ProjectBuildDependency associated with this particular Build if
-    any, by looking for the build_id in the list of dependencies for this
-    build_id.
-
-    Returns None if no ProjectBuildDependency found.
+    Returns the ProjectBuildDependencies associated with this particular
+    Build, by looking for the build_id in the list of dependencies for this
+    build_id, along with the ProjectBuildDependencies of other ProjectBuilds
+    that are sharing the build.
     """
-    if build.build_id:
-        return ProjectBuildDependency.objects.filter(
-            dependency__job=build.job,
-            projectbuild__build_key=build.build_id).first()
+    if not build.build_id:
+        return []
+    dependencies = ProjectBuildDependency.objects.filter(
+        dependency__job=build.job).select_related("projectbuild")
+    projectbuild_dependency = dependencies.filter(
+        projectbuild__build_key=build.build_id).first()
+    shared = dependencies.filter(queued_build_key=build.build_id).exclude(
+        projectbuild__build_key=build.build_id)
+    if projectbuild_dependency is None:
+        return list(shared)
+    return [projectbuild_dependency] + list(shared)
 
 
 @shared_task
@@ -36,6 +48,8 @@ def process_build_dependencies(build_pk):
     update_autotracked_dependencies(build)
     update_projectbuilds(build)
     create_projectbuilds_for_autotracking(build)
+    # The projects and dependencies display the builds we've just processed.
+    bump_versions_for_job(build.job_id)
     return build_pk
 
 
@@ -44,43 +58,57 @@ def update_autotracked_dependencies(build):
     Find projects that use the dependency associated with this build, and if
     they're auto-tracked, update the "current_build" to be this new build.
     """
-    if build.job.dependency_set.exists():
-        for dependency in build.job.dependency_set.all():
-            for project_dependency in dependency.projectdependency_set.filter(
-                    auto_track=True):
-                project_dependency.current_build = build
-                project_dependency.save()
+    project_dependency_pks = [
+        project_dependency.pk for _, project_dependency in
+        get_autotracking_for_job(build.job_id)]
+    if project_dependency_pks:
+        ProjectDependency.objects.filter(
+            pk__in=project_dependency_pks).update(current_build=build)
 
 
 def update_projectbuilds(build):
     """
-    If this build was for a ProjectBuild, i.e. if the build's build_id matches
-    a ProjectBuildDependency for the build job, then we need to update the
-    state of the ProjectBuild.
+    If this build was for ProjectBuilds, i.e. if the build's build_id matches
+    ProjectBuildDependencies for the build job, then we need to update the
+    state of each of the ProjectBuilds.
     """
-    dependency = get_projectbuild_dependency_for_build(build)
-    if dependency:
+    dependencies = get_projectbuild_dependencies_for_build(build)
+    for dependency in dependencies:
         dependency.build = build
+        # The wait isn't known if we weren't notified when the build started.
+        if build.started_at is not None:
+            # Builds that are shared may have started before this
+            # ProjectBuild was requested.
+            queue_wait = (
+                build.started_at - dependency.projectbuild.requested_at)
+            dependency.queue_wait = max(0, int(queue_wait.total_seconds()))
         dependency.save()
-        projectbuild = dependency.projectbuild
-
-        build_statuses = ProjectBuildDependency.objects.filter(
-            projectbuild=dependency.projectbuild).values(
-            "build__status", "build__phase")
-
-        statuses = set([x["build__status"] for x in build_statuses])
-        phases = set([x["build__phase"] for x in build_statuses])
-        updated = False
-        if len(statuses) == 1:
-            projectbuild.status = list(statuses)[0]
-            updated = True
-        if len(phases) == 1:
-            projectbuild.phase = list(phases)[0]
-            if projectbuild.phase == Build.FINALIZED:
-                projectbuild.ended_at = timezone.now()
-                projectbuild.save()
-        elif updated:
-            projectbuild.save()
+        update_projectbuild_state(dependency.projectbuild)
+    if dependencies and build.started_at is not None:
+        # The build was queued by the first ProjectBuild.
+        record_queue_time(build, dependencies[0].queue_wait)
+
+
+def update_projectbuild_state(projectbuild):
+    """
+    Update the status and phase of the projectbuild from the builds of its
+    dependencies.
+    """
+    build_statuses = ProjectBuildDependency.objects.filter(
+        projectbuild=projectbuild).values("build__status", "build__phase")
+
+    statuses = set([x["build__status"] for x in build_statuses])
+    phases = set([x["build__phase"] for x in build_statuses])
+    updated = False
+    if len(statuses) == 1:
+        projectbuild.status = list(statuses)[0]
+        updated = True
+    if len(phases) == 1:
+        projectbuild.phase = list(phases)[0]
+        if projectbuild.phase == Build.FINALIZED:
+            finalize_projectbuild(projectbuild)
+    elif updated:
+        projectbuild.save()
 
 
 def create_projectbuilds_for_autotracking(build):
@@ -89,21 +117,19 @@ def create_projectbuilds_for_autotracking(build):
     with this build, then we should create project builds for them.
     """
     logging.info("Autocreating projectbuilds for build %s", build)
-    build_dependency = get_projectbuild_dependency_for_build(build)
+    built_project_pks = set(
+        x.projectbuild.project_id for x in
+        get_projectbuild_dependencies_for_build(build))
     # At this point, we need to identify Projects which have this
     # dependency and create ProjectBuilds for them.
-    for dependency in build.job.dependency_set.all():
-        logging.debug("Processing dependency %s", dependency)
-        for project_dependency in dependency.projectdependency_set.filter(
-                auto_track=True):
-            logging.debug("Processing %s", project_dependency)
-            if (build_dependency is not None and
-                    build_dependency.projectbuild.project ==
-                        project_dependency.project):
-                continue
-            else:
-                process_project_dependency(
-                    build, dependency, project_dependency)
+    for dependency, project_dependency in get_autotracking_for_job(
+            build.job_id):
+        logging.debug("Processing %s", project_dependency)
+        if project_dependency.project_id in built_project_pks:
+            continue
+        else:
+            process_project_dependency(
+                build, dependency, project_dependency)
 
 
 def process_project_dependency(build, dependency, project_dependency):
@@ -116,11 +142,12 @@ def process_project_dependency(build, dependency, project_dependency):
     # We have a Project with a an auto-tracked element.
     projectbuild = build_project(
         project_dependency.project, dependencies=None,
-        queue_build=False, automated=True)
+        queue_build=False, automated=True, priority=AUTOMATED)
     projectbuild_dependency = projectbuild.dependencies.get(
         dependency=dependency)
     projectbuild_dependency.build = build
     projectbuild_dependency.save()
+    projectbuild.write_manifest()
 
 
 @shared_task
@@ -198,3 +225,45 @@ def get_base_url():
     """
     current_site = Site.objects.get_current()
     return urlparse.urlunparse(("http", current_site.domain, "/", "", "", ""))
+
+
+@shared_task
+def queue_scheduled_builds():
+    """
+    Queue builds of the projects whose scheduled builds are due, this should
+    be run every minute by celery beat.
+
+    The builds are spread out across the servers, see
+    get_scheduled_build_delays.
+    """
+    now = timezone.now()
+    due_projects = []
+    for project in Project.objects.filter(
+            next_scheduled_build__lte=now).exclude(schedule=""):
+        # Only queue the build if another process hasn't already done so.
+        next_scheduled_build = get_next_scheduled_time(project.schedule, now)
+        updated = Project.objects.filter(
+            pk=project.pk,
+            next_scheduled_build=project.next_scheduled_build).update(
+            next_scheduled_build=next_scheduled_build)
+        if updated:
+            due_projects.append(project)
+    if not due_projects:
+        return
+    delays = get_scheduled_build_delays(due_projects)
+    for project in due_projects:
+        logging.info(
+            "Queueing scheduled build of %s in %ds", project,
+            delays[project.pk])
+        build_scheduled_project.apply_async(
+            (project.pk,), countdown=delays[project.pk])
+
+
+@shared_task
+def build_scheduled_project(project_pk):
+    """
+    Build the project for its schedule.
+    """
+    project = Project.objects.get(pk=project_pk)
+    projectbuild = build_project(project, priority=AUTOMATED)
+    return projectbuild.pk
@@ -1,22 +1,34 @@
 from django.template.base import Library
-from django.core.urlresolvers import reverse
 
-from projects.models import ProjectBuild
+from projects.utils import get_projectbuild_urls
 
 
 register = Library()
 
 
 @register.simple_tag()
-def build_url(build_key):
+def build_url(build_key, build_urls=None):
     """
     Returns the URL for the associated ProjectBuild (if any) for the
     supplied build_key, or returns an empty string.
+
+    If build_urls from get_build_urls is provided, then the URL is taken from
+    there, rather than querying for the ProjectBuild.
+    """
+    if build_urls is None:
+        build_urls = get_projectbuild_urls([build_key])
+    return build_urls.get(build_key, "")
+
+
+@register.assignment_tag()
+def get_build_urls(builds):
+    """
+    Returns a dictionary mapping the build_ids of the builds to the URLs for
+    the associated ProjectBuilds, using a single query.
+
+    {% get_build_urls builds as build_urls %}
+    {% for build in builds %}
+      {% build_url build.build_id build_urls %}
+    {% endfor %}
     """
-    try:
-        build = ProjectBuild.objects.get(build_key=build_key)
-        return reverse(
-            "project_projectbuild_detail",
-            kwargs={"project_pk": build.project.pk, "build_pk": build.pk})
-    except ProjectBuild.DoesNotExist:
-        return ""
+    return get_projectbuild_urls([build.build_id for build in builds])
@@ -1,8 +1,9 @@
 from django.test import TestCase
 from django.core.urlresolvers import reverse
+from django.template import Template, Context
 
 from projects.helpers import build_project
-from projects.templatetags.projects_tags import build_url
+from projects.templatetags.projects_tags import build_url, get_build_urls
 from projects.models import ProjectDependency
 from projects.tests.factories import ProjectFactory, DependencyFactory
 from jenkins.tests.factories import BuildFactory
@@ -36,3 +37,58 @@ class BuildUrlTest(TestCase):
         """
         build = BuildFactory.create()
         self.assertEqual("", build_url(build.build_id))
+
+    def test_build_url_with_build_urls(self):
+        """
+        build_url should use the build_urls if provided rather than querying
+        for the ProjectBuild.
+        """
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                "/testing/", build_url("testing", {"testing": "/testing/"}))
+            self.assertEqual("", build_url("unknown", {}))
+
+
+class GetBuildUrlsTest(TestCase):
+
+    def test_get_build_urls(self):
+        """
+        get_build_urls should return the urls for all builds with a
+        projectbuild in a single query.
+        """
+        project = ProjectFactory.create()
+        dependency = DependencyFactory.create()
+        ProjectDependency.objects.create(
+            project=project, dependency=dependency)
+        projectbuilds = [
+            build_project(project, queue_build=False) for x in range(3)]
+        builds = [BuildFactory.create(
+            job=dependency.job, build_id=projectbuild.build_key)
+            for projectbuild in projectbuilds]
+        builds.append(BuildFactory.create(job=dependency.job))
+
+        with self.assertNumQueries(1):
+            build_urls = get_build_urls(builds)
+
+        self.assertEqual(
+            dict((projectbuild.build_key, projectbuild.get_absolute_url())
+                 for projectbuild in projectbuilds), build_urls)
+
+    def test_get_build_urls_renders_with_build_url(self):
+        """
+        The result of get_build_urls can be passed to build_url in a template.
+        """
+        project = ProjectFactory.create()
+        projectbuild = build_project(project, queue_build=False)
+        build = BuildFactory.create(build_id=projectbuild.build_key)
+        template = Template(
+            "{% load projects_tags %}"
+            "{% get_build_urls builds as build_urls %}"
+            "{% for build in builds %}"
+            "{% build_url build.build_id build_urls %}"
+            "{% endfor %}")
+
+        with self.assertNumQueries(1):
+            output = template.render(Context({"builds": [build]}))
+
+        self.assertEqual(projectbuild.get_absolute_url(), output)
@@ -0,0 +1,181 @@
+from __future__ import unicode_literals
+
+from django.test import TestCase
+import mock
+
+from jenkins.tests.factories import BuildFactory
+from projects.caching import (
+    get_dependency_index, get_dependencies_for_job, get_autotracking_for_job,
+    get_project_version, get_dependency_version, bump_versions_for_job,
+    DependencyIndexEntry, is_cache_shared)
+from projects.helpers import build_project
+from projects.models import ProjectDependency
+from .factories import ProjectFactory, DependencyFactory
+
+
+@mock.patch("projects.caching.is_cache_shared", return_value=True)
+class DependencyIndexTest(TestCase):
+
+    def test_get_dependency_index(self, shared_mock):
+        """
+        The index should contain an entry for each project using each
+        dependency of the job.
+        """
+        dependency = DependencyFactory.create()
+        project1 = ProjectFactory.create()
+        project2 = ProjectFactory.create()
+        projectdependency1 = ProjectDependency.objects.create(
+            project=project1, dependency=dependency)
+        projectdependency2 = ProjectDependency.objects.create(
+            project=project2, dependency=dependency, auto_track=False)
+
+        self.assertEqual(
+            [DependencyIndexEntry(dependency, projectdependency1, True),
+             DependencyIndexEntry(dependency, projectdependency2, False)],
+            get_dependency_index(dependency.job.pk))
+
+    def test_get_dependency_index_with_unused_dependency(self, shared_mock):
+        """
+        Dependencies which are not used by any project should still be in the
+        index.
+        """
+        dependency = DependencyFactory.create()
+
+        self.assertEqual(
+            [DependencyIndexEntry(dependency, None, False)],
+            get_dependency_index(dependency.job.pk))
+        self.assertEqual(
+            [dependency], get_dependencies_for_job(dependency.job.pk))
+        self.assertEqual([], get_autotracking_for_job(dependency.job.pk))
+
+    def test_get_dependency_index_is_cached(self, shared_mock):
+        """
+        Once the index has been built for a job, it should be served from the
+        cache.
+        """
+        dependency = DependencyFactory.create()
+        project = ProjectFactory.create()
+        ProjectDependency.objects.create(
+            project=project, dependency=dependency)
+        get_dependency_index(dependency.job.pk)
+
+        with self.assertNumQueries(0):
+            get_autotracking_for_job(dependency.job.pk)
+
+    def test_projectdependency_changes_invalidate_index(self, shared_mock):
+        """
+        Creating, updating or deleting a ProjectDependency should invalidate
+        the cached index.
+        """
+        dependency = DependencyFactory.create()
+        project = ProjectFactory.create()
+        self.assertEqual([], get_autotracking_for_job(dependency.job.pk))
+
+        projectdependency = ProjectDependency.objects.create(
+            project=project, dependency=dependency)
+        self.assertEqual(
+            [(dependency, projectdependency)],
+            get_autotracking_for_job(dependency.job.pk))
+
+        projectdependency.auto_track = False
+        projectdependency.save()
+        self.assertEqual([], get_autotracking_for_job(dependency.job.pk))
+
+        projectdependency.delete()
+        self.assertEqual(
+            [DependencyIndexEntry(dependency, None, False)],
+            get_dependency_index(dependency.job.pk))
+
+    def test_dependency_changes_invalidate_index(self, shared_mock):
+        """
+        Deleting a Dependency should invalidate the cached index.
+        """
+        dependency = DependencyFactory.create()
+        job = dependency.job
+        self.assertEqual([dependency], get_dependencies_for_job(job.pk))
+
+        dependency.delete()
+        self.assertEqual([], get_dependencies_for_job(job.pk))
+
+
+@mock.patch("projects.caching.is_cache_shared", return_value=True)
+class VersionTest(TestCase):
+
+    def test_bump_versions_for_job(self, shared_mock):
+        """
+        The versions of the dependencies for the job and the projects that use
+        them should be bumped.
+        """
+        dependency = DependencyFactory.create()
+        project = ProjectFactory.create()
+        other_project = ProjectFactory.create()
+        ProjectDependency.objects.create(
+            project=project, dependency=dependency)
+        project_version = get_project_version(project.pk)
+        other_version = get_project_version(other_project.pk)
+        dependency_version = get_dependency_version(dependency.pk)
+        get_dependency_index(dependency.job.pk)
+
+        with self.assertNumQueries(0):
+            bump_versions_for_job(dependency.job.pk)
+
+        self.assertNotEqual(project_version, get_project_version(project.pk))
+        self.assertNotEqual(
+            dependency_version, get_dependency_version(dependency.pk))
+        self.assertEqual(other_version, get_project_version(other_project.pk))
+
+    def test_build_bumps_versions(self, shared_mock):
+        """
+        Recording a Build should bump the versions for the dependencies of the
+        job and the projects that use them.
+        """
+        dependency = DependencyFactory.create()
+        project = ProjectFactory.create()
+        ProjectDependency.objects.create(
+            project=project, dependency=dependency)
+        project_version = get_project_version(project.pk)
+        dependency_version = get_dependency_version(dependency.pk)
+
+        BuildFactory.create(job=dependency.job)
+
+        self.assertNotEqual(project_version, get_project_version(project.pk))
+        self.assertNotEqual(
+            dependency_version, get_dependency_version(dependency.pk))
+
+    def test_new_projectbuild_bumps_versions(self, shared_mock):
+        """
+        Creating a ProjectBuild should bump the versions for the project and
+        its dependencies.
+        """
+        dependency = DependencyFactory.create()
+        project = ProjectFactory.create()
+        ProjectDependency.objects.create(
+            project=project, dependency=dependency)
+        project_version = get_project_version(project.pk)
+        dependency_version = get_dependency_version(dependency.pk)
+
+        build_project(project, queue_build=False)
+
+        self.assertNotEqual(project_version, get_project_version(project.pk))
+        self.assertNotEqual(
+            dependency_version, get_dependency_version(dependency.pk))
+
+
+class UnsharedCacheTest(TestCase):
+
+    def test_is_cache_shared(self):
+        """
+        The per-process local memory cache isn't shared with the workers.
+        """
+        self.assertFalse(is_cache_shared())
+
+    def test_get_dependency_index_without_shared_cache(self):
+        """
+        Without a shared cache, the index should be built from the database
+        every time, so that changes made by the workers are seen.
+        """
+        dependency = DependencyFactory.create()
+        get_dependency_index(dependency.job.pk)
+
+        with self.assertNumQueries(2):
+            get_autotracking_for_job(dependency.job.pk)
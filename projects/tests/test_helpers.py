@@ -1,7 +1,14 @@
+from datetime import timedelta
+
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.contrib.auth.models import User
+from django.utils import timezone
 import mock
 
+from jenkins.models import Build
+from jenkins.priorities import AUTOMATED, INTERACTIVE
+from jenkins.utils import get_build_reuse_key
 from projects.models import (
     ProjectBuild, ProjectDependency, ProjectBuildDependency)
 from projects.helpers import (
@@ -36,9 +43,10 @@ class BuildProjectTest(TestCase):
         self.assertEqual(
             [dependency1.pk, dependency2.pk],
             list(build_dependencies.values_list("dependency", flat=True)))
-        mock_build_job.delay.assert_has_calls(
-            [mock.call(dependency1.job.pk, build_id=new_build.build_key),
-             mock.call(dependency2.job.pk, build_id=new_build.build_key)])
+        kwargs = {"build_id": new_build.build_key, "priority": AUTOMATED}
+        mock_build_job.apply_async.assert_has_calls(
+            [mock.call((dependency1.job.pk,), kwargs, priority=3),
+             mock.call((dependency2.job.pk,), kwargs, priority=3)])
 
     def test_build_project_with_no_queue_build(self):
         """
@@ -69,9 +77,29 @@ class BuildProjectTest(TestCase):
             new_build = build_project(project)
             self.assertIsInstance(new_build, ProjectBuild)
 
-        mock_build_job.delay.assert_called_once_with(
-            dependency.job.pk, build_id=new_build.build_key,
-            params={"THISVALUE": "mako"})
+        mock_build_job.apply_async.assert_called_once_with(
+            (dependency.job.pk,),
+            {"build_id": new_build.build_key, "params": {"THISVALUE": "mako"},
+             "priority": AUTOMATED}, priority=3)
+
+    def test_build_project_with_priority(self):
+        """
+        The priority class should be recorded for the projectbuild, and used
+        when queueing the builds of the dependencies.
+        """
+        project = ProjectFactory.create()
+        dependency = DependencyFactory.create()
+        ProjectDependency.objects.create(
+            project=project, dependency=dependency)
+
+        with mock.patch("projects.helpers.build_job") as mock_build_job:
+            new_build = build_project(project, priority=INTERACTIVE)
+
+        self.assertEqual(INTERACTIVE, new_build.priority)
+        mock_build_job.apply_async.assert_called_once_with(
+            (dependency.job.pk,),
+            {"build_id": new_build.build_key, "priority": INTERACTIVE},
+            priority=9)
 
     def test_build_project_assigns_user_correctly(self):
         """
@@ -148,6 +176,194 @@ class BuildProjectTest(TestCase):
         self.assertEqual(built_dependency2.build, built_dependency1.build)
 
 
+class BuildProjectReuseTest(TestCase):
+
+    def create_reusable_build(self, dependency, **kwargs):
+        options = {
+            "job": dependency.job, "phase": Build.FINALIZED,
+            "status": "SUCCESS", "reuse_key": get_build_reuse_key(
+                dependency.job, dependency.get_build_parameters())}
+        options.update(kwargs)
+        return BuildFactory.create(**options)
+
+    def test_build_project_reuses_builds(self):
+        """
+        With reuse_builds, a recent successful build of the dependency with
+        the same parameters should be used instead of queueing a new build.
+        """
+        project = ProjectFactory.create()
+        dependency1 = DependencyFactory.create(parameters="BRANCH=trunk")
+        ProjectDependency.objects.create(
+            project=project, dependency=dependency1)
+        dependency2 = DependencyFactory.create()
+        ProjectDependency.objects.create(
+            project=project, dependency=dependency2)
+        self.create_reusable_build(dependency1)
+        build = self.create_reusable_build(dependency1)
+        self.create_reusable_build(dependency1, status="FAILURE")
+
+        with mock.patch("projects.helpers.build_job") as mock_build_job:
+            with mock.patch(
+                    "projects.helpers.archive_projectbuild_dependencies"
+                    ) as mock_archive:
+                new_build = build_project(project, reuse_builds=True)
+
+        self.assertEqual(
+            [(dependency1, build), (dependency2, None)],
+            [(x.dependency, x.build) for x in
+             new_build.dependencies.order_by("dependency__job__pk")])
+        # The reused build is archived for the new projectbuild.
+        mock_archive.delay.assert_called_once_with(
+            [new_build.dependencies.get(dependency=dependency1).pk])
+        mock_build_job.apply_async.assert_called_once_with(
+            (dependency2.job.pk,),
+            {"build_id": new_build.build_key, "priority": AUTOMATED},
+            priority=3)
+        self.assertIsNone(new_build.ended_at)
+
+    def test_build_project_reuses_all_builds(self):
+        """
+        If every dependency can be reused, then the projectbuild is complete.
+        """
+        project = ProjectFactory.create()
+        dependency = DependencyFactory.create()
+        ProjectDependency.objects.create(
+            project=project, dependency=dependency)
+        self.create_reusable_build(dependency)
+
+        with mock.patch("projects.helpers.build_job") as mock_build_job:
+            with mock.patch(
+                    "projects.helpers.archive_projectbuild_dependencies"):
+                new_build = build_project(project, reuse_builds=True)
+
+        self.assertEqual([], mock_build_job.apply_async.mock_calls)
+        self.assertEqual(Build.FINALIZED, new_build.phase)
+        self.assertEqual("SUCCESS", new_build.status)
+        self.assertIsNotNone(new_build.ended_at)
+        self.assertTrue(new_build.dependencies.get().on_critical_path)
+
+    def test_build_project_does_not_reuse_stale_or_different_builds(self):
+        """
+        Builds with different parameters, or that are too old, shouldn't be
+        reused.
+        """
+        project = ProjectFactory.create()
+        dependency = DependencyFactory.create(parameters="BRANCH=trunk")
+        ProjectDependency.objects.create(
+            project=project, dependency=dependency)
+        build = self.create_reusable_build(dependency)
+        Build.objects.filter(pk=build.pk).update(
+            created_at=timezone.now() - timedelta(hours=2))
+        self.create_reusable_build(
+            dependency, reuse_key=get_build_reuse_key(
+                dependency.job, {"BRANCH": "stable"}))
+
+        with mock.patch("projects.helpers.build_job") as mock_build_job:
+            new_build = build_project(project, reuse_builds=True)
+
+        self.assertIsNone(new_build.dependencies.get().build)
+        self.assertEqual(1, len(mock_build_job.apply_async.mock_calls))
+
+    def test_build_project_reuse_dependency_without_job(self):
+        """
+        Dependencies without a job are skipped when looking for builds to
+        reuse.
+        """
+        project = ProjectFactory.create()
+        dependency = DependencyFactory.create(job=None)
+        ProjectDependency.objects.create(
+            project=project, dependency=dependency)
+
+        new_build = build_project(
+            project, reuse_builds=True, queue_build=False)
+
+        self.assertIsNone(new_build.dependencies.get().build)
+
+    @override_settings(REUSE_DEPENDENCY_BUILDS=True)
+    def test_build_project_reuse_setting(self):
+        """
+        Reusing builds can be enabled with the REUSE_DEPENDENCY_BUILDS setting.
+        """
+        project = ProjectFactory.create()
+        dependency = DependencyFactory.create()
+        ProjectDependency.objects.create(
+            project=project, dependency=dependency)
+        build = self.create_reusable_build(dependency)
+
+        with mock.patch("projects.helpers.build_job"), mock.patch(
+                "projects.helpers.archive_projectbuild_dependencies"):
+            self.assertEqual(
+                build, build_project(project).dependencies.get().build)
+            self.assertIsNone(build_project(
+                project, reuse_builds=False).dependencies.get().build)
+
+
+class BuildProjectShareTest(TestCase):
+
+    def create_projects(self):
+        """
+        Create two projects which share a dependency.
+        """
+        dependency = DependencyFactory.create()
+        project1, project2 = ProjectFactory.create_batch(2)
+        for project in [project1, project2]:
+            ProjectDependency.objects.create(
+                project=project, dependency=dependency)
+        return project1, project2, dependency
+
+    def test_build_project_shares_queued_builds(self):
+        """
+        If a build of the dependency has already been queued for another
+        projectbuild, then the build should be shared rather than queueing
+        another.
+        """
+        project1, project2, dependency = self.create_projects()
+
+        with mock.patch("projects.helpers.build_job") as mock_build_job:
+            projectbuild1 = build_project(project1)
+            projectbuild2 = build_project(project2)
+
+        mock_build_job.apply_async.assert_called_once_with(
+            (dependency.job.pk,),
+            {"build_id": projectbuild1.build_key, "priority": AUTOMATED},
+            priority=3)
+        self.assertEqual(
+            projectbuild1.build_key,
+            projectbuild2.dependencies.get().queued_build_key)
+
+    def test_build_project_does_not_share_unqueued_or_finished_builds(self):
+        """
+        Builds are only shared while they're queued or running.
+        """
+        project1, project2, dependency = self.create_projects()
+        build_project(project1, queue_build=False)
+
+        with mock.patch("projects.helpers.build_job") as mock_build_job:
+            projectbuild2 = build_project(project2)
+            projectbuild2.dependencies.update(build=BuildFactory.create())
+            projectbuild3 = build_project(project1)
+
+        mock_build_job.apply_async.assert_has_calls(
+            [mock.call((dependency.job.pk,),
+                       {"build_id": projectbuild2.build_key,
+                        "priority": AUTOMATED}, priority=3),
+             mock.call((dependency.job.pk,),
+                       {"build_id": projectbuild3.build_key,
+                        "priority": AUTOMATED}, priority=3)])
+
+    def test_build_project_without_sharing(self):
+        """
+        Sharing builds can be disabled.
+        """
+        project1, project2, dependency = self.create_projects()
+
+        with mock.patch("projects.helpers.build_job") as mock_build_job:
+            build_project(project1)
+            build_project(project2, share_builds=False)
+
+        self.assertEqual(2, len(mock_build_job.apply_async.mock_calls))
+
+
 class BuildDependencyTest(TestCase):
 
     def test_build_dependency(self):
@@ -159,7 +375,8 @@ class BuildDependencyTest(TestCase):
         with mock.patch("projects.helpers.build_job") as mock_build_job:
             build_dependency(dependency)
 
-        mock_build_job.delay.assert_called_once_with(dependency.job.pk)
+        mock_build_job.apply_async.assert_called_once_with(
+            (dependency.job.pk,), {"priority": AUTOMATED}, priority=3)
 
     def test_build_dependency_with_parameters(self):
         """
@@ -172,8 +389,10 @@ class BuildDependencyTest(TestCase):
         with mock.patch("projects.helpers.build_job") as mock_build_job:
             build_dependency(dependency)
 
-        mock_build_job.delay.assert_called_once_with(
-            dependency.job.pk, params={"THISVAL": "500", "THATVAL": "testing"})
+        mock_build_job.apply_async.assert_called_once_with(
+            (dependency.job.pk,),
+            {"params": {"THISVAL": "500", "THATVAL": "testing"},
+             "priority": AUTOMATED}, priority=3)
 
     def test_build_dependency_with_build_id(self):
         """
@@ -185,8 +404,9 @@ class BuildDependencyTest(TestCase):
         with mock.patch("projects.helpers.build_job") as mock_build_job:
             build_dependency(dependency, build_id="201403.2")
 
-        mock_build_job.delay.assert_called_once_with(
-            dependency.job.pk, build_id="201403.2")
+        mock_build_job.apply_async.assert_called_once_with(
+            (dependency.job.pk,),
+            {"build_id": "201403.2", "priority": AUTOMATED}, priority=3)
 
     def test_build_dependency_with_user(self):
         """
@@ -199,5 +419,7 @@ class BuildDependencyTest(TestCase):
         with mock.patch("projects.helpers.build_job") as mock_build_job:
             build_dependency(dependency, build_id="201403.2", user=user)
 
-        mock_build_job.delay.assert_called_once_with(
-            dependency.job.pk, build_id="201403.2", user="testing")
+        mock_build_job.apply_async.assert_called_once_with(
+            (dependency.job.pk,),
+            {"build_id": "201403.2", "user": "testing",
+             "priority": AUTOMATED}, priority=3)
@@ -4,14 +4,19 @@ from datetime import timedelta
 from django.test import TestCase
 from django.contrib.auth.models import User
 from django.utils import timezone
+from django.core.exceptions import ValidationError
+import mock
 from jenkins.models import Build
 
 from projects.models import (
-    Dependency, ProjectDependency, ProjectBuild, generate_projectbuild_id)
-from projects.tasks import process_build_dependencies
+    Dependency, ProjectDependency, ProjectBuild, ProjectBuildDependency,
+    generate_projectbuild_id, get_current_builds)
+from projects.tasks import (
+    process_build_dependencies, update_projectbuild_state)
 from .factories import (
     ProjectFactory, DependencyFactory, ProjectBuildFactory)
 from jenkins.tests.factories import JobFactory, BuildFactory, ArtifactFactory
+from archives.tests.factories import ArchiveFactory
 
 
 class DependencyTest(TestCase):
@@ -41,6 +46,20 @@ class DependencyTest(TestCase):
         dependency = DependencyFactory.create()
         self.assertEqual(None, dependency.get_current_build())
 
+    def test_get_current_builds(self):
+        """
+        get_current_builds should return the pks of the current builds for
+        several dependencies in a single query.
+        """
+        build = BuildFactory.create(phase=Build.FINALIZED, status="SUCCESS")
+        dependency1 = DependencyFactory.create(job=build.job)
+        dependency2 = DependencyFactory.create()
+
+        with self.assertNumQueries(1):
+            current_builds = get_current_builds([dependency1, dependency2])
+        self.assertEqual(
+            {dependency1.pk: build.pk, dependency2.pk: None}, current_builds)
+
     def test_get_parameters(self):
         """
         Dependency.get_build_parameters should return a dictionary parsed from
@@ -76,9 +95,74 @@ class DependencyTest(TestCase):
         dependency = DependencyFactory.create()
         self.assertFalse(dependency.is_building)
 
-        BuildFactory.create(job=dependency.job)
+        build = BuildFactory.create(job=dependency.job)
+        dependency = Dependency.objects.get(pk=dependency.pk)
         self.assertTrue(dependency.is_building)
 
+        build.phase = Build.FINALIZED
+        build.save()
+        dependency = Dependency.objects.get(pk=dependency.pk)
+        self.assertFalse(dependency.is_building)
+
+    def test_build_state_is_updated_by_builds(self):
+        """
+        The last_build and building_count should track the builds of the
+        dependency's job.
+        """
+        dependency = DependencyFactory.create()
+        build1 = BuildFactory.create(job=dependency.job)
+        build2 = BuildFactory.create(job=dependency.job)
+
+        dependency = Dependency.objects.get(pk=dependency.pk)
+        self.assertEqual(2, dependency.building_count)
+        self.assertIsNone(dependency.get_current_build())
+
+        build1.phase = Build.FINALIZED
+        build1.save()
+        dependency = Dependency.objects.get(pk=dependency.pk)
+        self.assertEqual(1, dependency.building_count)
+        self.assertEqual(build1, dependency.get_current_build())
+
+        build2.phase = Build.FINALIZED
+        build2.save()
+        dependency = Dependency.objects.get(pk=dependency.pk)
+        self.assertEqual(0, dependency.building_count)
+        self.assertEqual(build2, dependency.get_current_build())
+
+        build2.delete()
+        dependency = Dependency.objects.get(pk=dependency.pk)
+        self.assertEqual(build1, dependency.get_current_build())
+
+    def test_build_state_does_not_use_dependency_index(self):
+        """
+        The dependencies to update should be read from the database, so that
+        a stale cached dependency index doesn't prevent the update.
+        """
+        dependency = DependencyFactory.create()
+
+        with mock.patch(
+                "projects.caching.get_dependency_index", return_value=[]):
+            build = BuildFactory.create(
+                job=dependency.job, phase=Build.FINALIZED)
+
+        dependency = Dependency.objects.get(pk=dependency.pk)
+        self.assertEqual(build, dependency.get_current_build())
+
+    def test_build_state_when_job_is_changed(self):
+        """
+        If the job for a dependency changes, then the build state should be
+        taken from the new job.
+        """
+        dependency = DependencyFactory.create()
+        build = BuildFactory.create(phase=Build.FINALIZED)
+
+        dependency.job = build.job
+        dependency.save()
+
+        dependency = Dependency.objects.get(pk=dependency.pk)
+        self.assertEqual(build, dependency.get_current_build())
+        self.assertEqual(0, dependency.building_count)
+
 
 class ProjectDependencyTest(TestCase):
 
@@ -114,6 +198,39 @@ class ProjectTest(TestCase):
 
         self.assertEqual([artifact2], list(project.get_current_artifacts()))
 
+    def test_next_scheduled_build(self):
+        """
+        The next scheduled build is calculated when the schedule changes.
+        """
+        project = ProjectFactory.create()
+        self.assertIsNone(project.next_scheduled_build)
+
+        project.schedule = "*/5 * * * *"
+        project.save()
+        next_scheduled_build = project.next_scheduled_build
+        self.assertEqual(0, next_scheduled_build.minute % 5)
+        self.assertGreater(next_scheduled_build, timezone.now())
+        self.assertLessEqual(
+            next_scheduled_build, timezone.now() + timedelta(minutes=5))
+
+        project.name = "Renamed"
+        project.save()
+        self.assertEqual(next_scheduled_build, project.next_scheduled_build)
+
+        project.schedule = ""
+        project.save()
+        self.assertIsNone(project.next_scheduled_build)
+
+    def test_schedule_validation(self):
+        """
+        The schedule must be a valid cron-like schedule.
+        """
+        project = ProjectFactory.build(schedule="0 0 * *")
+        with self.assertRaises(ValidationError):
+            project.full_clean()
+        project.schedule = "0 0 * * 1-5"
+        project.full_clean()
+
     def test_get_current_projectbuild(self):
         """
         Project.get_current_projectbuild returns the most recent ProjectBuild
@@ -178,6 +295,104 @@ class ProjectBuildTest(TestCase):
         build2 = ProjectBuildFactory.create(project=build1.project)
         self.assertNotEqual(build1.build_key, build2.build_key)
 
+    def test_get_current_artifacts_with_shared_build(self):
+        """
+        The artifacts for a projectbuild should include those from builds
+        shared with other projectbuilds.
+        """
+        projectbuild1 = ProjectBuildFactory.create()
+        projectbuild2 = ProjectBuildFactory.create()
+        dependency = DependencyFactory.create()
+        build = BuildFactory.create(
+            job=dependency.job, build_id=projectbuild1.build_key)
+        artifact = ArtifactFactory.create(build=build)
+        for projectbuild in [projectbuild1, projectbuild2]:
+            ProjectBuildDependency.objects.create(
+                projectbuild=projectbuild, dependency=dependency, build=build,
+                queued_build_key=projectbuild1.build_key)
+
+        self.assertEqual(
+            [artifact], list(projectbuild1.get_current_artifacts()))
+        self.assertEqual(
+            [artifact], list(projectbuild2.get_current_artifacts()))
+
+    def test_get_current_artifacts_with_reused_build(self):
+        """
+        The artifacts for a projectbuild should include those from builds
+        reused from before the projectbuild was requested.
+        """
+        projectbuild = ProjectBuildFactory.create()
+        dependency = DependencyFactory.create()
+        build = BuildFactory.create(job=dependency.job, build_id="")
+        artifact = ArtifactFactory.create(build=build)
+        ProjectBuildDependency.objects.create(
+            projectbuild=projectbuild, dependency=dependency, build=build)
+
+        self.assertEqual(
+            [artifact], list(projectbuild.get_current_artifacts()))
+
+    def test_write_manifest(self):
+        """
+        ProjectBuild.write_manifest records the current artifacts for the
+        projectbuild along with the details of archived artifacts.
+        """
+        projectbuild = ProjectBuildFactory.create(phase=Build.FINALIZED)
+        dependency = DependencyFactory.create()
+        build = BuildFactory.create(
+            job=dependency.job, build_id=projectbuild.build_key)
+        artifact1 = ArtifactFactory.create(build=build, filename="file1.gz")
+        artifact2 = ArtifactFactory.create(build=build, filename="file2.gz")
+        projectbuild_dependency = ProjectBuildDependency.objects.create(
+            projectbuild=projectbuild, dependency=dependency, build=build)
+        archive = ArchiveFactory.create(default=True)
+        item = archive.add_artifact(
+            artifact2, build, dependency=dependency,
+            projectbuild_dependency=projectbuild_dependency)
+        item.archived_at = timezone.now()
+        item.archived_size = 1024
+        item.sha256 = "a" * 64
+        item.save()
+
+        projectbuild.write_manifest()
+
+        manifest = list(projectbuild.manifest.all())
+        self.assertEqual(
+            [(artifact1, build, "file1.gz", artifact1.url, None, "", ""),
+             (artifact2, build, "file2.gz", artifact2.url, 1024, "a" * 64,
+              item.get_url())],
+            [(x.artifact, x.build, x.filename, x.url, x.size, x.checksum,
+              x.archive_url) for x in manifest])
+        self.assertEqual(
+            [artifact1.url, item.get_url()], [x.get_url() for x in manifest])
+
+        # Writing the manifest again replaces the entries.
+        projectbuild.write_manifest()
+        self.assertEqual(2, projectbuild.manifest.count())
+
+    def test_manifest_written_when_finalized(self):
+        """
+        The manifest is written when the builds of the dependencies are
+        FINALIZED.
+        """
+        dependency = DependencyFactory.create()
+        ProjectDependency.objects.create(
+            project=self.project, dependency=dependency)
+        from projects.helpers import build_project
+        projectbuild = build_project(self.project, queue_build=False)
+        build = BuildFactory.create(
+            job=dependency.job, build_id=projectbuild.build_key,
+            phase=Build.STARTED)
+        artifact = ArtifactFactory.create(build=build)
+
+        process_build_dependencies(build.pk)
+        self.assertEqual(0, projectbuild.manifest.count())
+
+        build.phase = Build.FINALIZED
+        build.save()
+        process_build_dependencies(build.pk)
+        self.assertEqual(
+            [artifact], [x.artifact for x in projectbuild.manifest.all()])
+
     def test_instantiation(self):
         """
         We can create ProjectBuilds.
@@ -234,6 +449,8 @@ class ProjectBuildTest(TestCase):
             "Build with no artifacts can be archived")
         for build in builds:
             ArtifactFactory.create(build=build)
+        # The manifest is rewritten when the builds are processed again.
+        update_projectbuild_state(projectbuild)
         self.assertTrue(
             projectbuild.can_be_archived,
             "Build with artifacts can't be archived")
@@ -0,0 +1,163 @@
+from __future__ import unicode_literals
+from datetime import datetime
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+import mock
+
+from jenkins.models import Build
+from jenkins.tests.factories import (
+    JenkinsServerFactory, JobFactory, BuildFactory)
+from projects.helpers import build_project
+from projects.models import ProjectDependency
+from projects.schedules import (
+    parse_schedule, get_next_scheduled_time, get_queue_depths,
+    get_scheduled_build_delays)
+from projects.tests.factories import ProjectFactory, DependencyFactory
+
+
+def utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+class ParseScheduleTest(TestCase):
+
+    def test_parse_schedule(self):
+        """
+        parse_schedule parses the fields of a cron-like schedule.
+        """
+        cron = parse_schedule("*/30 2 1,15 * 1-5")
+        self.assertEqual(set([0, 30]), cron.minute)
+        self.assertEqual(set([2]), cron.hour)
+        self.assertEqual(set([1, 15]), cron.day_of_month)
+        self.assertEqual(set(range(1, 13)), cron.month_of_year)
+        self.assertEqual(set([1, 2, 3, 4, 5]), cron.day_of_week)
+
+    def test_parse_invalid_schedule(self):
+        """
+        parse_schedule raises ValueError for invalid schedules.
+        """
+        for schedule in ["", "* * * *", "61 * * * *", "* * * * * *",
+                         "a b c d e"]:
+            with self.assertRaises(ValueError):
+                parse_schedule(schedule)
+
+
+class GetNextScheduledTimeTest(TestCase):
+
+    def test_get_next_scheduled_time(self):
+        """
+        get_next_scheduled_time returns the first time after the provided
+        time that matches the schedule.
+        """
+        # 2014-06-06 is a Friday.
+        now = utc(2014, 6, 6, 1, 30, 15)
+        tests = [
+            ("0 0 * * *", utc(2014, 6, 7, 0, 0)),
+            ("*/15 * * * *", utc(2014, 6, 6, 1, 45)),
+            ("30 1 * * *", utc(2014, 6, 7, 1, 30)),
+            ("0 2 * * 1-5", utc(2014, 6, 6, 2, 0)),
+            ("0 0 * * 1-5", utc(2014, 6, 9, 0, 0)),
+            ("0 0 1 * *", utc(2014, 7, 1, 0, 0)),
+            ("0 0 29 2 *", utc(2016, 2, 29, 0, 0)),
+        ]
+        for schedule, expected in tests:
+            self.assertEqual(
+                expected, get_next_scheduled_time(schedule, now), schedule)
+
+
+class ScheduledBuildDelaysTest(TestCase):
+
+    def create_project(self, server):
+        project = ProjectFactory.create()
+        dependency = DependencyFactory.create(
+            job=JobFactory.create(server=server))
+        ProjectDependency.objects.create(
+            project=project, dependency=dependency)
+        return project
+
+    def test_get_queue_depths(self):
+        """
+        get_queue_depths counts the dependency builds which are queued on each
+        server, but haven't started.
+        """
+        server1 = JenkinsServerFactory.create()
+        server2 = JenkinsServerFactory.create()
+        project1 = self.create_project(server1)
+        project2 = self.create_project(server2)
+        # ProjectBuilds that don't queue builds aren't counted.
+        build_project(project1, queue_build=False)
+        with mock.patch("projects.helpers.build_job"):
+            build_project(project1)
+            build_project(project1, share_builds=False)
+            build_project(project2)
+            # Shared builds are only counted once.
+            build_project(project2)
+            # Builds that have started aren't counted.
+            started = build_project(project2, share_builds=False)
+        BuildFactory.create(
+            job=project2.dependencies.get().job, build_id=started.build_key,
+            phase=Build.STARTED)
+
+        self.assertEqual({server1.pk: 2, server2.pk: 1}, get_queue_depths())
+
+    def test_get_queue_depths_without_queued_builds(self):
+        """
+        If no builds are queued, then the builds aren't queried.
+        """
+        with self.assertNumQueries(1):
+            self.assertEqual({}, get_queue_depths())
+
+    @override_settings(
+        SCHEDULED_BUILD_WINDOW=600, SCHEDULED_BUILD_JITTER=0)
+    def test_get_scheduled_build_delays(self):
+        """
+        The scheduled builds for each server are spread across the window
+        after the builds already queued on the server.
+        """
+        server1 = JenkinsServerFactory.create()
+        server2 = JenkinsServerFactory.create()
+        projects1 = [self.create_project(server1) for x in range(2)]
+        projects2 = [self.create_project(server2) for x in range(3)]
+        project3 = ProjectFactory.create()
+
+        delays = get_scheduled_build_delays(
+            projects1 + projects2 + [project3],
+            queue_depths={server1.pk: 2})
+
+        self.assertEqual(
+            [300, 450], [delays[x.pk] for x in projects1])
+        self.assertEqual(
+            [0, 200, 400], [delays[x.pk] for x in projects2])
+        self.assertEqual(0, delays[project3.pk])
+
+    @override_settings(
+        SCHEDULED_BUILD_WINDOW=600, SCHEDULED_BUILD_JITTER=0)
+    def test_get_scheduled_build_delays_uses_busiest_server(self):
+        """
+        Projects with dependencies on several servers are spread with the
+        builds of the busiest server.
+        """
+        server1 = JenkinsServerFactory.create()
+        server2 = JenkinsServerFactory.create()
+        project = self.create_project(server1)
+        ProjectDependency.objects.create(
+            project=project, dependency=DependencyFactory.create(
+                job=JobFactory.create(server=server2)))
+
+        delays = get_scheduled_build_delays(
+            [project], queue_depths={server1.pk: 1, server2.pk: 3})
+
+        self.assertEqual({project.pk: 450}, delays)
+
+    @override_settings(
+        SCHEDULED_BUILD_WINDOW=600, SCHEDULED_BUILD_JITTER=30)
+    def test_get_scheduled_build_delays_with_jitter(self):
+        """
+        Each scheduled build is delayed by a random jitter.
+        """
+        project = ProjectFactory.create()
+        for x in range(10):
+            delays = get_scheduled_build_delays([project], queue_depths={})
+            self.assertTrue(0 <= delays[project.pk] <= 30)
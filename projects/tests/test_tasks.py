@@ -1,21 +1,24 @@
 from __future__ import unicode_literals
+from datetime import timedelta
 from smtplib import SMTPException
 
 from django.test import TestCase
 from django.core import mail
 from django.contrib.auth.models import User
 from django.test.utils import override_settings
+from django.utils import timezone
 import mock
 
 from jenkins.models import Build
+from jenkins.priorities import AUTOMATED
 
 from projects.helpers import build_project
 from projects.models import (
-    ProjectDependency, ProjectBuildDependency, ProjectBuild)
+    ProjectDependency, ProjectBuildDependency, ProjectBuild, Project)
 from projects.tests.factories import DependencyFactory, ProjectFactory
 from projects.tasks import (
     process_build_dependencies, send_email_to_requestor, projectbuild_url,
-    get_base_url, send_email)
+    get_base_url, send_email, queue_scheduled_builds, build_scheduled_project)
 from jenkins.tests.factories import BuildFactory, ArtifactFactory
 
 
@@ -182,6 +185,36 @@ class ProcessBuildDependenciesTest(TestCase):
             dependency=dependency2)
         self.assertEqual(existing_build, build_dependency2.build)
 
+    def test_automated_projectbuild_manifest(self):
+        """
+        The manifest of an automatically created ProjectBuild has the
+        artifacts of the build that triggered it, and of the last known
+        builds of the other dependencies.
+        """
+        dependency1 = DependencyFactory.create()
+        ProjectDependency.objects.create(
+            project=self.project, dependency=dependency1)
+        dependency2 = DependencyFactory.create()
+        existing_build = BuildFactory.create(
+            job=dependency2.job, phase=Build.FINALIZED)
+        artifact2 = ArtifactFactory.create(build=existing_build)
+        ProjectDependency.objects.create(
+            project=self.project, dependency=dependency2,
+            current_build=existing_build)
+
+        build = BuildFactory.create(job=dependency1.job, phase=Build.FINALIZED)
+        artifact1 = ArtifactFactory.create(build=build)
+        process_build_dependencies(build.pk)
+
+        projectbuild = ProjectBuild.objects.get(project=self.project)
+        self.assertEqual(
+            set([artifact1, artifact2]),
+            set(x.artifact for x in projectbuild.manifest.all()))
+        self.assertEqual(
+            set([artifact1, artifact2]),
+            set(projectbuild.get_current_artifacts()))
+        self.assertTrue(projectbuild.can_be_archived)
+
     def test_build_with_projectbuild_dependencies(self):
         """
         ProjectBuildDependencies should be tied to the newly created build.
@@ -232,6 +265,70 @@ class ProcessBuildDependenciesTest(TestCase):
             sorted([b.build for b in
                     ProjectBuildDependency.objects.all()]))
 
+    def test_projectbuild_records_queue_wait(self):
+        """
+        The time between the projectbuild being requested and the build
+        starting should be recorded.
+        """
+        project, dependency = self.create_dependencies()
+        projectbuild = build_project(project, queue_build=False)
+        ProjectBuild.objects.filter(pk=projectbuild.pk).update(
+            requested_at=projectbuild.requested_at - timedelta(minutes=5))
+
+        build = BuildFactory.create(
+            job=dependency.job, build_id=projectbuild.build_key,
+            started_at=timezone.now())
+        process_build_dependencies(build.pk)
+
+        queue_wait = ProjectBuildDependency.objects.get(
+            projectbuild=projectbuild).queue_wait
+        self.assertTrue(300 <= queue_wait < 310)
+
+    def test_projectbuild_without_start_time(self):
+        """
+        If we weren't notified when the build started, then the queue wait
+        isn't recorded.
+        """
+        project, dependency = self.create_dependencies()
+        projectbuild = build_project(project, queue_build=False)
+
+        build = BuildFactory.create(
+            job=dependency.job, build_id=projectbuild.build_key)
+        process_build_dependencies(build.pk)
+
+        dependency = ProjectBuildDependency.objects.get(
+            projectbuild=projectbuild)
+        self.assertEqual(build, dependency.build)
+        self.assertIsNone(dependency.queue_wait)
+
+    def test_shared_build_updates_all_projectbuilds(self):
+        """
+        A build that was shared by several projectbuilds should be associated
+        with each of them, and the projectbuilds updated.
+        """
+        project1, dependency = self.create_dependencies()
+        project2 = ProjectFactory.create()
+        ProjectDependency.objects.create(
+            project=project2, dependency=dependency, auto_track=False)
+
+        with mock.patch("projects.helpers.build_job") as mock_build_job:
+            projectbuild1 = build_project(project1)
+            projectbuild2 = build_project(project2)
+        self.assertEqual(1, len(mock_build_job.apply_async.mock_calls))
+
+        build = BuildFactory.create(
+            job=dependency.job, build_id=projectbuild1.build_key,
+            phase=Build.FINALIZED, status="SUCCESS")
+        process_build_dependencies(build.pk)
+
+        for projectbuild in [projectbuild1, projectbuild2]:
+            projectbuild = ProjectBuild.objects.get(pk=projectbuild.pk)
+            self.assertEqual(build, projectbuild.dependencies.get().build)
+            self.assertEqual(Build.FINALIZED, projectbuild.phase)
+            self.assertEqual("SUCCESS", projectbuild.status)
+        # No additional projectbuilds are created for autotracking.
+        self.assertEqual(2, ProjectBuild.objects.count())
+
 
 class SendEmailTaskTest(TestCase):
 
@@ -323,3 +420,68 @@ class SendEmailTaskTest(TestCase):
         base_url = get_base_url()
         self.assertIsNotNone(base_url)
         self.assertTrue(isinstance(base_url, basestring))
+
+
+class ScheduledBuildsTaskTest(TestCase):
+
+    def test_queue_scheduled_builds(self):
+        """
+        queue_scheduled_builds queues builds of the projects whose scheduled
+        builds are due, and moves their schedules on.
+        """
+        project1 = ProjectFactory.create(schedule="0 0 * * *")
+        project2 = ProjectFactory.create(schedule="0 0 * * *")
+        ProjectFactory.create()
+        Project.objects.filter(pk=project1.pk).update(
+            next_scheduled_build=timezone.now() - timedelta(minutes=1))
+
+        with mock.patch(
+                "projects.tasks.build_scheduled_project") as build_mock:
+            with mock.patch(
+                    "projects.tasks.get_scheduled_build_delays",
+                    return_value={project1.pk: 120}) as delays_mock:
+                queue_scheduled_builds()
+
+        self.assertEqual(
+            [project1], list(delays_mock.call_args[0][0]))
+        build_mock.apply_async.assert_called_once_with(
+            (project1.pk,), countdown=120)
+        project1 = Project.objects.get(pk=project1.pk)
+        self.assertGreater(project1.next_scheduled_build, timezone.now())
+        self.assertEqual(
+            project2.next_scheduled_build,
+            Project.objects.get(pk=project2.pk).next_scheduled_build)
+
+    def test_queue_scheduled_builds_with_no_builds_due(self):
+        """
+        If no scheduled builds are due, then nothing is queued.
+        """
+        ProjectFactory.create(schedule="0 0 * * *")
+
+        with mock.patch(
+                "projects.tasks.build_scheduled_project") as build_mock:
+            queue_scheduled_builds()
+
+        self.assertFalse(build_mock.apply_async.called)
+
+    def test_build_scheduled_project(self):
+        """
+        build_scheduled_project builds the project with the automated
+        priority.
+        """
+        project = ProjectFactory.create(schedule="0 0 * * *")
+        dependency = DependencyFactory.create()
+        ProjectDependency.objects.create(
+            project=project, dependency=dependency)
+
+        with mock.patch("projects.helpers.build_job") as build_job_mock:
+            projectbuild_pk = build_scheduled_project(project.pk)
+
+        projectbuild = ProjectBuild.objects.get(pk=projectbuild_pk)
+        self.assertEqual(project, projectbuild.project)
+        self.assertEqual(AUTOMATED, projectbuild.priority)
+        self.assertIsNone(projectbuild.requested_by)
+        build_job_mock.apply_async.assert_called_once_with(
+            (dependency.job.pk,),
+            {"build_id": projectbuild.build_key, "priority": AUTOMATED},
+            priority=3)
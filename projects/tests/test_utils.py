@@ -1,9 +1,22 @@
+from datetime import timedelta
+
 from django.test import TestCase
+from django.utils import timezone
+import mock
 
-from .factories import ProjectFactory, DependencyFactory
+from .factories import (
+    ProjectFactory, DependencyFactory, ProjectBuildFactory)
+from projects.helpers import build_project
+from projects.tasks import process_build_dependencies
+from jenkins.priorities import INTERACTIVE, AUTOMATED
 from jenkins.tests.factories import BuildFactory
-from projects.models import ProjectDependency
-from projects.utils import get_build_table_for_project
+from jenkins.models import Build
+from projects.models import (
+    ProjectDependency, ProjectBuild, ProjectBuildDependency)
+from projects.utils import (
+    get_build_table_for_project, get_cached_build_table_for_project,
+    get_recent_builds_for_jobs, get_queue_wait_by_priority,
+    get_projectbuild_timeline, mark_critical_path, get_critical_path_summary)
 
 
 class GetBuildTableForProjectTest(TestCase):
@@ -93,3 +106,302 @@ class GetBuildTableForProjectTest(TestCase):
             [{"build": build2, "current": False}],
             [{"build": build1, "current": False}],
             [{"build": build, "current": True}]], table)
+
+    def test_get_build_table_for_project_with_count(self):
+        """
+        We can request a different number of recent builds for the table.
+        """
+        project = ProjectFactory.create()
+        dependency = DependencyFactory.create()
+        [build1, build2, build3] = BuildFactory.create_batch(
+            3, job=dependency.job)
+        ProjectDependency.objects.create(
+            project=project, dependency=dependency, auto_track=False,
+            current_build=build3)
+
+        header, table = get_build_table_for_project(project, count=2)
+
+        self.assertEqual([
+            [{"build": build3, "current": True}],
+            [{"build": build2, "current": False}]], table)
+
+    def test_get_build_table_for_project_uses_fixed_queries(self):
+        """
+        The number of queries should not depend on the number of dependencies
+        in the project.
+        """
+        project = ProjectFactory.create()
+        for dependency in DependencyFactory.create_batch(10):
+            builds = BuildFactory.create_batch(3, job=dependency.job)
+            ProjectDependency.objects.create(
+                project=project, dependency=dependency, auto_track=False,
+                current_build=builds[0])
+
+        with self.assertNumQueries(2):
+            get_build_table_for_project(project)
+
+    @mock.patch("projects.caching.is_cache_shared", return_value=True)
+    def test_get_cached_build_table_for_project(self, shared_mock):
+        """
+        The table should be cached until a build of one of the project's
+        dependencies is recorded.
+        """
+        project = ProjectFactory.create()
+        dependency = DependencyFactory.create()
+        build1 = BuildFactory.create(job=dependency.job)
+        ProjectDependency.objects.create(
+            project=project, dependency=dependency, auto_track=False,
+            current_build=build1)
+        get_cached_build_table_for_project(project)
+
+        with self.assertNumQueries(0):
+            header, table = get_cached_build_table_for_project(project)
+        self.assertEqual([[{"build": build1, "current": True}]], table[:1])
+
+        build2 = BuildFactory.create(job=dependency.job)
+        header, table = get_cached_build_table_for_project(project)
+        self.assertEqual([
+            [{"build": build2, "current": False}],
+            [{"build": build1, "current": True}]], table[:2])
+
+
+class GetRecentBuildsForJobsTest(TestCase):
+
+    def create_builds(self):
+        """
+        Create two dependencies, each with 4 builds.
+        """
+        dependency1, dependency2 = DependencyFactory.create_batch(2)
+        builds1 = BuildFactory.create_batch(4, job=dependency1.job)
+        builds2 = BuildFactory.create_batch(4, job=dependency2.job)
+        return dependency1.job, builds1, dependency2.job, builds2
+
+    def test_get_recent_builds_for_jobs(self):
+        """
+        We should get the most recent builds for each job, and the builds that
+        are explicitly included.
+        """
+        job1, builds1, job2, builds2 = self.create_builds()
+
+        with self.assertNumQueries(1):
+            recent, included = get_recent_builds_for_jobs(
+                [job1.pk, job2.pk], 2, include=[builds1[0].pk])
+
+        self.assertEqual(
+            {job1.pk: [builds1[3], builds1[2]],
+             job2.pk: [builds2[3], builds2[2]]}, recent)
+        self.assertEqual({builds1[0].pk: builds1[0]}, included)
+
+    def test_get_recent_builds_for_jobs_without_window_functions(self):
+        """
+        When the database doesn't support window functions, we should get the
+        same builds, with a query for each job and the included builds.
+        """
+        job1, builds1, job2, builds2 = self.create_builds()
+
+        with mock.patch(
+                "projects.utils.supports_window_functions",
+                return_value=False):
+            with self.assertNumQueries(3):
+                recent, included = get_recent_builds_for_jobs(
+                    [job1.pk, job2.pk], 2, include=[builds2[0].pk])
+
+        self.assertEqual(
+            {job1.pk: [builds1[3], builds1[2]],
+             job2.pk: [builds2[3], builds2[2]]}, recent)
+        self.assertEqual({builds2[0].pk: builds2[0]}, included)
+
+    def test_get_recent_builds_for_no_jobs(self):
+        """
+        If there are no jobs, then we shouldn't query the database.
+        """
+        with self.assertNumQueries(0):
+            self.assertEqual(({}, {}), get_recent_builds_for_jobs([], 5))
+
+
+class GetQueueWaitByPriorityTest(TestCase):
+
+    def test_get_queue_wait_by_priority(self):
+        """
+        The queue waits should be aggregated by the priority class of the
+        projectbuilds.
+        """
+        dependency = DependencyFactory.create()
+        for priority, queue_wait in [
+                (INTERACTIVE, 10), (INTERACTIVE, 20), (AUTOMATED, 300),
+                (AUTOMATED, None)]:
+            ProjectBuildDependency.objects.create(
+                projectbuild=ProjectBuildFactory.create(priority=priority),
+                dependency=dependency, queue_wait=queue_wait)
+
+        self.assertEqual({
+            INTERACTIVE: {"count": 2, "average": 15, "maximum": 20},
+            AUTOMATED: {"count": 1, "average": 300, "maximum": 300}},
+            get_queue_wait_by_priority())
+
+
+class ProjectBuildTimelineTest(TestCase):
+
+    def create_projectbuild(self, project, timings):
+        """
+        Create a FINALIZED projectbuild for the project, with builds of the
+        dependencies starting and ending at the (start, end) offsets in
+        seconds from the time the projectbuild was requested.
+        """
+        projectbuild = ProjectBuildFactory.create(
+            project=project, phase=Build.FINALIZED)
+        requested_at = projectbuild.requested_at
+        for dependency, (start, end) in zip(
+                project.dependencies.order_by("name"), timings):
+            build = None
+            if start is not None:
+                build = BuildFactory.create(
+                    job=dependency.job, duration=(end - start) * 1000,
+                    started_at=requested_at + timedelta(seconds=start),
+                    finalized_at=requested_at + timedelta(seconds=end))
+            ProjectBuildDependency.objects.create(
+                projectbuild=projectbuild, dependency=dependency, build=build)
+        return projectbuild
+
+    def create_project(self, count):
+        project = ProjectFactory.create()
+        for index in range(count):
+            ProjectDependency.objects.create(
+                project=project, dependency=DependencyFactory.create(
+                    name="dependency %d" % index))
+        return project
+
+    def test_get_projectbuild_timeline(self):
+        """
+        The timeline has the queue wait and duration of each dependency
+        build, the dependency which ended last is on the critical path.
+        """
+        project = self.create_project(3)
+        projectbuild = self.create_projectbuild(
+            project, [(10, 100), (30, 400), (-60, -10)])
+
+        with self.assertNumQueries(1):
+            timeline = get_projectbuild_timeline(projectbuild)
+
+        self.assertEqual(400, timeline["wall_time"])
+        self.assertEqual(
+            "dependency 1", timeline["critical"]["dependency"].name)
+        self.assertEqual(
+            [("dependency 0", 10, 10, 90, False),
+             ("dependency 1", 30, 30, 370, True),
+             ("dependency 2", -60, 0, 50, False)],
+            [(x["dependency"].name, x["offset"], x["queue_wait"],
+              x["duration"], x["critical"]) for x in timeline["entries"]])
+        # The timeline runs from the request to the latest end.
+        self.assertEqual(
+            [(10 * 100.0 / 400, 90 * 100.0 / 400),
+             (30 * 100.0 / 400, 370 * 100.0 / 400),
+             (0, 0)],
+            [(x["queue_percent"], x["duration_percent"])
+             for x in timeline["entries"]])
+
+    def test_get_projectbuild_timeline_with_reused_build(self):
+        """
+        Only the part of a reused build after the projectbuild was requested
+        is displayed on the timeline.
+        """
+        project = self.create_project(2)
+        projectbuild = self.create_projectbuild(
+            project, [(-100, 50), (0, 200)])
+
+        timeline = get_projectbuild_timeline(projectbuild)
+
+        self.assertEqual(200, timeline["wall_time"])
+        entry = timeline["entries"][0]
+        self.assertEqual(150, entry["duration"])
+        self.assertEqual(0, entry["queue_percent"])
+        self.assertEqual(50 * 100.0 / 200, entry["duration_percent"])
+
+    def test_get_projectbuild_timeline_with_waiting_builds(self):
+        """
+        Dependencies which are waiting for builds have no times.
+        """
+        project = self.create_project(2)
+        projectbuild = self.create_projectbuild(
+            project, [(10, 100), (None, None)])
+
+        timeline = get_projectbuild_timeline(projectbuild)
+
+        entry = timeline["entries"][1]
+        self.assertIsNone(entry["build"])
+        self.assertIsNone(entry["duration"])
+        self.assertFalse(entry["critical"])
+
+    def test_mark_critical_path(self):
+        """
+        mark_critical_path flags the dependency of the projectbuild which
+        ended last.
+        """
+        project = self.create_project(2)
+        projectbuild = self.create_projectbuild(
+            project, [(10, 500), (30, 400)])
+
+        mark_critical_path(projectbuild)
+
+        self.assertEqual(
+            ["dependency 0"],
+            [x.dependency.name for x in projectbuild.dependencies.filter(
+                on_critical_path=True)])
+
+    def test_critical_path_marked_when_finalized(self):
+        """
+        The critical path is marked when the builds of the dependencies are
+        processed and the projectbuild is FINALIZED.
+        """
+        project = self.create_project(2)
+        projectbuild = build_project(project, queue_build=False)
+        builds = []
+        for index, dependency in enumerate(
+                project.dependencies.order_by("name")):
+            builds.append(BuildFactory.create(
+                job=dependency.job, build_id=projectbuild.build_key,
+                phase=Build.FINALIZED, finalized_at=(
+                    timezone.now() + timedelta(minutes=10 - index))))
+        for build in builds:
+            process_build_dependencies(build.pk)
+
+        self.assertEqual(
+            ["dependency 0"],
+            [x.dependency.name for x in projectbuild.dependencies.filter(
+                on_critical_path=True)])
+
+    def test_get_critical_path_summary(self):
+        """
+        The number of times that each dependency was on the critical path is
+        aggregated across the recent builds of the project.
+        """
+        project = self.create_project(3)
+        for timings in [[(0, 300), (0, 100), (0, 50)],
+                        [(0, 100), (0, 200), (0, 50)],
+                        [(0, 500), (0, 100), (0, 50)]]:
+            mark_critical_path(self.create_projectbuild(project, timings))
+        # Only the most recent builds are included.
+        ProjectBuild.objects.filter(project=project).update(
+            requested_at=timezone.now() - timedelta(days=1))
+        for timings in [[(0, 100), (0, 100), (0, 500)],
+                        [(0, 100), (0, 400), (0, 50)]]:
+            mark_critical_path(self.create_projectbuild(project, timings))
+        # Builds without a critical path aren't counted.
+        mark_critical_path(self.create_projectbuild(
+            project, [(None, None), (None, None), (None, None)]))
+
+        with self.assertNumQueries(2):
+            summary = get_critical_path_summary(project, count=5)
+
+        self.assertEqual(
+            [("dependency 1", 2, 4, 300), ("dependency 0", 1, 4, 500),
+             ("dependency 2", 1, 4, 500)],
+            [(x["name"], x["count"], x["projectbuilds"],
+              x["average_duration"]) for x in summary])
+
+    def test_get_critical_path_summary_with_no_builds(self):
+        """
+        Projects with no FINALIZED builds have an empty summary.
+        """
+        self.assertEqual(
+            [], get_critical_path_summary(ProjectFactory.create()))
@@ -5,6 +5,7 @@ from django_webtest import WebTest
 import mock
 
 from jenkins.models import Job, Build
+from jenkins.priorities import INTERACTIVE
 from jenkins.tests.factories import (
     BuildFactory, JobFactory, JobTypeFactory, JenkinsServerFactory,
     job_with_parameters, ArtifactFactory)
@@ -16,17 +17,26 @@ from projects.tasks import process_build_dependencies
 from .factories import (
     ProjectFactory, DependencyFactory, ProjectBuildFactory)
 from archives.tests.factories import ArchiveFactory
+from capomastro.pagination import encode_cursor
 
 
 # TODO Introduce subclass of WebTest that allows easy assertions that a page
 # requires various permissions...
 # Possibly, through looking to see if Views are mixed in with the various
 # Django-Braces mixins.
-from projects.views import DependencyDetailView, ProjectDetailView
+from projects.views import (
+    DependencyDetailView, ProjectDetailView, ProjectBuildListView)
 
 
 class ProjectDetailTest(WebTest):
 
+    # The session and user, the project, dependencies, projectbuilds, current
+    # projectbuild and its manifest.
+    PROJECT_DETAIL_QUERIES = 7
+    PROJECT_DETAIL_ARCHIVED_QUERIES = 7
+    # The session and user, and the project.
+    PROJECT_DETAIL_CACHED_QUERIES = 3
+
     def setUp(self):
         self.user = User.objects.create_user("testing")
 
@@ -81,8 +91,10 @@ class ProjectDetailTest(WebTest):
         self.assertEqual(200, response.status_code)
         self.assertIsNotNone(
             response.context["project"].get_current_projectbuild())
+        build_name = "%s %s" % (build.job, build.number)
         self.assertEqual(
-            [ProjectDetailView.item_from_artifact(artifact)],
+            [{"build_name": build_name, "filename": "file1.gz",
+              "url": artifact.url, "archived": False}],
             response.context["current_artifacts"])
 
         # Archive the artifact and the view should display the archived item
@@ -90,17 +102,18 @@ class ProjectDetailTest(WebTest):
         items = []
         for x in archive.add_build(build)[artifact]:
             if x.projectbuild_dependency:
-                items.append(ProjectDetailView.item_from_archived_artifact(x))
+                items.append(
+                    {"build_name": build_name, "filename": "file1.gz",
+                     "url": x.get_url(), "archived": True})
 
         project_url = reverse("project_detail", kwargs={"pk": project.pk})
         response = self.app.get(project_url, user="testing")
         self.assertEqual(200, response.status_code)
         self.assertEqual(items, response.context["current_artifacts"])
 
-    def test_item_from_artifact_and_archived_artifact(self):
+    def test_item_from_manifest(self):
         """
-        Return an artifact or archived artifact in a standard format for
-        display.
+        Return an entry from the manifest in a standard format for display.
         """
         project = ProjectFactory.create()
         dependency = DependencyFactory.create()
@@ -110,32 +123,104 @@ class ProjectDetailTest(WebTest):
         build = BuildFactory.create(
             job=dependency.job, build_id=projectbuild.build_key,
             phase=Build.FINALIZED)
-
-        # Create the artifact and check the display format
         artifact = ArtifactFactory.create(build=build, filename="file1.gz")
-        artifact_item = ProjectDetailView.item_from_artifact(artifact)
-        self.assertIsNotNone(artifact_item)
-        self.assertTrue(isinstance(artifact_item, dict))
-        self.assertTrue("build_name" in artifact_item)
-        self.assertTrue("filename" in artifact_item)
-        self.assertTrue("url" in artifact_item)
-        self.assertTrue("archived" in artifact_item)
-
-        # Archive the artifact and check the display format
         process_build_dependencies(build.pk)
+
+        entry = projectbuild.manifest.get()
+        self.assertEqual(
+            {"build_name": "%s %s" % (build.job, build.number),
+             "filename": "file1.gz", "url": artifact.url, "archived": False},
+            ProjectDetailView.item_from_manifest(entry))
+
+        entry.archive_url = "http://example.com/projects/file1.gz"
+        self.assertEqual(
+            {"build_name": "%s %s" % (build.job, build.number),
+             "filename": "file1.gz",
+             "url": "http://example.com/projects/file1.gz", "archived": True},
+            ProjectDetailView.item_from_manifest(entry))
+
+    def create_project_with_artifacts(self, count):
+        """
+        Create a project with count dependencies, each with a FINALIZED build
+        with an artifact.
+        """
+        project = ProjectFactory.create()
+        for dependency in DependencyFactory.create_batch(count):
+            ProjectDependency.objects.create(
+                project=project, dependency=dependency)
+        projectbuild = build_project(project, queue_build=False)
+        builds = []
+        for dependency in project.dependencies.all():
+            build = BuildFactory.create(
+                job=dependency.job, build_id=projectbuild.build_key,
+                phase=Build.FINALIZED)
+            ArtifactFactory.create(build=build)
+            process_build_dependencies(build.pk)
+            builds.append(build)
+        return project, builds
+
+    def test_project_detail_query_budget(self):
+        """
+        The number of queries for the project detail should not depend on the
+        number of dependencies or artifacts.
+        """
+        # Login before we start counting queries.
+        self.app.get(reverse("home"), user="testing")
+        for count in [1, 5]:
+            project, _ = self.create_project_with_artifacts(count)
+            project_url = reverse("project_detail", kwargs={"pk": project.pk})
+            with self.assertNumQueries(self.PROJECT_DETAIL_QUERIES):
+                response = self.app.get(project_url, user="testing")
+            self.assertEqual(count, len(response.context["current_artifacts"]))
+
+    def test_project_detail_archived_query_budget(self):
+        """
+        The number of queries for the project detail should not depend on the
+        number of archived artifacts.
+        """
         archive = ArchiveFactory.create(policy="cdimage", default=True)
-        items = []
-        for x in archive.add_build(build)[artifact]:
-            if x.projectbuild_dependency:
-                items.append(x)
-        self.assertEquals(len(items), 1)
-        archived_item = ProjectDetailView.item_from_archived_artifact(items[0])
-        self.assertIsNotNone(archived_item)
-        self.assertTrue(isinstance(archived_item, dict))
-        self.assertTrue("build_name" in archived_item)
-        self.assertTrue("filename" in archived_item)
-        self.assertTrue("url" in archived_item)
-        self.assertTrue("archived" in archived_item)
+        self.app.get(reverse("home"), user="testing")
+        for count in [1, 5]:
+            project, builds = self.create_project_with_artifacts(count)
+            for build in builds:
+                archive.add_build(build)
+            project_url = reverse("project_detail", kwargs={"pk": project.pk})
+            with self.assertNumQueries(self.PROJECT_DETAIL_ARCHIVED_QUERIES):
+                response = self.app.get(project_url, user="testing")
+            self.assertEqual(count, len(response.context["current_artifacts"]))
+
+    def test_project_detail_without_shared_cache(self):
+        """
+        If the cache isn't shared with the workers, then the rendered
+        fragments shouldn't be cached.
+        """
+        project, builds = self.create_project_with_artifacts(1)
+        project_url = reverse("project_detail", kwargs={"pk": project.pk})
+
+        response = self.app.get(project_url, user="testing")
+        self.assertEqual(0, response.context["cache_timeout"])
+
+    @mock.patch("projects.caching.is_cache_shared", return_value=True)
+    def test_project_detail_is_cached(self, shared_mock):
+        """
+        Repeated views of the project detail should be served from the cache
+        until a build of one of the dependencies is processed.
+        """
+        project, builds = self.create_project_with_artifacts(1)
+        project_url = reverse("project_detail", kwargs={"pk": project.pk})
+        self.app.get(project_url, user="testing")
+
+        with self.assertNumQueries(self.PROJECT_DETAIL_CACHED_QUERIES):
+            response = self.app.get(project_url, user="testing")
+        self.assertEqual(1, len(response.context["current_artifacts"]))
+
+        dependency = project.dependencies.get()
+        build = BuildFactory.create(job=dependency.job, phase=Build.FINALIZED)
+        process_build_dependencies(build.pk)
+
+        response = self.app.get(project_url, user="testing")
+        self.assertEqual(
+            build, response.context["dependencies"][0].current_build)
 
 
 class ProjectCreateTest(WebTest):
@@ -248,9 +333,35 @@ class ProjectBuildListTest(WebTest):
             set([projectbuild]), set(response.context["projectbuilds"]))
         self.assertEqual(project, response.context["project"])
 
+    def test_projectbuild_list_view_pagination(self):
+        """
+        The list view should be paginated, with the most recent projectbuilds
+        first.
+        """
+        project = ProjectFactory.create()
+        projectbuilds = ProjectBuildFactory.create_batch(
+            ProjectBuildListView.PAGINATE_BUILDS + 1, project=project)
+
+        url = reverse("project_projectbuild_list", kwargs={"pk": project.pk})
+        response = self.app.get(url, user="testing")
+
+        self.assertEqual(
+            list(reversed(projectbuilds[1:])),
+            list(response.context["projectbuilds"]))
+        self.assertRaises(IndexError, response.click, "Newer")
+
+        older = response.click("Older")
+        self.assertEqual(
+            [projectbuilds[0]], list(older.context["projectbuilds"]))
+        self.assertRaises(IndexError, older.click, "Older")
+
 
 class ProjectBuildDetailTest(WebTest):
 
+    # The session and user, the projectbuild, dependencies, archive and
+    # archived items.
+    PROJECTBUILD_DETAIL_QUERIES = 6
+
     def setUp(self):
         self.user = User.objects.create_user("testing")
         self.project = ProjectFactory.create()
@@ -305,7 +416,8 @@ class ProjectBuildDetailTest(WebTest):
 
         process_build_dependencies(build.pk)
         archive = ArchiveFactory.create(policy="cdimage", default=True)
-        items = [x for x in archive.add_build(build)[artifact] if x.projectbuild_dependency]
+        items = [x for x in archive.add_build(build)[artifact]
+                 if x.projectbuild_dependency]
 
         url = reverse(
             "project_projectbuild_detail",
@@ -315,6 +427,81 @@ class ProjectBuildDetailTest(WebTest):
 
         self.assertEqual(items, list(response.context["archived_items"]))
 
+    def test_project_build_detail_query_budget(self):
+        """
+        The number of queries for the project build detail should not depend
+        on the number of dependencies or archived artifacts.
+        """
+        archive = ArchiveFactory.create(policy="cdimage", default=True)
+        self.app.get(reverse("home"), user="testing")
+        for count in [1, 5]:
+            project = ProjectFactory.create()
+            for dependency in DependencyFactory.create_batch(count):
+                ProjectDependency.objects.create(
+                    project=project, dependency=dependency)
+            projectbuild = build_project(project, queue_build=False)
+            for dependency in project.dependencies.all():
+                build = BuildFactory.create(
+                    job=dependency.job, build_id=projectbuild.build_key)
+                ArtifactFactory.create(build=build)
+                process_build_dependencies(build.pk)
+                archive.add_build(build)
+
+            url = reverse(
+                "project_projectbuild_detail",
+                kwargs={"project_pk": project.pk,
+                        "build_pk": projectbuild.pk})
+            with self.assertNumQueries(self.PROJECTBUILD_DETAIL_QUERIES):
+                response = self.app.get(url, user="testing")
+            self.assertEqual(
+                count, len(response.context["archived_items"]))
+
+
+class ProjectBuildTimelineTest(WebTest):
+
+    # The session and user, the projectbuild, dependencies with their builds,
+    # the recent projectbuilds and the critical path summary.
+    PROJECTBUILD_TIMELINE_QUERIES = 6
+
+    def setUp(self):
+        self.user = User.objects.create_user("testing")
+
+    def test_project_build_timeline(self):
+        """
+        The timeline shows the builds of the dependencies and which was on
+        the critical path.
+        """
+        project = ProjectFactory.create()
+        for dependency in DependencyFactory.create_batch(3):
+            ProjectDependency.objects.create(
+                project=project, dependency=dependency)
+        projectbuild = build_project(project, queue_build=False)
+        for index, dependency in enumerate(project.dependencies.all()):
+            build = BuildFactory.create(
+                job=dependency.job, build_id=projectbuild.build_key,
+                phase=Build.FINALIZED, duration=(index + 1) * 60000,
+                started_at=projectbuild.requested_at)
+            process_build_dependencies(build.pk)
+        self.app.get(reverse("home"), user="testing")
+
+        url = reverse(
+            "project_projectbuild_timeline",
+            kwargs={"project_pk": project.pk, "build_pk": projectbuild.pk})
+        with self.assertNumQueries(self.PROJECTBUILD_TIMELINE_QUERIES):
+            response = self.app.get(url, user="testing")
+
+        self.assertEqual(projectbuild, response.context["projectbuild"])
+        timeline = response.context["timeline"]
+        self.assertEqual(3, len(timeline["entries"]))
+        self.assertEqual(
+            [1], [x["count"] for x in response.context[
+                "critical_path_summary"]])
+        self.assertEqual(
+            timeline["critical"]["dependency"].name,
+            response.context["critical_path_summary"][0]["name"])
+        self.assertEqual(
+            1, len(response.html.select("tr.danger")))
+
 
 class DependencyListTest(WebTest):
 
@@ -426,6 +613,31 @@ class DependencyDetailTest(WebTest):
         self.assertEqual([project], list(response.context["projects"]))
         self.assertNotContains(response, "Dependency currently building")
 
+    @mock.patch("projects.caching.is_cache_shared", return_value=True)
+    def test_dependency_detail_is_cached(self, shared_mock):
+        """
+        Repeated views of the dependency detail should be served from the
+        cache until a build of the dependency is recorded.
+        """
+        dependency = DependencyFactory.create()
+        project = ProjectFactory.create()
+        ProjectDependency.objects.create(
+            project=project, dependency=dependency)
+        build1 = BuildFactory.create(job=dependency.job)
+        url = reverse("dependency_detail", kwargs={"pk": dependency.pk})
+        self.app.get(url, user="testing")
+
+        # The session and user, and the dependency.
+        with self.assertNumQueries(3):
+            response = self.app.get(url, user="testing")
+        self.assertEqual([build1], list(response.context["builds"]))
+        self.assertEqual(1, response.context["builds"].paginator.count)
+
+        build2 = BuildFactory.create(job=dependency.job)
+        response = self.app.get(url, user="testing")
+        self.assertEqual([build2, build1], list(response.context["builds"]))
+        self.assertContains(response, build2.build_id)
+
     def test_dependency_detail_with_currently_building(self):
         """
         If the Dependency is currently building, we should get an info message
@@ -457,8 +669,9 @@ class DependencyDetailTest(WebTest):
         self.assertEqual([project], list(response.context["projects"]))
         self.assertContains(
             response, "Build for '%s' queued." % dependency.name)
-        build_job_mock.delay.assert_called_once_with(
-            dependency.job.pk, user=self.user.username)
+        build_job_mock.apply_async.assert_called_once_with(
+            (dependency.job.pk,),
+            {"user": self.user.username, "priority": INTERACTIVE}, priority=9)
 
     def test_dependency_build_with_parameters(self):
         """
@@ -479,9 +692,10 @@ class DependencyDetailTest(WebTest):
         self.assertEqual([project], list(response.context["projects"]))
         self.assertContains(
             response, "Build for '%s' queued." % dependency.name)
-        build_job_mock.delay.assert_called_once_with(
-            dependency.job.pk, params={"TESTPARAMETER": "500"},
-            user=self.user.username)
+        build_job_mock.apply_async.assert_called_once_with(
+            (dependency.job.pk,),
+            {"params": {"TESTPARAMETER": "500"}, "user": self.user.username,
+             "priority": INTERACTIVE}, priority=9)
 
     def test_dependency_build_pagination(self):
         """
@@ -490,15 +704,17 @@ class DependencyDetailTest(WebTest):
         disabled and the next page link should be available.
         """
         dependency = DependencyFactory.create()
-        BuildFactory.create_batch(
+        builds = BuildFactory.create_batch(
             DependencyDetailView.PAGINATE_BUILDS + 1, job=dependency.job)
 
         depend_url = reverse("dependency_detail", kwargs={"pk": dependency.pk})
         response = self.app.get(depend_url, user="testing")
         self.assertEqual(200, response.status_code)
-        self.assertEqual(len(response.context["builds"]),
-                         DependencyDetailView.PAGINATE_BUILDS)
-        self.assertEqual(response.context["builds"].number, 1)
+        self.assertEqual(
+            list(reversed(builds[1:])), list(response.context["builds"]))
+        self.assertFalse(response.context["builds"].has_previous())
+        self.assertContains(
+            response, "%d builds" % (DependencyDetailView.PAGINATE_BUILDS + 1))
 
         # Check that the 'Newer' link is disabled
         self.assertRaises(IndexError, response.click, "Newer")
@@ -507,7 +723,7 @@ class DependencyDetailTest(WebTest):
         older = response.click("Older")
         self.assertEqual(200, older.status_code)
         self.assertNotEquals(older, response)
-        self.assertEqual(older.context["builds"].number, 2)
+        self.assertEqual([builds[0]], list(older.context["builds"]))
 
     def test_dependency_build_pagination_page_two(self):
         """
@@ -515,15 +731,14 @@ class DependencyDetailTest(WebTest):
         second page.
         """
         dependency = DependencyFactory.create()
-        BuildFactory.create_batch(
+        builds = BuildFactory.create_batch(
             DependencyDetailView.PAGINATE_BUILDS + 1, job=dependency.job)
 
         depend_url = reverse("dependency_detail", kwargs={"pk": dependency.pk})
-        depend_url += "?page=2"
-        response = self.app.get(depend_url, user="testing")
+        response = self.app.get(depend_url, user="testing").click("Older")
         self.assertEqual(200, response.status_code)
         self.assertEqual(len(response.context["builds"]), 1)
-        self.assertEqual(response.context["builds"].number, 2)
+        self.assertTrue(response.context["builds"].has_previous())
 
         # Check that the 'Older' link is disabled
         self.assertRaises(IndexError, response.click, "Older")
@@ -532,40 +747,46 @@ class DependencyDetailTest(WebTest):
         newer = response.click("Newer")
         self.assertEqual(200, newer.status_code)
         self.assertNotEquals(newer, response)
-        self.assertEqual(newer.context["builds"].number, 1)
+        self.assertEqual(
+            list(reversed(builds[1:])), list(newer.context["builds"]))
+        self.assertFalse(newer.context["builds"].has_previous())
 
-    def test_dependency_build_pagination_page_non_numeric(self):
+    def test_dependency_build_pagination_invalid_cursor(self):
         """
-        The dependency build list should return page 1 when a non-numeric
-        page is supplied.
+        The dependency build list should return page 1 when an invalid cursor
+        is supplied.
         """
         dependency = DependencyFactory.create()
         BuildFactory.create_batch(
             DependencyDetailView.PAGINATE_BUILDS + 1, job=dependency.job)
 
         depend_url = reverse("dependency_detail", kwargs={"pk": dependency.pk})
-        depend_url += "?page=abc"
+        depend_url += "?after=abc"
         response = self.app.get(depend_url, user="testing")
         self.assertEqual(200, response.status_code)
         self.assertEqual(len(response.context["builds"]),
                          DependencyDetailView.PAGINATE_BUILDS)
-        self.assertEqual(response.context["builds"].number, 1)
+        self.assertFalse(response.context["builds"].has_previous())
 
-    def test_dependency_build_pagination_page_invalid(self):
+    def test_dependency_build_pagination_cursor_out_of_range(self):
         """
-        The dependency build list should return the last page when an out-of-
-        range number is supplied.
+        The dependency build list should return the oldest builds when there
+        are no builds after the cursor.
         """
         dependency = DependencyFactory.create()
-        BuildFactory.create_batch(
+        builds = BuildFactory.create_batch(
             DependencyDetailView.PAGINATE_BUILDS + 1, job=dependency.job)
+        cursor = encode_cursor([builds[0].number - 1, builds[0].pk])
 
         depend_url = reverse("dependency_detail", kwargs={"pk": dependency.pk})
-        depend_url += "?page=999"
+        depend_url += "?after=%s" % cursor
         response = self.app.get(depend_url, user="testing")
         self.assertEqual(200, response.status_code)
-        self.assertEqual(len(response.context["builds"]), 1)
-        self.assertEqual(response.context["builds"].number, 2)
+        self.assertEqual(
+            list(reversed(builds[:DependencyDetailView.PAGINATE_BUILDS])),
+            list(response.context["builds"]))
+        self.assertFalse(response.context["builds"].has_next())
+        self.assertTrue(response.context["builds"].has_previous())
 
 
 class DependencyUpdateTest(WebTest):
@@ -679,13 +900,12 @@ class InitiateProjectBuildTest(WebTest):
 
         projectbuild = response.context["projectbuild"]
 
-        build_job_mock.delay.assert_has_calls([
-            mock.call(dep1.job.pk, build_id=projectbuild.build_key,
-                      user='testing'),
-            mock.call(dep2.job.pk, build_id=projectbuild.build_key,
-                      user='testing'),
-            mock.call(dep3.job.pk, build_id=projectbuild.build_key,
-                      user='testing')])
+        kwargs = {"build_id": projectbuild.build_key, "user": "testing",
+                  "priority": INTERACTIVE}
+        build_job_mock.apply_async.assert_has_calls([
+            mock.call((dep1.job.pk,), kwargs, priority=9),
+            mock.call((dep2.job.pk,), kwargs, priority=9),
+            mock.call((dep3.job.pk,), kwargs, priority=9)])
         self.assertContains(
             response, "Build '%s' queued." % projectbuild.build_id)
 
@@ -710,11 +930,11 @@ class InitiateProjectBuildTest(WebTest):
 
         projectbuild = response.context["projectbuild"]
 
-        build_job_mock.delay.assert_has_calls([
-            mock.call(dep1.job.pk, build_id=projectbuild.build_key,
-                      user='testing'),
-            mock.call(dep3.job.pk, build_id=projectbuild.build_key,
-                      user='testing')])
+        kwargs = {"build_id": projectbuild.build_key, "user": "testing",
+                  "priority": INTERACTIVE}
+        build_job_mock.apply_async.assert_has_calls([
+            mock.call((dep1.job.pk,), kwargs, priority=9),
+            mock.call((dep3.job.pk,), kwargs, priority=9)])
 
     def test_project_build_form_requires_selection(self):
         """
@@ -737,7 +957,7 @@ class InitiateProjectBuildTest(WebTest):
             response = form.submit()
 
         self.assertContains(response, "Must select at least one dependency.")
-        self.assertEqual([], build_job_mock.delay.mock_calls)
+        self.assertEqual([], build_job_mock.apply_async.mock_calls)
 
 
 class ProjectUpdateTest(WebTest):
@@ -782,6 +1002,32 @@ class ProjectUpdateTest(WebTest):
 
         self.assertEqual(1, len(project.dependencies.all()))
 
+    def test_project_update_adds_dependencies_with_current_build(self):
+        """
+        Dependencies added to a project should start with the current build of
+        the dependency.
+        """
+        project = ProjectFactory.create()
+        projectdependency = ProjectDependency.objects.create(
+            project=project, dependency=DependencyFactory.create())
+        dependency1 = DependencyFactory.create()
+        build = BuildFactory.create(
+            job=dependency1.job, phase=Build.FINALIZED)
+        dependency2 = DependencyFactory.create()
+
+        project_url = reverse("project_update", kwargs={"pk": project.pk})
+        response = self.app.get(project_url, user="testing")
+        form = response.forms["project"]
+        form["dependencies"].select_multiple(
+            [projectdependency.dependency.pk, dependency1.pk, dependency2.pk])
+        form.submit().follow()
+
+        current_builds = dict(ProjectDependency.objects.filter(
+            project=project).values_list("dependency", "current_build"))
+        self.assertEqual(
+            {projectdependency.dependency.pk: None, dependency1.pk: build.pk,
+             dependency2.pk: None}, current_builds)
+
     def test_project_update_auto_track_status(self):
         """
         The update view should allow us to change the auto_track status.
@@ -11,6 +11,9 @@ urlpatterns = patterns("",
     url(r"^projects/(?P<pk>\d+)/build/$", InitiateProjectBuildView.as_view(), name="project_initiate_projectbuild"),
     url(r"^projects/(?P<pk>\d+)/builds/$", ProjectBuildListView.as_view(), name="project_projectbuild_list"),
     url(r"^projects/(?P<project_pk>\d+)/builds/(?P<build_pk>\d+)/$", ProjectBuildDetailView.as_view(), name="project_projectbuild_detail"),
+    url(r"^projects/(?P<project_pk>\d+)/builds/(?P<build_pk>\d+)/timeline/$",
+        ProjectBuildTimelineView.as_view(),
+        name="project_projectbuild_timeline"),
     url(r"^projects/create/$", ProjectCreateView.as_view(), name="project_create"),
     url(r"^dependencies/create/$", DependencyCreateView.as_view(), name="dependency_create"),
     url(r"^dependencies/$", DependencyListView.as_view(), name="dependency_list"),
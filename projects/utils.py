@@ -1,13 +1,95 @@
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.db.models import Avg, Count, Max
+from django.utils import timezone
+
 from jenkins.models import Build
-from projects.models import ProjectDependency
+from jenkins.utils import DefaultSettings
+from projects.caching import get_or_set, get_project_version
+from projects.models import (
+    ProjectDependency, ProjectBuild, ProjectBuildDependency)
+
+
+build_table_settings = DefaultSettings({
+    "PROJECT_DEPENDENCY_RECENT_BUILDS": 5,
+    "CRITICAL_PATH_PROJECTBUILDS": 20,
+})
+
+RECENT_BUILDS_WINDOW_SQL = """
+SELECT * FROM (
+    SELECT build.*, ROW_NUMBER() OVER (
+        PARTITION BY build.job_id ORDER BY build.number DESC, build.id DESC
+    ) AS row_number
+    FROM {table} build
+    WHERE build.job_id IN ({jobs})
+) ranked
+WHERE ranked.row_number <= %s{current}
+ORDER BY ranked.job_id, ranked.row_number
+"""
+
+
+def supports_window_functions():
+    """
+    Returns True if the database supports ROW_NUMBER() OVER (...).
+    """
+    if connection.vendor == "postgresql":
+        return True
+    if connection.vendor == "sqlite":
+        from django.db.backends.sqlite3.base import Database
+        return Database.sqlite_version_info >= (3, 25, 0)
+    return False
+
 
+def get_recent_builds_by_job(job_pks, count, include):
+    """
+    Get the most recent count builds for each of the job_pks with a query per
+    job, for databases without window functions, see
+    get_recent_builds_for_jobs.
 
-def get_recent_builds_for_dependency(dependency):
+    Each query only reads the most recent builds of the job, numbering the
+    builds of all the jobs in a single query would need a correlated subquery
+    which counts the newer builds for every build.
     """
-    Get the most recent 5 builds for a given dependency.
+    recent_builds = dict(
+        (job_pk, list(Build.objects.filter(job=job_pk).order_by(
+            "-number", "-id")[:count])) for job_pk in job_pks)
+    included_builds = {}
+    if include:
+        included_builds = Build.objects.in_bulk(include)
+    return recent_builds, included_builds
+
+
+def get_recent_builds_for_jobs(job_pks, count, include=None):
+    """
+    Get the most recent count builds for each of the job_pks in a single
+    query if the database supports window functions, along with any builds
+    with a pk in include, regardless of whether or not they're recent.
+
+    Returns a dictionary mapping the job pk to the recent builds for that job,
+    ordered most recent first and a dictionary mapping the included build pks
+    to the builds.
     """
-    return list(
-        Build.objects.filter(job=dependency.job).order_by("-number")[:5])
+    job_pks = sorted(set(job_pks))
+    include = sorted(set(include or []))
+    if not job_pks:
+        return {}, {}
+    if not supports_window_functions():
+        return get_recent_builds_by_job(job_pks, count, include)
+    current = ""
+    if include:
+        current = " OR ranked.id IN (%s)" % ", ".join(["%s"] * len(include))
+    sql = RECENT_BUILDS_WINDOW_SQL.format(
+        table=connection.ops.quote_name(Build._meta.db_table),
+        jobs=", ".join(["%s"] * len(job_pks)), current=current)
+
+    recent_builds = dict((job_pk, []) for job_pk in job_pks)
+    included_builds = {}
+    for build in Build.objects.raw(sql, job_pks + [count] + include):
+        if build.row_number <= count:
+            recent_builds[build.job_id].append(build)
+        if build.pk in include:
+            included_builds[build.pk] = build
+    return recent_builds, included_builds
 
 
 def get_build_for_row(builds, row):
@@ -17,27 +99,42 @@ def get_build_for_row(builds, row):
         return
 
 
-def get_build_table_for_project(project):
+def get_build_table_for_project(project, count=None):
     """
     Returns a tuple with header row, list of rows
+
+    The table has a row for each of the most recent count builds (defaulting
+    to the PROJECT_DEPENDENCY_RECENT_BUILDS setting) and an additional row if
+    any current builds are older than that.
     """
-    dependencies = list(ProjectDependency.objects.filter(project=project))
+    if count is None:
+        count = build_table_settings.PROJECT_DEPENDENCY_RECENT_BUILDS
+    dependencies = list(ProjectDependency.objects.filter(
+        project=project).select_related("dependency"))
+
+    recent_builds_by_job, current_builds_by_pk = get_recent_builds_for_jobs(
+        [x.dependency.job_id for x in dependencies if x.dependency.job_id],
+        count, include=[x.current_build_id for x in dependencies
+                        if x.current_build_id])
 
     recent_builds = {}
     current_builds = {}
     for projectdependency in dependencies:
         dependency = projectdependency.dependency
-        recent_builds[dependency] = get_recent_builds_for_dependency(
-            dependency)
-        current_builds[dependency] = projectdependency.current_build
+        recent_builds[dependency] = list(
+            recent_builds_by_job.get(dependency.job_id, []))
+        current_builds[dependency] = current_builds_by_pk.get(
+            projectdependency.current_build_id)
 
     # Deal with possible extra builds outwith recent builds.
-    rows_to_count = 5
+    rows_to_count = count
     for projectdependency in dependencies:
         dependency = projectdependency.dependency
-        if projectdependency.current_build not in recent_builds[dependency]:
-            recent_builds[dependency].append(projectdependency.current_build)
-            rows_to_count = 6
+        current_build = current_builds[dependency]
+        recent_pks = set(x.pk for x in recent_builds[dependency])
+        if current_build is None or current_build.pk not in recent_pks:
+            recent_builds[dependency].append(current_build)
+            rows_to_count = count + 1
 
     header_row = [x.dependency for x in dependencies]
     build_rows = []
@@ -51,3 +148,178 @@ def get_build_table_for_project(project):
                  "current": current_builds[dependency] == current_build})
         build_rows.append(current_row)
     return header_row, build_rows
+
+
+def get_cached_build_table_for_project(project, count=None):
+    """
+    Returns the get_build_table_for_project from the cache, the cached table
+    is invalidated when a build is recorded for any of the project's jobs, or
+    when the project's dependencies change.
+    """
+    if count is None:
+        count = build_table_settings.PROJECT_DEPENDENCY_RECENT_BUILDS
+    key = "projects:build-table:%d:%d:%s" % (
+        project.pk, count, get_project_version(project.pk))
+    return get_or_set(
+        key, lambda: get_build_table_for_project(project, count=count))
+
+
+def get_projectbuild_urls(build_keys):
+    """
+    Returns a dictionary mapping the build_keys to the URLs of the associated
+    ProjectBuilds, build_keys without a ProjectBuild are not included.
+    """
+    build_keys = set(x for x in build_keys if x)
+    if not build_keys:
+        return {}
+    projectbuilds = ProjectBuild.objects.filter(
+        build_key__in=build_keys).values_list("build_key", "project", "pk")
+    return dict(
+        (build_key, reverse(
+            "project_projectbuild_detail",
+            kwargs={"project_pk": project_pk, "build_pk": build_pk}))
+        for build_key, project_pk, build_pk in projectbuilds)
+
+
+def get_queue_wait_by_priority(since=None):
+    """
+    Returns a dictionary mapping the priority classes to the number of
+    dependency builds, and the average and maximum number of seconds that they
+    waited before starting, for ProjectBuilds requested since the datetime.
+    """
+    dependencies = ProjectBuildDependency.objects.filter(
+        queue_wait__isnull=False)
+    if since is not None:
+        dependencies = dependencies.filter(
+            projectbuild__requested_at__gte=since)
+    waits = dependencies.values("projectbuild__priority").annotate(
+        count=Count("pk"), average=Avg("queue_wait"),
+        maximum=Max("queue_wait")).order_by()
+    return dict(
+        (x.pop("projectbuild__priority"), x) for x in waits)
+
+
+def get_seconds(delta):
+    return int(delta.total_seconds())
+
+
+def get_projectbuild_timeline(projectbuild):
+    """
+    Returns a dictionary with the wall time of the projectbuild in seconds,
+    and an entry for each of its dependencies with the times that the build
+    started and ended.
+
+    The wall time runs from the projectbuild being requested until the last
+    of the builds ended, the dependency whose build ended last is on the
+    critical path. Builds that were reused or shared may have started before
+    the projectbuild was requested.
+
+    Each entry has the offset and queue wait in seconds since the request,
+    the build duration in seconds, and the queue wait and the part of the
+    build after the request as a percentage of the wall time for display.
+    """
+    dependencies = list(ProjectBuildDependency.objects.filter(
+        projectbuild=projectbuild).select_related(
+        "dependency", "build").order_by("dependency__name", "pk"))
+
+    entries = []
+    for dependency in dependencies:
+        entry = {"projectbuild_dependency": dependency,
+                 "dependency": dependency.dependency,
+                 "build": dependency.build, "started_at": None,
+                 "ended_at": None, "critical": False}
+        if dependency.build is not None:
+            entry["started_at"] = dependency.build.get_start_time()
+            entry["ended_at"] = dependency.build.get_end_time()
+        entries.append(entry)
+
+    requested_at = projectbuild.requested_at
+    ended = [x for x in entries if x["ended_at"] is not None]
+    critical = max(ended, key=lambda x: x["ended_at"]) if ended else None
+    if critical is not None:
+        critical["critical"] = True
+
+    starts = [x["started_at"] for x in entries if x["started_at"]]
+    end = max([requested_at] + starts + [x["ended_at"] for x in ended])
+    span = max(get_seconds(end - requested_at), 1)
+    for entry in entries:
+        entry.update({"offset": None, "queue_wait": None, "duration": None})
+        if entry["started_at"] is None:
+            continue
+        entry["offset"] = get_seconds(entry["started_at"] - requested_at)
+        entry["queue_wait"] = max(0, entry["offset"])
+        entry["queue_percent"] = 100.0 * entry["queue_wait"] / span
+        if entry["ended_at"] is not None:
+            entry["duration"] = get_seconds(
+                entry["ended_at"] - entry["started_at"])
+            # The timeline starts when the projectbuild was requested.
+            visible = get_seconds(entry["ended_at"] - max(
+                entry["started_at"], requested_at))
+            entry["duration_percent"] = 100.0 * max(0, visible) / span
+
+    wall_time = None
+    if critical is not None:
+        wall_time = max(0, get_seconds(critical["ended_at"] - requested_at))
+    return {"requested_at": requested_at, "wall_time": wall_time,
+            "critical": critical, "entries": entries}
+
+
+def mark_critical_path(projectbuild):
+    """
+    Records which of the projectbuild's dependencies is on the critical path,
+    so that it can be aggregated across projectbuilds.
+    """
+    critical = get_projectbuild_timeline(projectbuild)["critical"]
+    critical_pk = critical and critical["projectbuild_dependency"].pk
+    ProjectBuildDependency.objects.filter(projectbuild=projectbuild).exclude(
+        pk=critical_pk).update(on_critical_path=False)
+    if critical_pk is not None:
+        ProjectBuildDependency.objects.filter(pk=critical_pk).update(
+            on_critical_path=True)
+    return critical_pk
+
+
+def finalize_projectbuild(projectbuild):
+    """
+    Marks the projectbuild as FINALIZED once the builds of its dependencies
+    have all finished, writing the manifest and recording the critical path.
+    """
+    projectbuild.phase = Build.FINALIZED
+    projectbuild.ended_at = timezone.now()
+    projectbuild.write_manifest()
+    mark_critical_path(projectbuild)
+    projectbuild.save()
+
+
+def get_critical_path_summary(project, count=None):
+    """
+    Returns a list with the number of times each dependency was on the
+    critical path for the most recent count FINALIZED builds of the project
+    (defaulting to the CRITICAL_PATH_PROJECTBUILDS setting), along with the
+    average duration of the dependency's builds on the critical path, most
+    frequent first.
+
+    Builds without a critical path, e.g. where none of the dependencies were
+    built, aren't counted in the number of projectbuilds.
+    """
+    if count is None:
+        count = build_table_settings.CRITICAL_PATH_PROJECTBUILDS
+    projectbuild_pks = list(ProjectBuild.objects.filter(
+        project=project, phase=Build.FINALIZED).order_by(
+        "-requested_at", "-id").values_list("pk", flat=True)[:count])
+    if not projectbuild_pks:
+        return []
+    summary = ProjectBuildDependency.objects.filter(
+        projectbuild__in=projectbuild_pks, on_critical_path=True).values(
+        "dependency", "dependency__name").annotate(
+        count=Count("pk"), average_duration=Avg("build__duration")).order_by(
+        "-count", "dependency__name")
+    # Each projectbuild has at most one dependency on the critical path.
+    projectbuilds = sum(x["count"] for x in summary)
+    return [{"dependency_pk": x["dependency"],
+             "name": x["dependency__name"], "count": x["count"],
+             "projectbuilds": projectbuilds,
+             # Jenkins reports the duration in milliseconds.
+             "average_duration": x["average_duration"] and int(
+                 x["average_duration"] / 1000)}
+            for x in summary]
@@ -1,5 +1,6 @@
-from django.core.paginator import (
-    Paginator, EmptyPage, PageNotAnInteger)
+import hashlib
+
+from django.db.models import Count
 from django.shortcuts import get_object_or_404
 from django.views.generic import (
     CreateView, ListView, DetailView, FormView, UpdateView, DeleteView)
@@ -9,9 +10,9 @@ from django.http import HttpResponseRedirect
 
 from braces.views import (
     LoginRequiredMixin, PermissionRequiredMixin, FormValidMessageMixin)
-from archives.models import ArchiveArtifact
 
 from jenkins.models import Build
+from jenkins.priorities import INTERACTIVE
 from jenkins.tasks import delete_job_from_jenkins
 from jenkins.utils import parse_parameters_from_job
 from projects.models import (
@@ -20,8 +21,14 @@ from projects.models import (
 from projects.forms import (
     ProjectForm, DependencyCreateForm, ProjectBuildForm)
 from projects.helpers import build_project, build_dependency
-from projects.utils import get_build_table_for_project
+from projects.caching import (
+    get_dashboard_cache_timeout, get_or_set, get_project_version,
+    get_dependency_version)
+from projects.utils import (
+    get_cached_build_table_for_project, get_projectbuild_timeline,
+    get_critical_path_summary)
 from archives.helpers import get_default_archive
+from capomastro.pagination import KeysetPaginator
 
 
 class ProjectCreateView(
@@ -90,7 +97,8 @@ class InitiateProjectBuildView(LoginRequiredMixin, FormView):
         project = form.cleaned_data["project"]
         projectbuild = build_project(
             project, user=self.request.user,
-            dependencies=form.cleaned_data["dependencies"])
+            dependencies=form.cleaned_data["dependencies"],
+            priority=INTERACTIVE)
         messages.add_message(
             self.request, messages.INFO,
             "Build '%s' queued." % projectbuild.build_id)
@@ -102,15 +110,34 @@ class InitiateProjectBuildView(LoginRequiredMixin, FormView):
 
 class ProjectBuildListView(LoginRequiredMixin, ListView):
 
+    PAGINATE_BUILDS = 20
     context_object_name = "projectbuilds"
     model = ProjectBuild
 
     def get_queryset(self):
         return ProjectBuild.objects.filter(
-            project=self._get_project_from_url())
+            project=self._get_project_from_url()).select_related(
+            "requested_by")
 
     def _get_project_from_url(self):
-        return get_object_or_404(Project, pk=self.kwargs["pk"])
+        if not hasattr(self, "_project"):
+            self._project = get_object_or_404(Project, pk=self.kwargs["pk"])
+        return self._project
+
+    def paginate_queryset(self, queryset, page_size):
+        """
+        Paginate the projectbuilds, most recent first, using the after or
+        before cursors from the request.
+        """
+        paginator = KeysetPaginator(
+            queryset, ("-requested_at", "-id"), page_size)
+        page = paginator.page(
+            after=self.request.GET.get("after"),
+            before=self.request.GET.get("before"))
+        return (paginator, page, page.object_list, page.has_other_pages())
+
+    def get_paginate_by(self, queryset):
+        return self.PAGINATE_BUILDS
 
     def get_context_data(self, **kwargs):
         """
@@ -130,19 +157,13 @@ class ProjectBuildDetailView(LoginRequiredMixin, DetailView):
         project_pk = self.kwargs["project_pk"]
         build_pk = self.kwargs["build_pk"]
         return get_object_or_404(
-            ProjectBuild, project__pk=project_pk, pk=build_pk)
-
-    def _get_project_from_url(self):
-        return get_object_or_404(Project, pk=self.kwargs["project_pk"])
-
-    def _get_build_from_url(self):
-        project_pk = self.kwargs["project_pk"]
-        build_pk = self.kwargs["build_pk"]
-        return get_object_or_404(
-            ProjectBuild, project__pk=project_pk, pk=build_pk)
+            ProjectBuild.objects.select_related("project"),
+            project__pk=project_pk, pk=build_pk)
 
     def _get_build_dependencies(self, projectbuild):
-        return ProjectBuildDependency.objects.filter(projectbuild=projectbuild)
+        return ProjectBuildDependency.objects.filter(
+            projectbuild=projectbuild).select_related(
+            "build", "dependency__job")
 
     def get_context_data(self, **kwargs):
         """
@@ -150,15 +171,41 @@ class ProjectBuildDetailView(LoginRequiredMixin, DetailView):
         """
         context = super(
             ProjectBuildDetailView, self).get_context_data(**kwargs)
-        context["project"] = self._get_project_from_url()
-        context["projectbuild"] = self._get_build_from_url()
+        context["project"] = self.object.project
+        context["projectbuild"] = self.object
         context["dependencies"] = self._get_build_dependencies(
             context["projectbuild"])
 
         archive = get_default_archive()
         if archive:
             context["archived_items"] = archive.items.filter(
-                projectbuild_dependency__projectbuild=context["projectbuild"])
+                projectbuild_dependency__projectbuild=context["projectbuild"]
+                ).select_related("artifact__build__job", "archive")
+        return context
+
+
+class ProjectBuildTimelineView(LoginRequiredMixin, DetailView):
+
+    template_name = "projects/projectbuild_timeline.html"
+    context_object_name = "projectbuild"
+
+    def get_object(self):
+        return get_object_or_404(
+            ProjectBuild.objects.select_related("project"),
+            project__pk=self.kwargs["project_pk"], pk=self.kwargs["build_pk"])
+
+    def get_context_data(self, **kwargs):
+        """
+        Supplement the projectbuild with the timeline of its dependency
+        builds, and which dependencies have determined the wall time of
+        recent builds of the project.
+        """
+        context = super(
+            ProjectBuildTimelineView, self).get_context_data(**kwargs)
+        context["project"] = self.object.project
+        context["timeline"] = get_projectbuild_timeline(self.object)
+        context["critical_path_summary"] = get_critical_path_summary(
+            self.object.project)
         return context
 
 
@@ -168,58 +215,53 @@ class ProjectDetailView(LoginRequiredMixin, DetailView):
     context_object_name = "project"
 
     def get_context_data(self, **kwargs):
+        """
+        The expensive part of the context is cached under a key with the
+        version of the project, which is bumped whenever it changes, and is
+        also used by the template for caching the rendered fragments.
+        """
+        context = super(ProjectDetailView, self).get_context_data(**kwargs)
+        version = get_project_version(self.object.pk)
+        context.update(get_or_set(
+            "projects:project-detail:%d:%s" % (self.object.pk, version),
+            self.get_project_data))
+        context["cache_version"] = version
+        context["cache_timeout"] = get_dashboard_cache_timeout()
+        return context
+
+    def get_project_data(self):
         """
         Supplement the project with its dependencies.
         """
-        context = super(
-            ProjectDetailView, self).get_context_data(**kwargs)
-        context["dependencies"] = ProjectDependency.objects.filter(
-            project=context["project"])
-        context["projectbuilds"] = ProjectBuild.objects.filter(
-            project=context["project"]).order_by("-build_id")[:5]
+        context = {}
+        context["dependencies"] = list(ProjectDependency.objects.filter(
+            project=self.object).select_related(
+            "dependency", "current_build"))
+        context["projectbuilds"] = list(ProjectBuild.objects.filter(
+            project=self.object).select_related(
+            "requested_by").order_by("-build_id")[:5])
 
         items = []
-        # Get the artifacts for the current project build
-        current_projectbuild = context["project"].get_current_projectbuild()
+        # Get the artifacts for the current project build from its manifest
+        current_projectbuild = self.object.get_current_projectbuild()
         if current_projectbuild:
-            # Get the archived artifacts
-            archived_item_query = ArchiveArtifact.objects.filter(
-                projectbuild_dependency__projectbuild=current_projectbuild)
-            for archived_item in archived_item_query.all():
-                    items.append(
-                        self.item_from_archived_artifact(archived_item))
-
-            # Get the unarchived artifacts
-            if len(items) == 0:
-                for artifact in current_projectbuild.get_current_artifacts():
-                    items.append(self.item_from_artifact(artifact))
+            for entry in current_projectbuild.manifest.select_related(
+                    "build__job"):
+                items.append(self.item_from_manifest(entry))
         context["current_artifacts"] = items
         return context
 
     @staticmethod
-    def item_from_archived_artifact(archived_item):
-        """
-        Return an archived artifact in a standard format for display.
-        """
-        return {
-            "build_name": "%s %s" % (archived_item.build.job,
-                                     archived_item.build.number),
-            "filename": archived_item.artifact.filename,
-            "url": archived_item.get_url(),
-            "archived": True,
-        }
-
-    @staticmethod
-    def item_from_artifact(artifact):
+    def item_from_manifest(entry):
         """
-        Return an artifact in a standard format for display.
+        Return an entry from a ProjectBuild manifest in a standard format for
+        display.
         """
         return {
-            "build_name": "%s %s" % (
-                artifact.build.job, artifact.build.number),
-            "filename": artifact.filename,
-            "url": artifact.url,
-            "archived": False,
+            "build_name": "%s %s" % (entry.build.job, entry.build.number),
+            "filename": entry.filename,
+            "url": entry.get_url(),
+            "archived": entry.archived,
         }
 
 
@@ -243,6 +285,9 @@ class DependencyListView(LoginRequiredMixin, ListView):
     context_object_name = "dependencies"
     model = Dependency
 
+    def get_queryset(self):
+        return Dependency.objects.select_related("job__jobtype", "last_build")
+
 
 class DependencyDetailView(LoginRequiredMixin, DetailView):
 
@@ -250,37 +295,49 @@ class DependencyDetailView(LoginRequiredMixin, DetailView):
     context_object_name = "dependency"
     model = Dependency
 
-    def paginate_builds(self, context, page):
+    def paginate_builds(self, context, after=None, before=None):
         """
         Paginate the builds list so it returns n at a time (n is defined in
         PAGINATE_BUILDS).
         :param context: the context data
-        :param page: the requested page number
+        :param after: the cursor for the page of builds to follow
+        :param before: the cursor for the page of builds to precede
         """
-        builds_list = Build.objects.filter(job=context["dependency"].job)
-        paginator = Paginator(builds_list, self.PAGINATE_BUILDS)
+        builds_list = Build.objects.filter(job=context["dependency"].job_id)
+        paginator = KeysetPaginator(
+            builds_list, ("-number", "-id"), self.PAGINATE_BUILDS)
+        return paginator.page(after=after, before=before)
 
-        try:
-            builds = paginator.page(page)
-        except PageNotAnInteger:
-            # If page is not an integer, send the first page.
-            builds = paginator.page(1)
-        except EmptyPage:
-            # If page is out of range, send the last page of results.
-            builds = paginator.page(paginator.num_pages)
-        return builds
+    def get_dependency_data(self):
+        """
+        Supplement the dependency.
+        """
+        context = {}
+        context["builds"] = self.paginate_builds(
+            context={"dependency": self.object},
+            after=self.request.GET.get("after"),
+            before=self.request.GET.get("before"))
+        context["projects"] = list(Project.objects.filter(
+            dependencies=self.object).annotate(
+            projectbuild_count=Count("projectbuild")))
+        return context
 
     def get_context_data(self, **kwargs):
         """
-        Supplement the dependency.
+        The builds and projects are cached under a key with the version of
+        the dependency and the page of builds, see ProjectDetailView.
         """
         context = super(
             DependencyDetailView, self).get_context_data(**kwargs)
-
-        context["builds"] = self.paginate_builds(
-            context=context, page=self.request.GET.get('page'))
-        context["projects"] = Project.objects.filter(
-            dependencies=context["dependency"])
+        version = get_dependency_version(self.object.pk)
+        cursors = hashlib.md5(repr(
+            (self.request.GET.get("after"), self.request.GET.get("before"))))
+        context.update(get_or_set(
+            "projects:dependency-detail:%d:%s:%s" % (
+                self.object.pk, version, cursors.hexdigest()),
+            self.get_dependency_data))
+        context["cache_version"] = version
+        context["cache_timeout"] = get_dashboard_cache_timeout()
         if context["dependency"].is_building:
             messages.add_message(
                 self.request, messages.INFO,
@@ -292,7 +349,7 @@ class DependencyDetailView(LoginRequiredMixin, DetailView):
         Queue a build of this Dependency.
         """
         dependency = get_object_or_404(Dependency, pk=pk)
-        build_dependency(dependency, user=request.user)
+        build_dependency(dependency, user=request.user, priority=INTERACTIVE)
         messages.add_message(
             self.request, messages.INFO,
             "Build for '%s' queued." % dependency.name)
@@ -318,9 +375,12 @@ class ProjectDependenciesView(LoginRequiredMixin, DetailView):
         """
         context = super(
             ProjectDependenciesView, self).get_context_data(**kwargs)
-        header, table = get_build_table_for_project(context["project"])
+        header, table = get_cached_build_table_for_project(
+            context["project"])
         context["builds_header"] = header
         context["builds_table"] = table
+        context["cache_version"] = get_project_version(context["project"].pk)
+        context["cache_timeout"] = get_dashboard_cache_timeout()
         return context
 
 
@@ -387,5 +447,5 @@ __all__ = [
     "DependencyCreateView", "InitiateProjectBuildView", "ProjectBuildListView",
     "ProjectBuildDetailView", "DependencyListView", "DependencyDetailView",
     "ProjectUpdateView", "ProjectDependenciesView", "DependencyUpdateView",
-    "DependencyDeleteView"
+    "DependencyDeleteView", "ProjectBuildTimelineView"
 ]